@@ -22,6 +22,10 @@ Usage:
                  [--skip-roi]
                  [--generate-pngs]
                  [--roi-ids "all" | "214,2214"]
+                 [--roi-plot-format png|pdf|sheet]
+                 [--roi-workers N]
+                 [--roi-hierarchy structure_graph.json]
+                 [--roi-native]
                  [--force]
                  [--keep-all-rare]
                  [--require-all-modalities]
@@ -94,16 +98,6 @@ rare_allen_outputs_ready() {
   return 0
 }
 
-roi_tables_exist_for_group() {
-  local group_name="$1"; shift
-  local modalities=( "$@" )
-  for m in "${modalities[@]}"; do
-    local tsv="${OUT_ROOT}/derivatives/ROI_stats/${group_name}/${group_name}_${m}_roi_stats.tsv"
-    if [[ ! -f "$tsv" ]]; then return 1; fi
-  done
-  return 0
-}
-
 # ------------------------
 # Args & Defaults
 # ------------------------
@@ -118,6 +112,10 @@ RARE_TRANSFORM_TYPE="a"
 SKIP_ROI=0
 GENERATE_PNGS=0
 ROI_IDS="all"
+ROI_PLOT_FORMAT="png"
+ROI_WORKERS=1
+ROI_HIERARCHY=""
+ROI_NATIVE=0
 FORCE_RERUN=0
 MODALITIES_LIST="T1map,UNIT1"
 FILTER_BY_MODALITIES=1
@@ -138,6 +136,10 @@ while [[ $# -gt 0 ]]; do
     --skip-roi) SKIP_ROI=1; shift ;;
     --generate-pngs) GENERATE_PNGS=1; shift ;;
     --roi-ids) ROI_IDS="${2:-all}"; shift 2 ;;
+    --roi-plot-format) ROI_PLOT_FORMAT="${2:-png}"; shift 2 ;;
+    --roi-workers) ROI_WORKERS="${2:-1}"; shift 2 ;;
+    --roi-hierarchy) ROI_HIERARCHY="${2:-}"; shift 2 ;;
+    --roi-native) ROI_NATIVE=1; shift ;;
     --force) FORCE_RERUN=1; shift ;;
     --keep-all-rare) FILTER_BY_MODALITIES=0; shift ;;
     --require-all-modalities) REQUIRE_ALL_MODALITIES=1; shift ;;
@@ -173,6 +175,11 @@ mkdir -p "$OUT_ROOT"
 
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 PYTHON_BIN="${PYTHON_BIN:-python3}"
+# Brain extraction: volumes per network pass, N4 processes running ahead of the network
+MASK_BATCH_SIZE="${MASK_BATCH_SIZE:-4}"
+MASK_N4_WORKERS="${MASK_N4_WORKERS:-2}"
+# 1 = N4 only on the coarse brain box (masked), pasted back into the full volume
+MASK_CROP_N4="${MASK_CROP_N4:-0}"
 
 # --- INITIALIAZE Ants IA MODELS (offline) ---
 # Copy of models if you don't have internet acces, uncomment this :
@@ -187,6 +194,7 @@ RARE_TEMPLATE_SCRIPT="${RARE_TEMPLATE_SCRIPT:-$SCRIPT_DIR/src/build_study_templa
 APPLY_TO_TEMPLATE_SCRIPT="${APPLY_TO_TEMPLATE_SCRIPT:-$SCRIPT_DIR/src/project_maps_to_template.sh}"
 MAKE_TEMPLATE_SCRIPT="${MAKE_TEMPLATE_SCRIPT:-$SCRIPT_DIR/src/average_maps.sh}"
 ROI_SCRIPT="${ROI_SCRIPT:-$SCRIPT_DIR/src/extract_roi_stats.py}"
+WARP_LABELS_SCRIPT="${WARP_LABELS_SCRIPT:-$SCRIPT_DIR/src/warp_labels_to_native.sh}"
 
 ALLEN_TEMPLATE_DEFAULT="$SCRIPT_DIR/resources/100_AMBA_ref.nii.gz"
 if [[ ! -f "$ALLEN_TEMPLATE_DEFAULT" ]]; then
@@ -233,6 +241,10 @@ if [[ -n "$SESSION_FILTER" ]]; then
   IFS=',' read -r -a filter_sessions <<< "$SESSION_FILTER"
 fi
 
+# Sessions selected: RARE files still without mask, then (mask, modality, image) to apply
+pending_rare=()
+apply_masks=(); apply_mods=(); apply_imgs=(); apply_assume_ses1=()
+
 for sub_dir in "${subject_dirs[@]}"; do
   [[ -d "$sub_dir" ]] || continue
   sub="$(basename "$sub_dir")"
@@ -304,11 +316,9 @@ for sub_dir in "${subject_dirs[@]}"; do
     
     if [[ "$FORCE_RERUN" != "1" && -f "$mask_path" ]]; then :
     else
-      "$PYTHON_BIN" "$CREATE_MASK_SCRIPT" --input "$rare" --bids-root "$BIDS_DIR" --out-root "$OUT_ROOT"
+      pending_rare+=("$rare")
     fi
 
-    if [[ ! -f "$mask_path" ]]; then continue; fi
-
     for mod in "${requested_modalities[@]}"; do
       img=""
       for (( i=0; i<${#session_mods[@]}; i++ )); do
@@ -319,22 +329,47 @@ for sub_dir in "${subject_dirs[@]}"; do
       done
       
       [[ -z "$img" ]] && continue
-      mkdir -p "${brain_extracted_root}/${mod}"
-      img_base="$(basename_nii "$img")"
-      if [[ "$assume_ses1" == "1" ]]; then
-         if [[ "$img_base" =~ ^(sub-[^_]+)_(.+)$ ]]; then img_base="${BASH_REMATCH[1]}_ses-1_${BASH_REMATCH[2]}"; fi
-      fi
-      out_img="${brain_extracted_root}/${mod}/${img_base}_brain_extracted.nii.gz"
-      if [[ ! -f "$out_img" || "$FORCE_RERUN" == "1" ]]; then
-        "$PYTHON_BIN" "$MASK_APPLY_SCRIPT" --mask "$mask_path" --acq "$img" --output "$out_img"
-      fi
-      
-      if [[ "$MODALITY_FOUND_STR" != *" $mod "* ]]; then
-        MODALITY_FOUND_STR+="${mod} "
-      fi
+      apply_masks+=("$mask_path")
+      apply_mods+=("$mod")
+      apply_imgs+=("$img")
+      apply_assume_ses1+=("$assume_ses1")
     done
   done
 done
+
+# One Python process for all the masks: the extraction network is loaded once.
+# A failed subject must not prevent the masks of the others from being applied.
+mask_status=0
+if [[ ${#pending_rare[@]} -gt 0 ]]; then
+  mask_opts=(--batch-size "$MASK_BATCH_SIZE" --n4-workers "$MASK_N4_WORKERS")
+  [[ "$MASK_CROP_N4" == "1" ]] && mask_opts+=(--crop-n4)
+  "$PYTHON_BIN" "$CREATE_MASK_SCRIPT" --inputs "${pending_rare[@]}" --bids-root "$BIDS_DIR" --out-root "$OUT_ROOT" \
+    "${mask_opts[@]}" || mask_status=$?
+fi
+
+for (( k=0; k<${#apply_masks[@]}; k++ )); do
+  mask_path="${apply_masks[$k]}"
+  mod="${apply_mods[$k]}"
+  img="${apply_imgs[$k]}"
+  if [[ ! -f "$mask_path" ]]; then continue; fi
+
+  mkdir -p "${brain_extracted_root}/${mod}"
+  img_base="$(basename_nii "$img")"
+  if [[ "${apply_assume_ses1[$k]}" == "1" ]]; then
+     if [[ "$img_base" =~ ^(sub-[^_]+)_(.+)$ ]]; then img_base="${BASH_REMATCH[1]}_ses-1_${BASH_REMATCH[2]}"; fi
+  fi
+  out_img="${brain_extracted_root}/${mod}/${img_base}_brain_extracted.nii.gz"
+  if [[ ! -f "$out_img" || "$FORCE_RERUN" == "1" ]]; then
+    "$PYTHON_BIN" "$MASK_APPLY_SCRIPT" --mask "$mask_path" --acq "$img" --output "$out_img"
+  fi
+  
+  if [[ "$MODALITY_FOUND_STR" != *" $mod "* ]]; then
+    MODALITY_FOUND_STR+="${mod} "
+  fi
+done
+if [[ $mask_status -ne 0 ]]; then
+  echo "[WARN] Some brain masks failed (see [ERROR] above): those sessions were not masked."
+fi
 echo_hr
 
 # ============================================================
@@ -363,7 +398,10 @@ for m in "${requested_modalities[@]}"; do
   fi
 done
 
-if [[ ${#mods_to_align[@]} -gt 0 ]]; then
+# Native ROI stats do not need the maps in Allen space: only resample them for the templates
+if [[ "$ROI_NATIVE" == "1" && "$DO_TEMPLATE_STEPS" == "0" && "$STOP_AFTER_ALLEN" != "1" ]]; then
+  echo " Native ROI stats: maps not resampled to Allen."
+elif [[ ${#mods_to_align[@]} -gt 0 ]]; then
   export BRAIN_DIR="${brain_extracted_root}"
   export TRANSFORM_DIR="${brain_extracted_root}/RARE/transforms"
   export ALLEN_TEMPLATE="$ALLEN_TEMPLATE"
@@ -424,13 +462,19 @@ if [[ "$DO_TEMPLATE_STEPS" == "0" ]]; then
   INPUT_TYPE="aligned"
 fi
 
-# On vérifie si les fichiers existent déjà (seulement en mode template, 
-# en single-subject on recalcule ou on laisse le Python écraser)
-if [[ "$FORCE_RERUN" != "1" && "$INPUT_TYPE" == "template" ]]; then
-  if roi_tables_exist_for_group "$TEMPLATE_GROUP_NAME" "${mods_to_align[@]}"; then
-    echo " ROI tables already exist. Done."
-    exit 0
-  fi
+# Stats natives : les labels Allen sont ramenés sur la grille native de chaque carte
+# (transformées inverses, interpolation GenericLabel), les cartes ne sont pas rééchantillonnées
+if [[ "$ROI_NATIVE" == "1" ]]; then
+  INPUT_TYPE="native"
+  echo "=== Warp Allen labels to native space ==="
+  export BRAIN_DIR="${brain_extracted_root}"
+  export MODALITIES="$(IFS=','; echo "${mods_to_align[*]}")"
+  export TRANSFORM_DIR="${brain_extracted_root}/RARE/transforms"
+  export ALLEN_TEMPLATE="$ALLEN_TEMPLATE"
+  export ALLEN_LABELS="$ALLEN_LABELS"
+  export FORCE_RERUN="$FORCE_RERUN"
+  bash "$WARP_LABELS_SCRIPT"
+  echo_hr
 fi
 
 if [[ ${#mods_to_align[@]} -gt 0 && -f "$ROI_SCRIPT" ]]; then
@@ -444,11 +488,23 @@ if [[ ${#mods_to_align[@]} -gt 0 && -f "$ROI_SCRIPT" ]]; then
     --labels-table "$ALLEN_LABELS_TABLE"
     --modalities "$roi_modalities"
     --input-type "$INPUT_TYPE"
+    --workers "$ROI_WORKERS"
   )
 
+  # Sans --force, le Python ne recalcule que les images (ou options/atlas) modifiées
+  # depuis le dernier passage (manifest des empreintes dans ROI_stats/)
+  if [[ "$FORCE_RERUN" != "1" ]]; then
+    ROI_ARGS+=( --incremental )
+  fi
+
   # Si l'utilisateur a demandé les PNGs, on ajoute les arguments nécessaires
   if [[ "$GENERATE_PNGS" == "1" ]]; then
-    ROI_ARGS+=( --per-roi-png --roi-ids "$ROI_IDS" )
+    ROI_ARGS+=( --per-roi-png --roi-ids "$ROI_IDS" --roi-plot-format "$ROI_PLOT_FORMAT" )
+  fi
+
+  # Tables des structures parentes (ontologie Allen)
+  if [[ -n "$ROI_HIERARCHY" ]]; then
+    ROI_ARGS+=( --hierarchy "$ROI_HIERARCHY" )
   fi
 
   # Exécution du script Python
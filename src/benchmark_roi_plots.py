@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-PNG cost of the per-ROI distribution plots of extract_roi_stats.py:
+a fresh matplotlib figure per ROI ("figure") vs the reusable RoiFigureRenderer ("renderer").
+ROI voxel values are synthetic (normal, sizes spread over --min-voxels..--max-voxels).
+
+Example:
+    python benchmark_roi_plots.py --n-rois 100 --outdir /tmp/roi_png_bench
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from extract_roi_stats import plot_single_roi_distribution
+
+
+def make_rois(n_rois: int, min_voxels: int, max_voxels: int, seed: int) -> List[Tuple[np.ndarray, Dict[str, float]]]:
+    rng = np.random.default_rng(seed)
+    sizes = np.geomspace(max(min_voxels, 1), max(max_voxels, min_voxels, 1), n_rois).astype(np.int64)
+    rois = []
+    for size in rng.permutation(sizes):
+        vals = rng.normal(1500.0, 300.0, size=int(size)).astype(np.float32)
+        stats = {
+            "n_voxels": int(vals.size),
+            "mean": float(vals.mean()),
+            "std": float(vals.std()),
+            "min": float(vals.min()),
+            "max": float(vals.max()),
+        }
+        rois.append((vals, stats))
+    return rois
+
+
+def time_mode(rois: List[Tuple[np.ndarray, Dict[str, float]]], outdir: Path, reuse_figure: bool, max_points: int) -> float:
+    """
+    Seconds per PNG (includes figure setup, drawing and writing).
+    """
+    outdir.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    for i, (vals, stats) in enumerate(rois):
+        plot_single_roi_distribution(
+            values=vals,
+            roi_id=i + 1,
+            roi_name=f"ROI{i + 1}",
+            hemi="L",
+            stats=stats,
+            out_png=outdir / f"roi_{i + 1}.png",
+            modality_label="T1map",
+            max_points=max_points,
+            reuse_figure=reuse_figure,
+        )
+    return (time.perf_counter() - t0) / max(len(rois), 1)
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark per-ROI PNG rendering (fresh figure vs reusable renderer).")
+    p.add_argument("--n-rois", type=int, default=50, help="PNGs rendered per mode.")
+    p.add_argument("--min-voxels", type=int, default=50)
+    p.add_argument("--max-voxels", type=int, default=50000)
+    p.add_argument("--max-points", type=int, default=5000, help="Same as --roi-max-points of extract_roi_stats.py.")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--outdir", type=str, default="", help="Keep the PNGs here (default: temporary dir, removed).")
+    p.add_argument("--json", type=str, default="", help="Also write the results to this JSON file.")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    rois = make_rois(args.n_rois, args.min_voxels, args.max_voxels, args.seed)
+
+    tmp = None
+    if args.outdir:
+        outdir = Path(args.outdir).resolve()
+    else:
+        tmp = tempfile.mkdtemp(prefix="roi_png_bench_")
+        outdir = Path(tmp)
+
+    try:
+        # warm-up: matplotlib import, font cache, renderer construction
+        time_mode(rois[:1], outdir / "warmup", reuse_figure=False, max_points=args.max_points)
+        time_mode(rois[:1], outdir / "warmup", reuse_figure=True, max_points=args.max_points)
+
+        results = {
+            "n_rois": args.n_rois,
+            "figure_s_per_png": time_mode(rois, outdir / "figure", reuse_figure=False, max_points=args.max_points),
+            "renderer_s_per_png": time_mode(rois, outdir / "renderer", reuse_figure=True, max_points=args.max_points),
+        }
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    results["speedup"] = results["figure_s_per_png"] / max(results["renderer_s_per_png"], 1e-12)
+    print(f"[OK] fresh figure : {results['figure_s_per_png'] * 1e3:.1f} ms/PNG")
+    print(f"[OK] renderer     : {results['renderer_s_per_png'] * 1e3:.1f} ms/PNG")
+    print(f"[OK] speedup      : x{results['speedup']:.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of the ROI statistics engine of extract_roi_stats.py on synthetic atlases:
+label volumes on the Allen 100 um grid scaled to --resolutions (um), with --n-labels ROIs
+of skewed sizes (lognormal, --size-skew) and normal values. Each stage is timed separately
+(best of --repeat) with its peak RSS:
+  - index      : label index of the atlas bundle (index_label_volume)
+  - stats_fast : compute_stats_fast on the raw label/value volumes
+  - stats      : compute_stats_indexed through the bundle (the CLI path)
+  - table      : ROI table assembly (build_roi_table)
+  - png        : per-ROI distribution PNGs (reusable renderer), per PNG
+The JSON report (--json) can be compared across versions.
+
+Example:
+    python benchmark_roi_stats.py --resolutions 100,50 --n-labels 10,500,5000 --json roi_bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from extract_roi_stats import (
+    STATS_ENGINES,
+    STATS_KERNELS,
+    build_roi_table,
+    compute_stats_fast,
+    compute_stats_indexed,
+    index_label_volume,
+    plot_single_roi_distribution,
+)
+
+ALLEN_100UM_SHAPE = (114, 132, 80)
+
+
+def make_atlas(resolution_um: float, n_labels: int, size_skew: float, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (labels, values) on the Allen grid at resolution_um. The brain is an ellipsoid filling the grid,
+    cut in C order into n_labels contiguous ROIs with lognormal sizes (sigma size_skew, >= 1 voxel).
+    """
+    rng = np.random.default_rng(seed)
+    shape = tuple(max(int(round(n * 100.0 / resolution_um)), 1) for n in ALLEN_100UM_SHAPE)
+    axes = np.ogrid[tuple(slice(0, n) for n in shape)]
+    r2 = sum(((a - (n - 1) / 2.0) / (n / 2.0)) ** 2 for a, n in zip(axes, shape))
+    brain = np.flatnonzero(r2 <= 0.9)
+    del r2
+
+    weights = rng.lognormal(0.0, size_skew, n_labels)
+    sizes = np.maximum(np.floor(weights / weights.sum() * (brain.size - n_labels)), 0).astype(np.int64) + 1
+    sizes[-1] += brain.size - sizes.sum()  # remainder (>= 1 by construction)
+
+    labels = np.zeros(int(np.prod(shape)), dtype=np.int32)
+    labels[brain] = np.repeat(rng.permutation(n_labels) + 1, sizes)
+    values = np.zeros(labels.size, dtype=np.float32)
+    offsets = rng.normal(1500.0, 200.0, n_labels + 1).astype(np.float32)
+    values[brain] = offsets[labels[brain]] + rng.normal(0.0, 150.0, brain.size).astype(np.float32)
+    return labels.reshape(shape), values.reshape(shape)
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Reset the peak RSS of this process (Linux >= 4.0); False if not supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _status_mb(field: str) -> float:
+    """
+    VmHWM (peak RSS) or VmRSS of this process from /proc; ru_maxrss (peak) elsewhere.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # kB on Linux
+
+
+def time_stage(fn: Callable[[], object], repeat: int) -> Tuple[object, Dict[str, float]]:
+    """
+    Best wall time of repeat runs and peak RSS over them (process-wide peak if it cannot be
+    reset), with the RSS at the start of the stage (inputs already resident).
+    """
+    base = _status_mb("VmRSS")
+    resettable = _reset_peak_rss()
+    best = np.inf
+    out = None
+    for _ in range(max(repeat, 1)):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return out, {"seconds": best, "peak_rss_mb": _status_mb("VmHWM"), "start_rss_mb": base,
+                 "peak_rss_is_stage": resettable}
+
+
+def run_case(
+    resolution_um: float,
+    n_labels: int,
+    args: argparse.Namespace,
+    png_dir: Path,
+) -> Dict[str, object]:
+    labels, values = make_atlas(resolution_um, n_labels, args.size_skew, args.seed)
+    n_brain = int(np.count_nonzero(labels))
+    stages: Dict[str, Dict[str, float]] = {}
+
+    bundle, stages["index"] = time_stage(
+        lambda: index_label_volume(labels, {}, args.lr_offset, "_R", "_L"), args.repeat,
+    )
+    _, stages["stats_fast"] = time_stage(
+        lambda: compute_stats_fast(
+            labels, values, False, True, args.engine, args.approx_quantiles, args.threads,
+        ),
+        args.repeat,
+    )
+    stats, stages["stats"] = time_stage(
+        lambda: compute_stats_indexed(
+            bundle, values, False, True, args.engine, args.approx_quantiles, args.threads, args.stats_kernel,
+        ),
+        args.repeat,
+    )
+    _, stages["table"] = time_stage(
+        lambda: build_roi_table(bundle, stats, "bench", "T1map", "bench.nii.gz", 1.0, True), args.repeat,
+    )
+
+    if args.n_pngs > 0:
+        rng = np.random.default_rng(args.seed)
+        gathered = values.ravel()[np.asarray(bundle.voxel_order)]
+        picks = rng.choice(bundle.roi_ids.size, size=min(args.n_pngs, bundle.roi_ids.size), replace=False)
+
+        def render() -> None:
+            for pos in picks:
+                plot_single_roi_distribution(
+                    values=gathered[bundle.starts[pos]:bundle.ends[pos]],
+                    roi_id=int(bundle.roi_ids[pos]),
+                    roi_name=str(bundle.names[pos]),
+                    hemi=str(bundle.hemis[pos]),
+                    stats=stats.row(int(pos)),
+                    out_png=png_dir / f"roi_{int(bundle.roi_ids[pos])}.png",
+                    modality_label="T1map",
+                    max_points=args.max_points,
+                )
+
+        render()  # warm-up: matplotlib import, font cache, renderer construction
+        _, stages["png"] = time_stage(render, 1)
+        stages["png"]["seconds"] /= max(picks.size, 1)
+
+    return {
+        "resolution_um": resolution_um,
+        "shape": list(labels.shape),
+        "n_labels": n_labels,
+        "n_voxels": int(labels.size),
+        "n_brain_voxels": n_brain,
+        "stages": stages,
+        "mvoxels_per_s": n_brain / max(stages["stats"]["seconds"], 1e-12) / 1e6,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark the ROI stats engine on synthetic atlases.")
+    p.add_argument("--resolutions", type=str, default="100,50",
+                   help="Comma-separated grid resolutions in um (Allen 100 um grid scaled; 25 = ~77 M voxels).")
+    p.add_argument("--n-labels", type=str, default="10,500,5000", help="Comma-separated ROI counts.")
+    p.add_argument("--size-skew", type=float, default=1.5,
+                   help="Sigma of the lognormal ROI sizes (0 = equal sizes).")
+    p.add_argument("--repeat", type=int, default=3, help="Runs per stage (best time kept).")
+    p.add_argument("--n-pngs", type=int, default=10, help="ROI PNGs rendered per case (0 = skip).")
+    p.add_argument("--max-points", type=int, default=5000, help="Same as --roi-max-points of extract_roi_stats.py.")
+    p.add_argument("--engine", choices=list(STATS_ENGINES), default="segment")
+    p.add_argument("--approx-quantiles", type=int, default=0, metavar="BINS")
+    p.add_argument("--threads", type=int, default=1)
+    p.add_argument("--stats-kernel", choices=list(STATS_KERNELS), default="numpy")
+    p.add_argument("--lr-offset", type=int, default=2000)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--outdir", type=str, default="", help="Keep the PNGs here (default: temporary dir, removed).")
+    p.add_argument("--json", type=str, default="", help="Also write the report to this JSON file.")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    resolutions = [float(r) for r in args.resolutions.split(",") if r.strip()]
+    label_counts = [int(n) for n in args.n_labels.split(",") if n.strip()]
+
+    tmp = None
+    if args.outdir:
+        outdir = Path(args.outdir).resolve()
+    else:
+        tmp = tempfile.mkdtemp(prefix="roi_stats_bench_")
+        outdir = Path(tmp)
+
+    cases: List[Dict[str, object]] = []
+    try:
+        for res in resolutions:
+            for n_labels in label_counts:
+                png_dir = outdir / f"res{res:g}_n{n_labels}"
+                png_dir.mkdir(parents=True, exist_ok=True)
+                case = run_case(res, n_labels, args, png_dir)
+                cases.append(case)
+                st = case["stages"]
+                line = " ".join(f"{name}={v['seconds'] * 1e3:.1f}ms/{v['peak_rss_mb']:.0f}MB" for name, v in st.items())
+                print(f"[OK] {res:g}um {n_labels} ROIs ({case['n_brain_voxels']} voxels): {line}")
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "options": {k: v for k, v in vars(args).items() if k not in ("json", "outdir")},
+        "cases": cases,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Consistency checks of create_brain_masks.py against the installed ants / antspynet:
+  - crop      : --crop-n4 box handling (crop_box / paste_box) on a synthetic oblique grid:
+                ones cropped and pasted into zeros change exactly the box, the crop keeps the
+                physical position of its voxels; interior boxes and boxes touching the edges.
+  - extractor : MouseBrainExtractor (copy of antspynet.mouse_brain_extraction, modality "t2")
+                vs antspynet.mouse_brain_extraction on one N4-corrected RARE volume: largest
+                probability difference <= --atol (needs --rare).
+Exits non-zero if a check fails. Run it after any antspynet upgrade.
+
+Example:
+    python check_brain_masks.py --rare /path/to/sub-01_ses-1_RARE.nii.gz
+"""
+
+import argparse
+import sys
+
+import ants
+import numpy as np
+
+from create_brain_masks import MouseBrainExtractor, StepWriter, correct_bias, crop_box, paste_box
+
+CROP_SHAPE = (30, 24, 12)
+CROP_BOXES = (
+    ((5, 4, 2), (20, 18, 9)),    # interior
+    ((0, 0, 0), (12, 10, 12)),   # lower edge, all slices
+    ((18, 3, 0), (30, 24, 12)),  # far edge
+    ((0, 0, 0), CROP_SHAPE),     # whole volume
+)
+
+
+def check_crop() -> bool:
+    angle = np.deg2rad(20.0)
+    direction = np.array([[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+    header = dict(origin=(-4.5, 2.0, 7.25), spacing=(0.1, 0.12, 0.5), direction=direction)
+    zeros = ants.from_numpy(np.zeros(CROP_SHAPE, dtype=np.float32), **header)
+    ramp = ants.from_numpy(np.arange(np.prod(CROP_SHAPE), dtype=np.float32).reshape(CROP_SHAPE), **header)
+
+    ok = True
+    for lower, upper in CROP_BOXES:
+        box = tuple(slice(lo, up) for lo, up in zip(lower, upper))
+        expected = np.zeros(CROP_SHAPE, dtype=bool)
+        expected[box] = True
+
+        region = crop_box(zeros + 1, list(lower), list(upper))
+        changed = paste_box(zeros, region, list(lower), list(upper)).numpy() != 0
+        same_values = np.array_equal(crop_box(ramp, list(lower), list(upper)).numpy(), ramp.numpy()[box])
+        far = [up - 1 for up in upper]
+        same_position = np.allclose(ants.transform_index_to_physical_point(region, [0, 0, 0]),
+                                    ants.transform_index_to_physical_point(zeros, list(lower))) and np.allclose(
+            ants.transform_index_to_physical_point(region, [up - lo - 1 for lo, up in zip(lower, upper)]),
+            ants.transform_index_to_physical_point(zeros, far))
+        box_ok = np.array_equal(changed, expected) and same_values and same_position
+        ok &= box_ok
+        print(f"[{'OK' if box_ok else 'ERROR'}] crop {lower}-{upper}: pasted box exact={np.array_equal(changed, expected)}, "
+              f"values={same_values}, physical position={same_position}")
+    return bool(ok)
+
+
+def check_extractor(rare_path: str, atol: float) -> bool:
+    import antspynet
+
+    image = correct_bias(rare_path, StepWriter("", "", False))
+    ours = MouseBrainExtractor()(image).numpy()
+    reference = antspynet.mouse_brain_extraction(image, modality="t2").numpy()
+    diff = float(np.max(np.abs(ours - reference)))
+    both = np.count_nonzero((ours > 0.5) & (reference > 0.5))
+    dice = 2.0 * both / max(np.count_nonzero(ours > 0.5) + np.count_nonzero(reference > 0.5), 1)
+    ok = diff <= atol
+    print(f"[{'OK' if ok else 'ERROR'}] extractor: max |proba diff| = {diff:.2e} (atol {atol:g}), "
+          f"Dice at 0.5 = {dice:.4f}")
+    return ok
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Check create_brain_masks.py against ants / antspynet.")
+    p.add_argument("--rare", type=str, default="", help="RARE volume for the extractor check (skipped if empty).")
+    p.add_argument("--atol", type=float, default=1e-3, help="Tolerance on the probability maps.")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = [check_crop()]
+    if args.rare:
+        results.append(check_extractor(args.rare, args.atol))
+    else:
+        print("[SKIP] extractor: no --rare volume given")
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
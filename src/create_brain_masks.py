@@ -2,9 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import json
+import hashlib
+import queue
+import threading
+import multiprocessing
 import ants         
-import antspynet
 import argparse
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+# Bias correction passes (shrink factor, convergence); part of the N4 checkpoint key
+N4_PASSES = (
+    (4, {"iters": [20, 20, 10], "tol": 1e-6}),
+    (2, {"iters": [30, 20, 10], "tol": 1e-6}),
+)
+NETWORK_NAME = "mouseT2wBrainExtraction3D"
+STAGES = ("n4", "extract", "threshold")
+CACHE_VERSION = 1
+DEFAULT_EROSION = 6
+# Margin kept around the coarse brain box when N4 runs on the cropped volume (--crop-n4)
+N4_CROP_MARGIN_MM = 1.0
+# Cores kept by the main process of run_pipeline: network inference + writer thread
+PIPELINE_PARENT_CPUS = 2
 
 def _strip_nii_ext(filename: str) -> str:
     if filename.endswith(".nii.gz"):
@@ -14,84 +37,342 @@ def _strip_nii_ext(filename: str) -> str:
     return os.path.splitext(filename)[0]
 
 
-def process_file(input_path: str, derived_output_path: str, brain_out_dir: str,
-                 erosion_radius: int = 6, save_steps: bool = False) -> str:
+class MouseBrainExtractor:
     """
-    Brain extraction pipeline:
-    - N4 bias correction (2 consecutive passes)
-    - Probabilistic brain extraction (antspynet)
-    - Adaptive thresholding (Otsu)
-    - Morphology: erosion + largest component + dilation + FillHoles
+    Probabilistic brain extraction of antspynet.mouse_brain_extraction (modality "t2":
+    3D U-net mouseT2wBrainExtraction3D on the 176^3 B-spline T2w template grid), with the
+    template and the network built and loaded once. Batch runs then pay the model
+    construction and weights loading a single time instead of once per subject.
+    Copy of the "t2" path of antspynet 0.3.2 (pinned in requirements.txt): template resample,
+    centring transform, U-net filters and inverse mapping must follow any antspynet upgrade,
+    checked with check_brain_masks.py --rare <file>. All modes (--input too) use this class.
     """
-    base_name = _strip_nii_ext(os.path.basename(input_path))
+    template_shape = (176, 176, 176)
+
+    def __init__(self):
+        from antspynet.architectures import create_unet_model_3d
+        from antspynet.utilities import get_antsxnet_data, get_pretrained_network
+
+        print(f"[INFO] Loading brain extraction network ({NETWORK_NAME})...")
+        template_mask = ants.image_read(get_antsxnet_data("bsplineT2MouseTemplateBrainMask"))
+        self.reference = ants.resample_image(template_mask, self.template_shape, use_voxels=True, interp_type=1)
+        self.model = create_unet_model_3d((*self.template_shape, 1),
+                                          number_of_outputs=1, mode="sigmoid",
+                                          number_of_filters=(16, 32, 64, 128),
+                                          convolution_kernel_size=(3, 3, 3),
+                                          deconvolution_kernel_size=(2, 2, 2))
+        self.model.load_weights(get_pretrained_network(NETWORK_NAME))
+
+    def to_network_grid(self, image):
+        """
+        Translation centring the image field of view on the template, and the image
+        resampled on the network grid, normalized to [0, 1].
+        """
+        center_reference = np.asarray(ants.get_center_of_mass(self.reference * 0 + 1))
+        center_image = np.asarray(ants.get_center_of_mass(image * 0 + 1))
+        xfrm = ants.create_ants_transform(transform_type="Euler3DTransform", center=center_reference,
+                                          translation=center_image - center_reference)
+        warped = ants.apply_ants_transform_to_image(xfrm, image, self.reference, interpolation="linear")
+        return ants.iMath_normalize(warped), xfrm
+
+    def to_native(self, proba: np.ndarray, xfrm, image):
+        """
+        Network output (template grid) mapped back onto the grid of the input image.
+        """
+        proba_image = ants.from_numpy(proba.astype(np.float32), origin=self.reference.origin,
+                                      spacing=self.reference.spacing, direction=self.reference.direction)
+        return ants.apply_ants_transform_to_image(xfrm.invert(), proba_image, image, interpolation="linear")
+
+    def predict_batch(self, images: list) -> list:
+        """
+        Probability maps of several images (native grids) with a single forward pass:
+        every image is resampled on the network grid, the stack is predicted at once
+        and each output is mapped back onto its own image.
+        """
+        prepared = [self.to_network_grid(image) for image in images]
+        batch = np.stack([warped.numpy() for warped, _ in prepared]).astype(np.float32)[..., np.newaxis]
+        probas = self.model.predict(batch, batch_size=len(images), verbose=0)
+        del batch
+        return [self.to_native(np.squeeze(proba), xfrm, image)
+                for proba, (_, xfrm), image in zip(probas, prepared, images)]
+
+    def __call__(self, image):
+        return self.predict_batch([image])[0]
+
+
+class StepWriter:
+    """
+    Numbered QC outputs of one subject (step/<base>_stepNN_<tag>.nii.gz) when enabled.
+    """
+
+    def __init__(self, output_dir: str, base_name: str, enabled: bool):
+        self.step_dir = os.path.join(output_dir, "step")
+        self.base_name = base_name
+        self.enabled = enabled
+        self.counter = 1
+        if enabled:
+            os.makedirs(self.step_dir, exist_ok=True)
+
+    def write(self, image, tag: str) -> None:
+        if not self.enabled:
+            return
+        ants.image_write(image, os.path.join(self.step_dir, f"{self.base_name}_step{self.counter:02d}_{tag}.nii.gz"))
+        self.counter += 1
+
+    def skip(self, n: int) -> None:
+        # stages taken from a checkpoint keep the numbering of a full run
+        self.counter += n
+
+
+class MaskOptions(NamedTuple):
+    """
+    Thresholding / morphology parameters and checkpoint use of a run.
+    erosion_radii: the first one gives the final mask, the others are written to sweep/.
+    proba_threshold: fixed threshold on the probability map (None = Otsu).
+    from_stage: first stage recomputed (STAGES); earlier ones are read from the checkpoints.
+    use_cache: read / write the checkpoints (StageCache; off by default).
+    crop_n4: N4 restricted to the coarse brain box, masked (correct_bias).
+    """
+    erosion_radii: Tuple[int, ...] = (6,)
+    proba_threshold: Optional[float] = None
+    from_stage: str = "n4"
+    use_cache: bool = False
+    crop_n4: bool = False
+
+
+def _cache_key(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
 
+class StageCache:
+    """
+    Checkpoints of one subject in <output_dir>/cache (--cache): <base>_n4.nii.gz, the
+    N4-corrected image (float32, full volume), and <base>_proba_u8.nii.gz, the probability
+    map (uint8, steps of 1/255). Each is valid only for the key it was
+    written with (input file size/mtime + N4 parameters and crop, then + network), recorded in
+    <base>_cache.json: changing any of them invalidates the checkpoint and what follows it.
+    """
+
+    def __init__(self, output_dir: str, base_name: str, input_path: str, enabled: bool = False,
+                 crop_n4: bool = False):
+        self.enabled = enabled
+        self.cache_dir = os.path.join(output_dir, "cache")
+        self.n4_path = os.path.join(self.cache_dir, f"{base_name}_n4.nii.gz")
+        self.proba_path = os.path.join(self.cache_dir, f"{base_name}_proba_u8.nii.gz")
+        self.meta_path = os.path.join(self.cache_dir, f"{base_name}_cache.json")
+        st = os.stat(input_path)
+        n4_params = {"version": CACHE_VERSION, "n4": N4_PASSES,
+                     "input": [os.path.abspath(input_path), st.st_size, st.st_mtime_ns]}
+        if crop_n4:
+            n4_params["crop_margin_mm"] = N4_CROP_MARGIN_MM
+        self.n4_key = _cache_key(n4_params)
+        self.proba_key = _cache_key({"n4": self.n4_key, "network": NETWORK_NAME})
+
+    def _meta(self) -> dict:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, checkpoint: str, key: str) -> None:
+        meta = self._meta()
+        meta[checkpoint] = key
+        tmp = f"{self.meta_path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.meta_path)
+
+    def _valid(self, checkpoint: str, key: str, path: str) -> bool:
+        return self.enabled and self._meta().get(checkpoint) == key and os.path.exists(path)
+
+    def load_n4(self):
+        if not self._valid("n4", self.n4_key, self.n4_path):
+            return None
+        return ants.image_read(self.n4_path, pixeltype="float")
+
+    def save_n4(self, image) -> None:
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        ants.image_write(image, self.n4_path)
+        self._record("n4", self.n4_key)
+
+    def load_proba(self):
+        """
+        Dequantized probability map, for --from-stage threshold only: full runs threshold the
+        float network output, so a re-threshold with the same parameters may move the voxels
+        lying within 1/510 of the threshold.
+        """
+        if not self._valid("proba", self.proba_key, self.proba_path):
+            return None
+        return ants.image_read(self.proba_path, pixeltype="float") / 255.0
+
+    def save_proba(self, proba_image) -> None:
+        if not self.enabled:
+            return
+        quantized = np.clip(np.rint(proba_image.numpy() * 255.0), 0, 255).astype(np.uint8)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        ants.image_write(ants.from_numpy(quantized, origin=proba_image.origin, spacing=proba_image.spacing,
+                                         direction=proba_image.direction), self.proba_path)
+        self._record("proba", self.proba_key)
+
+
+def brain_box(image, margin_mm: float):
+    """
+    Coarse brain mask (ants.get_mask: threshold at the mean intensity + cleanup) and its
+    bounding box (lower, upper index, upper excluded) grown by margin_mm on each side;
+    None if the mask is empty.
+    """
+    coarse = ants.get_mask(image)
+    nonzero = np.nonzero(coarse.numpy())
+    if nonzero[0].size == 0:
+        return None
+    margin = [int(np.ceil(margin_mm / sp)) for sp in image.spacing]
+    lower = [max(int(idx.min()) - m, 0) for idx, m in zip(nonzero, margin)]
+    upper = [min(int(idx.max()) + 1 + m, n) for idx, m, n in zip(nonzero, margin, image.shape)]
+    return coarse, lower, upper
+
+
+def _box_slices(lower: List[int], upper: List[int]) -> Tuple[slice, ...]:
+    return tuple(slice(lo, up) for lo, up in zip(lower, upper))
+
+
+def crop_box(image, lower: List[int], upper: List[int]):
+    """
+    Sub-volume [lower, upper) of image (0-based, upper excluded) on the same physical grid.
+    Sliced in numpy with the origin moved to voxel lower, so that nothing depends on the
+    index convention of ants.crop_indices (1-based, inclusive C++ helper).
+    """
+    origin = ants.transform_index_to_physical_point(image, [int(lo) for lo in lower])
+    data = np.ascontiguousarray(image.numpy()[_box_slices(lower, upper)])
+    return ants.from_numpy(data, origin=tuple(origin), spacing=image.spacing, direction=image.direction)
+
+
+def paste_box(full, region, lower: List[int], upper: List[int]):
+    """
+    full with region (crop_box of the same box) written back in place.
+    """
+    data = full.numpy().astype(np.float32, copy=True)
+    data[_box_slices(lower, upper)] = region.numpy()
+    return ants.from_numpy(data, origin=full.origin, spacing=full.spacing, direction=full.direction)
+
+
+def correct_bias(input_path: str, steps: StepWriter, crop: bool = False):
+    """
+    Read the RARE image and run the consecutive N4 passes of N4_PASSES.
+    crop: the passes only run on the bounding box of a coarse brain mask (+ N4_CROP_MARGIN_MM),
+    with that mask as N4 weight mask, and the corrected box is pasted back into the full
+    volume (background outside the box left uncorrected).
+    """
     print(f"[INFO] Reading image: {input_path}")
     image = ants.image_read(input_path)
+    steps.write(image, "input")
+
+    full, lower, upper, n4_mask = None, None, None, None
+    if crop:
+        box = brain_box(image, N4_CROP_MARGIN_MM)
+        if box is None:
+            print("[WARN] Empty coarse brain mask: N4 on the full volume.")
+        else:
+            coarse, lower, upper = box
+            full = image
+            image = crop_box(full, lower, upper)
+            n4_mask = crop_box(coarse, lower, upper)
+            print(f"[INFO] N4 restricted to the brain box {tuple(image.shape)} of {tuple(full.shape)}...")
+
+    # 1-2) N4 bias correction (coarse then finer pass)
+    for i, (shrink_factor, convergence) in enumerate(N4_PASSES, start=1):
+        print(f"[INFO] N4 bias field correction (pass {i})...")
+        image = ants.n4_bias_field_correction(image, mask=n4_mask, shrink_factor=shrink_factor,
+                                              convergence=convergence)
+        if full is not None and steps.enabled:
+            steps.write(paste_box(full, image, lower, upper), f"n4_pass{i}")
+        else:
+            steps.write(image, f"n4_pass{i}")
+    return image if full is None else paste_box(full, image, lower, upper)
+
+
+def corrected_image(input_path: str, steps: StepWriter, cache: StageCache, options: MaskOptions):
+    """
+    N4 stage, or its checkpoint when the run starts at a later stage (recomputed, with a
+    warning, if the checkpoint is missing or stale).
+    """
+    if options.from_stage != "n4":
+        image = cache.load_n4()
+        if image is not None:
+            print(f"[INFO] N4 checkpoint: {cache.n4_path}")
+            steps.skip(1 + len(N4_PASSES))
+            return image
+        print(f"[WARN] No valid N4 checkpoint for {steps.base_name}: running N4.")
+    image = correct_bias(input_path, steps, options.crop_n4)
+    cache.save_n4(image)
+    return image
+
+
+def cached_proba(cache: StageCache, options: MaskOptions, base_name: str):
+    """
+    Probability map checkpoint when the run starts at thresholding, else None.
+    """
+    if options.from_stage != "threshold":
+        return None
+    proba_image = cache.load_proba()
+    if proba_image is None:
+        print(f"[WARN] No valid probability checkpoint for {base_name}: running the network.")
+    else:
+        print(f"[INFO] Probability checkpoint: {cache.proba_path}")
+    return proba_image
 
-    output_dir = os.path.dirname(derived_output_path)
-    step_dir = os.path.join(output_dir, "step")
-    step_counter = 1
-    
-    if save_steps:
-        os.makedirs(step_dir, exist_ok=True)
-        ants.image_write(image, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_input.nii.gz"))
-        step_counter += 1
-
-    # 1) N4 bias correction (pass 1)
-    print("[INFO] N4 bias field correction (pass 1)...")
-    image = ants.n4_bias_field_correction(image, shrink_factor=4, convergence={"iters": [20, 20, 10], "tol": 1e-6})
-    if save_steps:
-        ants.image_write(image, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_n4_pass1.nii.gz"))
-        step_counter += 1
-
-    # 2) N4 bias correction (pass 2)
-    print("[INFO] N4 bias field correction (pass 2)...")
-    image = ants.n4_bias_field_correction(image, shrink_factor=2, convergence={"iters": [30, 20, 10], "tol": 1e-6})
-    if save_steps:
-        ants.image_write(image, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_n4_pass2.nii.gz"))
-        step_counter += 1
-
-    # 3) Brain extraction (probability map)
-    print("[INFO] Brain extraction (antspynet)...")
-    proba_image = antspynet.mouse_brain_extraction(image)
-    if save_steps:
-        ants.image_write(proba_image, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_proba.nii.gz"))
-        step_counter += 1
-
-    # 4) Adaptive thresholding (Otsu)
-    print("[INFO] Adaptive thresholding (Otsu)...")
-    mask = ants.threshold_image(proba_image, "Otsu", 1, 0)
-    if save_steps:
-        ants.image_write(mask, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_otsu.nii.gz"))
-        step_counter += 1
 
+def clean_mask(mask, erosion_radius: int, steps: StepWriter):
+    """
+    Morphology: erosion + largest component + dilation + FillHoles.
+    """
     # 5) Morphology: erosion
     print(f"[INFO] Morphology: erosion (radius={erosion_radius})...")
     mask_eroded = ants.iMath(mask, "ME", erosion_radius)
-    if save_steps:
-        ants.image_write(mask_eroded, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_eroded.nii.gz"))
-        step_counter += 1
+    steps.write(mask_eroded, "eroded")
 
     # 6) Keep largest component
     print("[INFO] Keeping largest connected component...")
     mask_component = ants.iMath(mask_eroded, "GetLargestComponent", 10000)
-    if save_steps:
-        ants.image_write(mask_component, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_largest_component.nii.gz"))
-        step_counter += 1
+    steps.write(mask_component, "largest_component")
 
     # 7) Morphology: dilation
     print(f"[INFO] Morphology: dilation (radius={erosion_radius})...")
     mask_dilated = ants.iMath(mask_component, "MD", erosion_radius)
-    if save_steps:
-        ants.image_write(mask_dilated, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_dilated.nii.gz"))
-        step_counter += 1
+    steps.write(mask_dilated, "dilated")
 
     # 8) Fill holes
     print("[INFO] Filling holes...")
     mask_filled = ants.iMath(mask_dilated, "FillHoles", 0.3)
-    if save_steps:
-        ants.image_write(mask_filled, os.path.join(step_dir, f"{base_name}_step{step_counter:02d}_fillholes.nii.gz"))
-        step_counter += 1
+    steps.write(mask_filled, "fillholes")
+    return mask_filled
+
+
+def finalize_mask(image, proba_image, derived_output_path: str, brain_out_dir: str,
+                  options: MaskOptions, steps: StepWriter) -> str:
+    """
+    Probability map -> final mask (thresholding + morphology), then writes the brain-extracted
+    image and the final mask. Extra erosion radii (sweep) only write their mask, to
+    <output_dir>/sweep/<base>_mask_erosion<r>.nii.gz.
+    """
+    base_name = steps.base_name
+    output_dir = os.path.dirname(derived_output_path)
+    steps.write(proba_image, "proba")
+
+    # 4) Thresholding (adaptive Otsu, or a fixed probability)
+    if options.proba_threshold is None:
+        print("[INFO] Adaptive thresholding (Otsu)...")
+        mask = ants.threshold_image(proba_image, "Otsu", 1, 0)
+        steps.write(mask, "otsu")
+    else:
+        print(f"[INFO] Thresholding (probability >= {options.proba_threshold})...")
+        mask = ants.threshold_image(proba_image, options.proba_threshold, 2.0, 1, 0)
+        steps.write(mask, "threshold")
+
+    erosion_radius, *sweep_radii = options.erosion_radii
+    mask_filled = clean_mask(mask, erosion_radius, steps)
 
     # 9) Apply final mask
     print("[INFO] Applying final mask...")
@@ -107,76 +388,193 @@ def process_file(input_path: str, derived_output_path: str, brain_out_dir: str,
     print(f"[OK] Brain extracted: {brain_out_path}")
     print(f"[OK] Final mask saved: {final_mask_path}")
 
+    for radius in sweep_radii:
+        sweep_dir = os.path.join(output_dir, "sweep")
+        os.makedirs(sweep_dir, exist_ok=True)
+        sweep_path = os.path.join(sweep_dir, f"{base_name}_mask_erosion{radius}.nii.gz")
+        ants.image_write(clean_mask(mask, radius, StepWriter(output_dir, base_name, False)), sweep_path)
+        print(f"[OK] Sweep mask saved: {sweep_path}")
+
     return final_mask_path
 
 
-def _is_rare_file(filename: str) -> bool:
-    return filename.endswith("_RARE.nii.gz") or filename.endswith("_RARE.nii")
+def process_file(input_path: str, derived_output_path: str, brain_out_dir: str,
+                 erosion_radius: int = 6, save_steps: bool = False,
+                 extractor: Optional[MouseBrainExtractor] = None,
+                 options: Optional[MaskOptions] = None) -> str:
+    """
+    Brain extraction pipeline:
+    - N4 bias correction (2 consecutive passes)
+    - Probabilistic brain extraction (MouseBrainExtractor; extractor = network already loaded)
+    - Adaptive thresholding (Otsu)
+    - Morphology: erosion + largest component + dilation + FillHoles
+    options: checkpoints, thresholding and erosion sweep (default: no checkpoint, Otsu, erosion_radius).
+    """
+    if options is None:
+        options = MaskOptions(erosion_radii=(erosion_radius,))
+    base_name = _strip_nii_ext(os.path.basename(input_path))
+    output_dir = os.path.dirname(derived_output_path)
+    steps = StepWriter(output_dir, base_name, save_steps)
+    cache = StageCache(output_dir, base_name, input_path, options.use_cache, options.crop_n4)
 
+    image = corrected_image(input_path, steps, cache, options)
 
-def main():
-    parser = argparse.ArgumentParser(description="Brain extraction for RARE.")
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument("-r", "--root", help="Scan recursively (original behavior)")
-    group.add_argument("--input", help="Process a single RARE file")
+    # 3) Brain extraction (probability map)
+    proba_image = cached_proba(cache, options, base_name)
+    if proba_image is None:
+        print("[INFO] Brain extraction (antspynet)...")
+        if extractor is None:
+            extractor = MouseBrainExtractor()
+        proba_image = extractor(image)
+        cache.save_proba(proba_image)
 
-    parser.add_argument("--bids-root", help="BIDS root (required with --input)")
-    parser.add_argument("--out-root", help="Output root (required with --input)")
-    parser.add_argument("--save-steps", action="store_true", help="Write step-by-step QC outputs.")
-    
-    args = parser.parse_args()
+    return finalize_mask(image, proba_image, derived_output_path, brain_out_dir, options, steps)
 
-    # Default morphology parameter (Hardcoded logic removed)
-    DEFAULT_EROSION = 6
 
-    # --- Scan mode ---
-    if args.root:
-        root_dir = os.path.abspath(args.root)
-        derivatives_dir = os.path.join(root_dir, "derivatives")
-        brain_root = os.path.join(derivatives_dir, "Brain_extracted", "RARE")
-        os.makedirs(brain_root, exist_ok=True)
+def _n4_threads(n4_workers: int) -> int:
+    """
+    ITK threads per N4 worker: the cores left once the network and the writer thread of
+    the main process (PIPELINE_PARENT_CPUS) are served, split between the workers.
+    """
+    return max(((os.cpu_count() or 1) - PIPELINE_PARENT_CPUS) // n4_workers, 1)
 
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            dirnames[:] = [d for d in dirnames if d != "derivatives"]
 
-            for filename in filenames:
-                if not _is_rare_file(filename):
-                    continue
+def _init_n4_worker(itk_threads: int) -> None:
+    # read by ITK when its first filter runs in this process
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(itk_threads)
 
-                input_file = os.path.join(dirpath, filename)
-                rel_path = os.path.relpath(dirpath, root_dir)
-                output_dir = os.path.join(derivatives_dir, rel_path)
-                os.makedirs(output_dir, exist_ok=True)
 
-                base_name = _strip_nii_ext(filename)
-                mask_final_path = os.path.join(output_dir, f"{base_name}_mask_final.nii.gz")
-                
-                if os.path.exists(mask_final_path):
-                    continue
+def _bias_task(input_path: str, steps: StepWriter, cache: StageCache, options: MaskOptions):
+    """
+    corrected_image in a worker process; the image goes back as array + header.
+    """
+    image = corrected_image(input_path, steps, cache, options)
+    return steps, image.numpy(), image.origin, image.spacing, image.direction
 
-                derived_output_path = os.path.join(output_dir, f"{base_name}_brain_extracted.nii.gz")
-                print(f"[INFO] Processing: {input_file}")
 
+def run_pipeline(todo: list, options: MaskOptions, batch_size: int, n4_workers: int) -> int:
+    """
+    Staged version of the batch loop, all stages running at once:
+    - n4_workers processes read the upcoming files and run the 2 N4 passes;
+    - this thread gathers the corrected images in input order, by groups of batch_size,
+      and runs the network (loaded once) on each group;
+    - a writer thread thresholds, cleans and writes each subject.
+    At most n4_workers + batch_size files are queued for N4 and batch_size subjects wait
+    for the writer, so memory stays bounded whatever the number of files.
+    Returns the number of failures.
+    """
+    failures = []
+    writes = queue.Queue(maxsize=batch_size)
+
+    def writer() -> None:
+        while True:
+            item = writes.get()
+            if item is None:
+                return
+            input_file, derived_output_path, brain_root, steps, cache, image, proba_image = item
+            try:
+                finalize_mask(image, proba_image, derived_output_path, brain_root, options, steps)
+            except Exception as e:
+                print(f"[ERROR] Failed processing {input_file}: {e}")
+                failures.append(input_file)
+
+    writer_thread = threading.Thread(target=writer, name="mask-writer", daemon=True)
+    writer_thread.start()
+
+    extractor = None
+    group = []
+
+    def flush() -> None:
+        nonlocal extractor
+        print(f"[INFO] Brain extraction (antspynet), batch of {len(group)}...")
+        try:
+            if extractor is None:
+                extractor = MouseBrainExtractor()
+            probas = extractor.predict_batch([item[-1] for item in group])
+        except Exception as e:
+            print(f"[ERROR] Failed brain extraction for {len(group)} file(s): {e}")
+            failures.extend(item[0] for item in group)
+        else:
+            for item, proba_image in zip(group, probas):
+                item[4].save_proba(proba_image)
+                writes.put((*item, proba_image))
+        group.clear()
+
+    itk_threads = _n4_threads(n4_workers)
+    pending = deque()
+    upcoming = iter(todo)
+    try:
+        # spawn: no fork of a process that may already hold TensorFlow threads
+        with ProcessPoolExecutor(max_workers=n4_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_n4_worker, initargs=(itk_threads,)) as pool:
+
+            def submit_next() -> None:
+                for input_file, derived_output_path, brain_root, steps, cache in upcoming:
+                    os.makedirs(os.path.dirname(derived_output_path), exist_ok=True)
+                    print(f"[INFO] Processing: {input_file}")
+                    future = pool.submit(_bias_task, input_file, steps, cache, options)
+                    pending.append(((input_file, derived_output_path, brain_root, cache), future))
+                    return
+
+            for _ in range(n4_workers + batch_size):
+                submit_next()
+            while pending:
+                (input_file, derived_output_path, brain_root, cache), future = pending.popleft()
+                submit_next()
                 try:
-                    process_file(input_file, derived_output_path, brain_root, erosion_radius=DEFAULT_EROSION, save_steps=args.save_steps)
+                    steps, data, origin, spacing, direction = future.result()
                 except Exception as e:
                     print(f"[ERROR] Failed processing {input_file}: {e}")
-        return
+                    failures.append(input_file)
+                else:
+                    image = ants.from_numpy(data, origin=origin, spacing=spacing, direction=direction)
+                    group.append((input_file, derived_output_path, brain_root, steps, cache, image))
+                if len(group) == batch_size or (group and not pending):
+                    flush()
+    finally:
+        writes.put(None)
+        writer_thread.join()
+    return len(failures)
 
-    # --- Single-file mode ---
-    if not args.bids_root or not args.out_root:
-        raise SystemExit("ERROR: --bids-root and --out-root are required with --input")
 
-    bids_root = os.path.abspath(args.bids_root)
-    out_root = os.path.abspath(args.out_root)
-    input_file = os.path.abspath(args.input)
+def _is_rare_file(filename: str) -> bool:
+    return filename.endswith("_RARE.nii.gz") or filename.endswith("_RARE.nii")
 
-    if not os.path.isfile(input_file):
-        raise SystemExit(f"ERROR: input file not found: {input_file}")
 
+def _session_of(input_file: str, bids_root: str) -> str:
+    """
+    ses-* directory of a BIDS file ("ses-1" when the subject has no session level).
+    """
+    rel = os.path.relpath(os.path.dirname(input_file), bids_root)
+    for part in rel.split(os.sep):
+        if part.startswith("ses-"):
+            return part
+    return "ses-1"
+
+
+def find_rare_files(root_dir: str, sessions: Optional[List[str]] = None) -> List[str]:
+    """
+    RARE files under root_dir (recursive, derivatives excluded), sorted, optionally
+    restricted to the given sessions.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if d != "derivatives"]
+        for filename in filenames:
+            if _is_rare_file(filename):
+                found.append(os.path.join(dirpath, filename))
+    if sessions:
+        found = [f for f in found if _session_of(f, root_dir) in sessions]
+    return sorted(found)
+
+
+def mask_output_paths(input_file: str, bids_root: str, out_root: str) -> Tuple[str, str, str, str]:
+    """
+    (output_dir, derived_output_path, brain_root, mask_final_path) of a RARE file: outputs
+    mirror its BIDS sub-*/ses-*/anat path under out_root/derivatives.
+    """
     derivatives_dir = os.path.join(out_root, "derivatives")
     brain_root = os.path.join(derivatives_dir, "Brain_extracted", "RARE")
-    os.makedirs(brain_root, exist_ok=True)
 
     dirpath = os.path.dirname(input_file)
     # Handle cases where input might be outside BIDS root (robustness)
@@ -186,21 +584,177 @@ def main():
         rel_path = os.path.basename(dirpath)
 
     output_dir = os.path.join(derivatives_dir, rel_path)
-    os.makedirs(output_dir, exist_ok=True)
+    base_name = _strip_nii_ext(os.path.basename(input_file))
+    derived_output_path = os.path.join(output_dir, f"{base_name}_brain_extracted.nii.gz")
+    mask_final_path = os.path.join(output_dir, f"{base_name}_mask_final.nii.gz")
+    return output_dir, derived_output_path, brain_root, mask_final_path
+
+
+def run_batch(inputs: List[str], bids_root: str, out_root: str, options: MaskOptions,
+              save_steps: bool, batch_size: int = 4, n4_workers: int = 0) -> int:
+    """
+    Process several RARE files in this process. Existing _mask_final files are skipped,
+    unless the run starts at a later stage (options.from_stage): those redo the masks.
+    Files go by groups of batch_size: N4 for each, one batched network pass for the group
+    (MouseBrainExtractor, loaded once, only if a probability map is not checkpointed), then
+    thresholding, morphology and writing for each. n4_workers > 0 (full runs): same stages
+    overlapped (run_pipeline). A failing file does not stop the batch. Returns the number of failures.
+    """
+    todo = []
+    for input_file in inputs:
+        output_dir, derived_output_path, brain_root, mask_final_path = mask_output_paths(input_file, bids_root, out_root)
+        base_name = _strip_nii_ext(os.path.basename(input_file))
+        if options.from_stage == "n4" and os.path.exists(mask_final_path):
+            print(f"[SKIP] Mask already exists for {base_name}, skipping.")
+            continue
+        todo.append((input_file, derived_output_path, brain_root, StepWriter(output_dir, base_name, save_steps),
+                     StageCache(output_dir, base_name, input_file, options.use_cache, options.crop_n4)))
+
+    batch_size = max(batch_size, 1)
+    if n4_workers > 0 and options.from_stage == "n4" and todo:
+        return run_pipeline(todo, options, batch_size, n4_workers)
+
+    extractor = None
+    n_failed = 0
+    for start in range(0, len(todo), batch_size):
+        ready = []
+        group = []
+        for input_file, derived_output_path, brain_root, steps, cache in todo[start:start + batch_size]:
+            os.makedirs(os.path.dirname(derived_output_path), exist_ok=True)
+            print(f"[INFO] Processing: {input_file}")
+            try:
+                image = corrected_image(input_file, steps, cache, options)
+                proba_image = cached_proba(cache, options, steps.base_name)
+            except Exception as e:
+                print(f"[ERROR] Failed processing {input_file}: {e}")
+                n_failed += 1
+                continue
+            item = (input_file, derived_output_path, brain_root, steps, cache, image)
+            if proba_image is None:
+                group.append(item)
+            else:
+                ready.append((item, proba_image))
+
+        # 3) Brain extraction (probability maps), one forward pass for the group
+        if group:
+            print(f"[INFO] Brain extraction (antspynet), batch of {len(group)}...")
+            try:
+                if extractor is None:
+                    extractor = MouseBrainExtractor()
+                probas = extractor.predict_batch([item[-1] for item in group])
+                for item, proba_image in zip(group, probas):
+                    item[4].save_proba(proba_image)
+                    ready.append((item, proba_image))
+            except Exception as e:
+                print(f"[ERROR] Failed brain extraction for {len(group)} file(s): {e}")
+                n_failed += len(group)
+
+        for (input_file, derived_output_path, brain_root, steps, cache, image), proba_image in ready:
+            try:
+                finalize_mask(image, proba_image, derived_output_path, brain_root, options, steps)
+            except Exception as e:
+                print(f"[ERROR] Failed processing {input_file}: {e}")
+                n_failed += 1
+    return n_failed
+
 
-    filename = os.path.basename(input_file)
-    base_name = _strip_nii_ext(filename)
+def main():
+    parser = argparse.ArgumentParser(description="Brain extraction for RARE.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-r", "--root", help="Scan recursively (original behavior), network loaded once")
+    group.add_argument("--input", help="Process a single RARE file")
+    group.add_argument("--inputs", nargs="+", metavar="RARE",
+                       help="Process several RARE files in one process (network loaded once)")
+
+    parser.add_argument("--bids-root", help="BIDS root (required with --input/--inputs)")
+    parser.add_argument("--out-root", help="Output root (required with --input/--inputs; default with --root: the root)")
+    parser.add_argument("--sessions", default="",
+                        help='Comma-separated sessions to keep with --root/--inputs (e.g. "ses-1,ses-2"; '
+                             'subjects without session level count as ses-1).')
+    parser.add_argument("--save-steps", action="store_true", help="Write step-by-step QC outputs.")
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="Volumes per network forward pass with --root/--inputs (memory ~ 25 MB per volume).")
+    parser.add_argument("--n4-workers", type=int, default=0,
+                        help="With --root/--inputs: processes running N4 on the upcoming files while the network "
+                             "and the writer thread handle the previous ones (0 = one stage at a time).")
+    parser.add_argument("--erosion-radius", default=str(DEFAULT_EROSION),
+                        help="Erosion/dilation radius of the mask cleanup. Several comma-separated radii = sweep: "
+                             "the first gives the final mask, the others are written to sweep/.")
+    parser.add_argument("--proba-threshold", type=float, default=None,
+                        help="Fixed threshold on the probability map (default: Otsu).")
+    parser.add_argument("--from-stage", choices=STAGES, default="n4",
+                        help="First stage recomputed; earlier ones come from the per-subject checkpoints "
+                             "(see --cache, implied). extract/threshold redo existing masks.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Write per-subject checkpoints for later --from-stage runs, next to the masks: "
+                             "cache/<base>_n4.nii.gz (N4 image, float32), cache/<base>_proba_u8.nii.gz "
+                             "(probability map, uint8) and cache/<base>_cache.json.")
+    parser.add_argument("--crop-n4", action="store_true",
+                        help="Run N4 only on the bounding box of a coarse brain mask (+%g mm), masked, "
+                             "and paste the result back (faster on large fields of view)." % N4_CROP_MARGIN_MM)
     
-    mask_final_path = os.path.join(output_dir, f"{base_name}_mask_final.nii.gz")
-    if os.path.exists(mask_final_path):
+    args = parser.parse_args()
+
+    sessions = [s.strip() for s in args.sessions.split(",") if s.strip()]
+    try:
+        erosion_radii = tuple(int(r) for r in args.erosion_radius.split(",") if r.strip())
+    except ValueError:
+        raise SystemExit(f"ERROR: invalid --erosion-radius: {args.erosion_radius}")
+    if not erosion_radii:
+        raise SystemExit("ERROR: --erosion-radius needs at least one radius")
+    options = MaskOptions(erosion_radii=erosion_radii, proba_threshold=args.proba_threshold,
+                          from_stage=args.from_stage, use_cache=args.cache or args.from_stage != "n4", crop_n4=args.crop_n4)
+
+    # --- Scan mode ---
+    if args.root:
+        root_dir = os.path.abspath(args.root)
+        out_root = os.path.abspath(args.out_root) if args.out_root else root_dir
+        inputs = find_rare_files(root_dir, sessions)
+        n_failed = run_batch(inputs, root_dir, out_root, options, args.save_steps, args.batch_size,
+                             args.n4_workers)
+        if n_failed:
+            print(f"[WARN] {n_failed}/{len(inputs)} file(s) failed.")
+        return
+
+    if not args.bids_root or not args.out_root:
+        raise SystemExit("ERROR: --bids-root and --out-root are required with --input/--inputs")
+
+    bids_root = os.path.abspath(args.bids_root)
+    out_root = os.path.abspath(args.out_root)
+
+    # --- Batch mode ---
+    if args.inputs:
+        inputs = [os.path.abspath(f) for f in args.inputs]
+        missing = [f for f in inputs if not os.path.isfile(f)]
+        if missing:
+            raise SystemExit(f"ERROR: input file(s) not found: {', '.join(missing)}")
+        if sessions:
+            inputs = [f for f in inputs if _session_of(f, bids_root) in sessions]
+        n_failed = run_batch(inputs, bids_root, out_root, options, args.save_steps, args.batch_size,
+                             args.n4_workers)
+        if n_failed:
+            sys.exit(f"ERROR: {n_failed}/{len(inputs)} file(s) failed.")
+        return
+
+    # --- Single-file mode ---
+    input_file = os.path.abspath(args.input)
+
+    if not os.path.isfile(input_file):
+        raise SystemExit(f"ERROR: input file not found: {input_file}")
+
+    output_dir, derived_output_path, brain_root, mask_final_path = mask_output_paths(input_file, bids_root, out_root)
+    os.makedirs(brain_root, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    base_name = _strip_nii_ext(os.path.basename(input_file))
+    if options.from_stage == "n4" and os.path.exists(mask_final_path):
         print(f"[SKIP] Mask already exists for {base_name}, skipping.")
         return
 
-    derived_output_path = os.path.join(output_dir, f"{base_name}_brain_extracted.nii.gz")
     print(f"[INFO] Processing: {input_file}")
 
-    process_file(input_file, derived_output_path, brain_root, erosion_radius=DEFAULT_EROSION, save_steps=args.save_steps)
+    process_file(input_file, derived_output_path, brain_root, save_steps=args.save_steps, options=options)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,8 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
@@ -25,16 +32,10 @@ def load_label_table(csv_path: Path) -> Dict[int, str]:
     df = pd.read_csv(csv_path)
     if "id" not in df.columns or "name" not in df.columns:
         raise ValueError(f"Label table must contain columns: id, name. Found: {list(df.columns)}")
-    mapping: Dict[int, str] = {}
-    for _, row in df.iterrows():
-        try:
-            i = int(row["id"])
-        except Exception:
-            continue
-        name = str(row["name"]).strip()
-        if name:
-            mapping[i] = name
-    return mapping
+    ids = pd.to_numeric(df["id"], errors="coerce")
+    names = df["name"].astype(str).str.strip()
+    keep = ids.notna() & (names != "")
+    return dict(zip(ids[keep].astype(np.int64).tolist(), names[keep].tolist()))
 
 
 def label_name_from_id(
@@ -109,12 +110,715 @@ def discover_aligned(out_root: Path, modalities: List[str]) -> List[Tuple[str, s
             found.append((base_name, m, img_path))
     return found
 
-def compute_stats_fast(
+NATIVE_AFFINE_ATOL = 1e-3  # mm: header rounding (qform/sform), far below a voxel
+
+
+def native_subject_id(image_name: str) -> Optional[str]:
+    """
+    sub-XX_ses-YY of a file name (ses-1 when the name has no session), as named by the driver.
+    """
+    m = re.match(r"^(sub-[^_.]+)_(ses-[^_.]+)_", image_name)
+    if m:
+        return f"{m.group(1)}_{m.group(2)}"
+    m = re.match(r"^(sub-[^_.]+)_", image_name)
+    return f"{m.group(1)}_ses-1" if m else None
+
+
+def native_labels_path(out_root: Path, subject: str, modality: str, labels_path: Path) -> Path:
+    """
+    Labels warped onto the native grid of one modality map of a subject by warp_labels_to_native.sh
+    (every map keeps its own acquisition grid).
+    """
+    atlas_id = labels_path.name.split(".nii")[0]
+    native_dir = out_root / "derivatives" / "Brain_extracted" / "RARE" / "native_labels"
+    return native_dir / f"{subject}_{modality}_{atlas_id}_native.nii.gz"
+
+
+def discover_native(out_root: Path, modalities: List[str], labels_path: Path) -> List[Tuple[str, str, Path]]:
+    """
+    OUT_ROOT/derivatives/Brain_extracted/<MOD>/*_brain_extracted.nii.gz (native maps, never resampled)
+    of the subjects whose labels were warped to native space (see native_labels_path).
+    Returns (sub_ses, modality, map_path), sorted by subject.
+    """
+    found: List[Tuple[str, str, Path]] = []
+    for m in modalities:
+        mod_dir = out_root / "derivatives" / "Brain_extracted" / m
+        if not mod_dir.is_dir():
+            continue
+        for img_path in sorted(mod_dir.glob("*_brain_extracted.nii*")):
+            subject = native_subject_id(img_path.name)
+            if subject is None:
+                continue
+            native_labels = native_labels_path(out_root, subject, m, labels_path)
+            if not native_labels.exists():
+                print(f"[WARN] No native labels for {subject} ({native_labels.name}): skipping {img_path.name}")
+                continue
+            img, labels = nib.load(str(img_path)), nib.load(str(native_labels))
+            if img.shape[:3] != labels.shape[:3]:
+                print(f"[WARN] {img_path.name} {img.shape[:3]} is not on the grid of {native_labels.name}: skipping")
+                continue
+            if not np.allclose(img.affine, labels.affine, atol=NATIVE_AFFINE_ATOL):
+                print(f"[WARN] {img_path.name} and {native_labels.name} have different affines: skipping")
+                continue
+            found.append((subject, m, img_path))
+    found.sort(key=lambda item: item[0])  # stable: modality order kept within a subject
+    return found
+
+
+STATS_ENGINES = ("segment", "loop")
+ROBUST_QS = [0.05, 0.25, 0.50, 0.75, 0.95]
+TRIM_FRACTION = 0.10  # cut from each tail for trimmed_mean / winsorized_std (scipy trim_mean convention)
+MODE_BINS = 64        # histogram bins over the Tukey whiskers for the exact mode
+
+
+def _label_value_order(labels: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Permutation sorting voxels by (label, value) with a single argsort.
+    Labels (non-negative) go in the high 32 bits, the float32 value mapped to an
+    order-preserving uint32 in the low 32 bits. Much faster than np.lexsort.
+    """
+    bits = values.astype(np.float32).view(np.uint32).astype(np.uint64)
+    negative = (bits >> np.uint64(31)) != 0
+    bits = np.where(negative, ~bits & np.uint64(0xFFFFFFFF), bits | np.uint64(0x80000000))
+    key = (labels.astype(np.uint64) << np.uint64(32)) | bits
+    return np.argsort(key)
+
+
+def _segment_quantiles(val_s: np.ndarray, starts: np.ndarray, counts: np.ndarray, qs: List[float]) -> np.ndarray:
+    """
+    Linear-interpolated quantiles of every label segment at once.
+    val_s must be sorted by (label, value); starts/counts describe the segments.
+    Returns an array of shape (len(qs), n_segments), same convention as np.quantile(method="linear").
+    """
+    n = counts.astype(np.int64)
+    out = np.empty((len(qs), starts.size), dtype=np.float64)
+    for i, q in enumerate(qs):
+        pos = q * (n - 1).astype(np.float64)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, n - 1)
+        frac = pos - lo
+        a = val_s[starts + lo].astype(np.float64)
+        b = val_s[starts + hi].astype(np.float64)
+        out[i] = a + (b - a) * frac
+    return out
+
+
+def _segment_searchsorted(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    targets: np.ndarray,
+    side: str = "left",
+) -> np.ndarray:
+    """
+    np.searchsorted applied independently inside every sorted segment [starts, ends).
+    Vectorized bisection: the Python loop runs ~log2(largest segment) times, not once per ROI.
+    Returns absolute insertion indices into val_s.
+    """
+    targets = np.asarray(targets).astype(val_s.dtype)
+    lo = starts.astype(np.int64).copy()
+    hi = ends.astype(np.int64).copy()
+    last = max(val_s.size - 1, 0)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        v = val_s[np.minimum(mid, last)]
+        go_right = (v < targets) if side == "left" else (v <= targets)
+        go_right &= active
+        go_left = active & ~go_right
+        lo[go_right] = mid[go_right] + 1
+        hi[go_left] = mid[go_left]
+        active = lo < hi
+    return lo
+
+
+def _segment_pct_within(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+) -> np.ndarray:
+    """
+    Percentage of each sorted segment falling in [low, high] (NaN where the bounds are not finite).
+    """
+    n = (ends - starts).astype(np.float64)
+    ok = np.isfinite(low) & np.isfinite(high)
+    low_f = np.where(ok, low, 0.0)
+    high_f = np.where(ok, high, 0.0)
+    i_lo = _segment_searchsorted(val_s, starts, ends, low_f, side="left")
+    i_hi = _segment_searchsorted(val_s, starts, ends, high_f, side="right")
+    inside = np.maximum(i_hi - i_lo, 0).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = 100.0 * inside / n
+    return np.where(ok, pct, np.nan)
+
+
+def _segment_sums(x: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    Sum of x[lo[i]:hi[i]] for every i (non-empty ranges) with a single reduceat.
+    """
+    idx = np.stack([lo, hi], axis=1).ravel()
+    # odd entries sum the gaps between ranges and are dropped; the appended 0 keeps hi == x.size valid
+    return np.add.reduceat(np.r_[x, 0.0], idx)[::2]
+
+
+def _segment_trimmed_stats(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    center: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Trimmed mean and winsorized (population) std of every sorted segment: the k = int(TRIM_FRACTION * n)
+    lowest and highest values are dropped, resp. replaced by the values of rank k and n - 1 - k.
+    Both reduce to sums of (x - center) and (x - center)^2 over the kept ranks (center = segment
+    median, to keep the squares small).
+    """
+    n = ends - starts
+    k = np.floor(TRIM_FRACTION * n).astype(np.int64)
+    lo = starts + k
+    hi = ends - k
+    d = val_s.astype(np.float64) - np.repeat(center, n)
+    s1 = _segment_sums(d, lo, hi)
+    s2 = _segment_sums(d * d, lo, hi)
+    trimmed = center + s1 / (hi - lo)
+
+    low = d[lo]
+    high = d[hi - 1]
+    nf = n.astype(np.float64)
+    w1 = (s1 + k * (low + high)) / nf
+    w2 = (s2 + k * (low * low + high * high)) / nf
+    return trimmed, np.sqrt(np.maximum(w2 - w1 * w1, 0.0))
+
+
+def _segment_abs_dev_select(
+    val_s: np.ndarray,
+    split: np.ndarray,
+    n_left: np.ndarray,
+    n_right: np.ndarray,
+    center: np.ndarray,
+    k: np.ndarray,
+) -> np.ndarray:
+    """
+    k-th smallest (0-based) |x - center| of every sorted segment. Around split (first value
+    >= center) the deviations form two sorted runs, val_s[split - 1], val_s[split - 2], ... and
+    val_s[split], val_s[split + 1], ...; the k-th of their union is found by a vectorized bisection
+    on the number i of left-run values among the k + 1 smallest (~log2(largest segment) steps).
+    """
+    last = max(val_s.size - 1, 0)
+
+    def left(i: np.ndarray) -> np.ndarray:
+        v = np.abs(center - val_s[np.clip(split - 1 - i, 0, last)])
+        return np.where(i < 0, -np.inf, np.where(i < n_left, v, np.inf))
+
+    def right(j: np.ndarray) -> np.ndarray:
+        v = np.abs(val_s[np.clip(split + j, 0, last)] - center)
+        return np.where(j < 0, -np.inf, np.where(j < n_right, v, np.inf))
+
+    # smallest i in [lo, hi] with right(k - i) <= left(i); true at hi by construction
+    lo = np.maximum(k + 1 - n_right, 0)
+    hi = np.minimum(n_left, k + 1)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        ok = right(k - mid) <= left(mid)
+        go_left = active & ok
+        go_right = active & ~ok
+        hi[go_left] = mid[go_left]
+        lo[go_right] = mid[go_right] + 1
+        active = lo < hi
+    return np.maximum(left(lo - 1), right(k - lo))
+
+
+def _segment_mad(val_s: np.ndarray, starts: np.ndarray, ends: np.ndarray, medians: np.ndarray) -> np.ndarray:
+    """
+    Median absolute deviation median(|x - median|) of every sorted segment (unscaled,
+    np.quantile(method="linear") convention), without re-sorting the deviations.
+    """
+    n = ends - starts
+    split = _segment_searchsorted(val_s, starts, ends, medians, side="left")
+    n_left = split - starts
+    n_right = ends - split
+    pos = 0.5 * (n - 1).astype(np.float64)
+    k_lo = np.floor(pos).astype(np.int64)
+    k_hi = np.minimum(k_lo + 1, n - 1)
+    d_lo = _segment_abs_dev_select(val_s, split, n_left, n_right, medians, k_lo)
+    d_hi = _segment_abs_dev_select(val_s, split, n_left, n_right, medians, k_hi)
+    return d_lo + (d_hi - d_lo) * (pos - k_lo)
+
+
+def _hist_mode(hist: np.ndarray, lo: np.ndarray, width: np.ndarray) -> np.ndarray:
+    """
+    Centre of the fullest bin of each histogram row (first one on ties); NaN for empty rows.
+    """
+    if hist.shape[0] == 0:
+        return np.zeros(0)
+    b = hist.argmax(axis=1)
+    return np.where(hist.max(axis=1) > 0, lo + (b + 0.5) * width, np.nan)
+
+
+def _whisker_range(
+    q25: np.ndarray,
+    q75: np.ndarray,
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tukey whiskers [q1 - 1.5 IQR, q3 + 1.5 IQR] clipped to the data range: the mode histogram
+    ignores edge contamination instead of stretching its bins over it.
+    """
+    iqr = q75 - q25
+    return np.maximum(q25 - 1.5 * iqr, vmin), np.minimum(q75 + 1.5 * iqr, vmax)
+
+
+def _segment_mode(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+) -> np.ndarray:
+    """
+    Mode of every sorted segment from a MODE_BINS-bin histogram over [low, high] (bins
+    [e_j, e_j+1), the last one closed, as np.histogram). Bin counts are differences of
+    per-segment searchsorted positions of the edges: no pass over the voxels.
+    """
+    width = (high - low) / MODE_BINS
+    edges = low[:, None] + np.arange(MODE_BINS)[None, :] * width[:, None]
+    # edges rounded outwards to the value dtype: same bin membership as float64 comparisons
+    edges_v = edges.astype(val_s.dtype)
+    edges_v = np.where(edges_v < edges, np.nextafter(edges_v, np.asarray(np.inf, dtype=val_s.dtype)), edges_v)
+    high_v = high.astype(val_s.dtype)
+    high_v = np.where(high_v > high, np.nextafter(high_v, np.asarray(-np.inf, dtype=val_s.dtype)), high_v)
+    rep_starts = np.repeat(starts, MODE_BINS)
+    rep_ends = np.repeat(ends, MODE_BINS)
+    pos = _segment_searchsorted(val_s, rep_starts, rep_ends, edges_v.ravel(), side="left").reshape(-1, MODE_BINS)
+    stop = _segment_searchsorted(val_s, starts, ends, high_v, side="right")
+    hist = np.diff(np.concatenate([pos, stop[:, None]], axis=1), axis=1)
+    return np.where(width > 0, _hist_mode(hist, low, width), low)
+
+
+def _robust_stats_segments(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    seg_means: np.ndarray,
+    seg_stds: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """
+    Quantiles, "percent within" and robust location/scale metrics for all segments,
+    without any per-ROI Python loop. val_s must be sorted by (label, value).
+    """
+    q05, q25, q50, q75, q95 = _segment_quantiles(val_s, starts, ends - starts, ROBUST_QS)
+    iqr = q75 - q25
+
+    pct1 = _segment_pct_within(val_s, starts, ends, seg_means - seg_stds, seg_means + seg_stds)
+    pctw = _segment_pct_within(val_s, starts, ends, q25 - 1.5 * iqr, q75 + 1.5 * iqr)
+
+    trimmed, wstd = _segment_trimmed_stats(val_s, starts, ends, q50)
+    low, high = _whisker_range(q25, q75, val_s[starts].astype(np.float64), val_s[ends - 1].astype(np.float64))
+
+    return {
+        "p05": q05, "q1": q25, "median": q50, "q3": q75, "p95": q95, "iqr": iqr,
+        "pct_within_1sd": pct1, "pct_within_whiskers": pctw,
+        "trimmed_mean": trimmed, "winsorized_std": wstd,
+        "mad": _segment_mad(val_s, starts, ends, q50),
+        "mode": _segment_mode(val_s, starts, ends, low, high),
+    }
+
+
+def _robust_stats_loop(
+    val_s: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    seg_means: np.ndarray,
+    seg_stds: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """
+    Reference implementation: one _quantiles call and two boolean passes per ROI.
+    val_s only needs to be grouped by label.
+    """
+    keys = [
+        "p05", "q1", "median", "q3", "p95", "iqr", "pct_within_1sd", "pct_within_whiskers",
+        "trimmed_mean", "winsorized_std", "mad", "mode",
+    ]
+    out = {k: np.full(starts.size, np.nan, dtype=np.float64) for k in keys}
+
+    for i, (st, en) in enumerate(zip(starts, ends)):
+        vals_roi = val_s[st:en]
+        if vals_roi.size <= 0:
+            continue
+
+        q05, q25, q50, q75, q95 = _quantiles(vals_roi, ROBUST_QS)
+        iqr = float(q75 - q25)
+        out["p05"][i] = q05
+        out["q1"][i] = q25
+        out["median"][i] = q50
+        out["q3"][i] = q75
+        out["p95"][i] = q95
+        out["iqr"][i] = iqr
+
+        # % within mean ± 1 std
+        m = float(seg_means[i])
+        s = float(seg_stds[i])
+        if np.isfinite(m) and np.isfinite(s):
+            out["pct_within_1sd"][i] = 100.0 * float(np.mean((vals_roi >= m - s) & (vals_roi <= m + s)))
+
+        # % within Tukey boxplot whiskers: [q1 - 1.5*IQR, q3 + 1.5*IQR]
+        if np.isfinite(iqr):
+            loww = float(q25 - 1.5 * iqr)
+            highw = float(q75 + 1.5 * iqr)
+            out["pct_within_whiskers"][i] = 100.0 * float(np.mean((vals_roi >= loww) & (vals_roi <= highw)))
+
+        # trimmed mean / winsorized std: k values cut (resp. clamped) in each tail
+        srt = np.sort(vals_roi).astype(np.float64)
+        k = int(TRIM_FRACTION * srt.size)
+        out["trimmed_mean"][i] = float(np.mean(srt[k:srt.size - k]))
+        out["winsorized_std"][i] = float(np.std(np.clip(srt, srt[k], srt[srt.size - 1 - k])))
+        out["mad"][i] = float(np.median(np.abs(srt - q50)))
+
+        # mode: fullest bin of a histogram over the whiskers (clipped to the data range)
+        low = max(float(q25 - 1.5 * iqr), float(srt[0]))
+        high = min(float(q75 + 1.5 * iqr), float(srt[-1]))
+        if high > low:
+            hist, edges = np.histogram(srt, bins=MODE_BINS, range=(low, high))
+            b = int(np.argmax(hist))
+            out["mode"][i] = 0.5 * (edges[b] + edges[b + 1])
+        else:
+            out["mode"][i] = low
+
+    return out
+
+
+MOMENT_CHUNK = 1 << 20
+
+
+class GroupMoments(NamedTuple):
+    """
+    Per-group count, mean and central moment sums M2, M3, M4 (sum of (x - mean)^k), float64;
+    min/max are None when not computed.
+    """
+    count: np.ndarray
+    mean: np.ndarray
+    m2: np.ndarray
+    m3: np.ndarray
+    m4: np.ndarray
+    vmin: Optional[np.ndarray]
+    vmax: Optional[np.ndarray]
+
+
+def _merge_moments(a: GroupMoments, b: GroupMoments) -> GroupMoments:
+    """
+    Moments of the union of two disjoint sets (Chan et al. / Pebay pairwise update). Only
+    the deviation between the two means enters, never raw sums of powers, so the merge
+    stays accurate for large values and large counts. Empty groups are neutral.
+    """
+    n = a.count + b.count
+    na = a.count.astype(np.float64)
+    nb = b.count.astype(np.float64)
+    nf = np.maximum(n, 1).astype(np.float64)
+    delta = b.mean - a.mean
+    d2 = delta * delta
+    wb = nb / nf
+    m2 = a.m2 + b.m2 + d2 * na * wb
+    m3 = a.m3 + b.m3 + d2 * delta * na * wb * (na - nb) / nf + 3.0 * delta * (na * b.m2 - nb * a.m2) / nf
+    m4 = (
+        a.m4 + b.m4
+        + d2 * d2 * na * wb * (na * na - na * nb + nb * nb) / (nf * nf)
+        + 6.0 * d2 * (na * na * b.m2 + nb * nb * a.m2) / (nf * nf)
+        + 4.0 * delta * (na * b.m3 - nb * a.m3) / nf
+    )
+    minmax = a.vmin is not None and b.vmin is not None
+    return GroupMoments(
+        n, a.mean + delta * wb, m2, m3, m4,
+        np.minimum(a.vmin, b.vmin) if minmax else None,
+        np.maximum(a.vmax, b.vmax) if minmax else None,
+    )
+
+
+def _moment_shape(
+    count: np.ndarray,
+    mean: np.ndarray,
+    m2: np.ndarray,
+    m3: np.ndarray,
+    m4: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Population std, skewness sqrt(n) M3 / M2^1.5 and excess kurtosis n M4 / M2^2 - 3.
+    Skewness and kurtosis are NaN for (numerically) constant groups.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = count.astype(np.float64)
+        std = np.sqrt(np.maximum(m2 / n, 0.0))
+        flat = ~(std > 1e-9 * np.maximum(np.abs(mean), 1e-30))
+        skewness = np.where(flat, np.nan, np.sqrt(n) * m3 / (m2 * np.sqrt(m2)))
+        kurtosis = np.where(flat, np.nan, n * m4 / (m2 * m2) - 3.0)
+    return std, skewness, kurtosis
+
+
+def _chunk_moments(
+    groups: np.ndarray,
+    values: np.ndarray,
+    n_groups: int,
+    sorted_groups: bool,
+    minmax: bool,
+) -> GroupMoments:
+    """
+    Fused moments of one chunk: group means, then central sums of the deviations (two
+    passes over the chunk only, temporaries of chunk size). Sorted groups are contiguous
+    runs: every sum is one reduceat over the run starts. Otherwise sums are bincounts
+    and min/max unbuffered ufunc.at.
+    """
+    v = values.astype(np.float64)
+    count = np.zeros(n_groups, dtype=np.int64)
+    mean = np.zeros(n_groups)
+    m2 = np.zeros(n_groups)
+    m3 = np.zeros(n_groups)
+    m4 = np.zeros(n_groups)
+    vmin = vmax = None
+    if minmax:
+        vmin = np.full(n_groups, np.inf)
+        vmax = np.full(n_groups, -np.inf)
+
+    if sorted_groups:
+        starts = np.r_[0, np.flatnonzero(np.diff(groups)) + 1]
+        ids = groups[starts]
+        run_count = np.diff(np.r_[starts, groups.size])
+        run_mean = np.add.reduceat(v, starts) / run_count
+        dev = v - np.repeat(run_mean, run_count)
+        dev2 = dev * dev
+        count[ids] = run_count
+        mean[ids] = run_mean
+        m2[ids] = np.add.reduceat(dev2, starts)
+        m3[ids] = np.add.reduceat(dev2 * dev, starts)
+        m4[ids] = np.add.reduceat(dev2 * dev2, starts)
+        if minmax:
+            vmin[ids] = np.minimum.reduceat(values, starts)
+            vmax[ids] = np.maximum.reduceat(values, starts)
+    else:
+        count += np.bincount(groups, minlength=n_groups)
+        sums = np.bincount(groups, weights=v, minlength=n_groups)
+        mean = np.where(count > 0, sums / np.maximum(count, 1), 0.0)
+        dev = v - mean[groups]
+        dev2 = dev * dev
+        m2 = np.bincount(groups, weights=dev2, minlength=n_groups)
+        m3 = np.bincount(groups, weights=dev2 * dev, minlength=n_groups)
+        m4 = np.bincount(groups, weights=dev2 * dev2, minlength=n_groups)
+        if minmax:
+            np.minimum.at(vmin, groups, values)
+            np.maximum.at(vmax, groups, values)
+    return GroupMoments(count, mean, m2, m3, m4, vmin, vmax)
+
+
+def _grouped_moments(
+    groups: np.ndarray,
+    values: np.ndarray,
+    n_groups: int,
+    sorted_groups: bool = False,
+    minmax: bool = False,
+    threads: int = 1,
+) -> GroupMoments:
+    """
+    Count, mean, M2, M3, M4 (and min/max) per group in one fused pass per chunk of
+    MOMENT_CHUNK voxels; chunks run on a thread pool (bincount and reduceat release the
+    GIL) and are merged pairwise in a balanced tree (error grows with log(chunks), not
+    with the voxel count), in a fixed order: results do not depend on the number of threads.
+    sorted_groups: groups are non-decreasing (gathered through an atlas bundle).
+    """
+    if values.size == 0:
+        return _chunk_moments(groups, values, n_groups, False, minmax)
+    starts = range(0, values.size, MOMENT_CHUNK)
+
+    def run(start: int) -> GroupMoments:
+        sl = slice(start, start + MOMENT_CHUNK)
+        return _chunk_moments(groups[sl], values[sl], n_groups, sorted_groups, minmax)
+
+    pool = ThreadPoolExecutor(max_workers=min(threads, len(starts))) if threads > 1 and len(starts) > 1 else None
+    try:
+        parts = pool.map(run, starts) if pool is not None else map(run, starts)
+        # binary-counter merge: at most log2(chunks) partial results alive
+        stack: List[Tuple[int, GroupMoments]] = []
+        for part in parts:
+            level = 0
+            while stack and stack[-1][0] == level:
+                part = _merge_moments(stack.pop()[1], part)
+                level += 1
+            stack.append((level, part))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    out = stack.pop()[1]
+    while stack:
+        out = _merge_moments(stack.pop()[1], out)
+    return out
+
+
+def _grouped_stats(
+    groups: np.ndarray,
+    values: np.ndarray,
+    n_groups: int,
+    compute_minmax: bool,
+    engine: str,
+    approx_bins: int = 0,
+    group_lo: Optional[np.ndarray] = None,
+    group_hi: Optional[np.ndarray] = None,
+    sorted_groups: bool = False,
+    threads: int = 1,
+) -> Dict[str, np.ndarray]:
+    """
+    Statistics of (already masked) values grouped by integer ids in [0, n_groups).
+    Returns arrays over the non-empty groups; "group" holds their ids (ascending).
+    approx_bins > 0 replaces the sort by per-group histograms over [group_lo, group_hi]
+    (default: the overall value range), see _histogram_stats.
+    Moments come from _grouped_moments (threads, sorted_groups).
+    """
+    # min/max of the fused pass are only cheap on sorted groups; the sort provides them otherwise
+    moments = _grouped_moments(
+        groups, values, n_groups, sorted_groups, minmax=approx_bins > 0 and sorted_groups, threads=threads,
+    )
+    counts, means = moments.count, moments.mean
+    stds, skewness, kurtosis = _moment_shape(counts, means, moments.m2, moments.m3, moments.m4)
+
+    if approx_bins > 0:
+        if group_lo is None or group_hi is None:
+            group_lo = np.full(n_groups, float(values.min()))
+            group_hi = np.full(n_groups, float(values.max()))
+        present = np.flatnonzero(counts > 0)
+        hist_stats = _histogram_stats(
+            groups, values, n_groups, counts, means, stds, approx_bins, group_lo, group_hi,
+            moments.vmin, moments.vmax,
+        )
+        vmin = hist_stats.pop("min")
+        vmax = hist_stats.pop("max")
+        out = {
+            "group": present, "n_voxels": counts[present], "mean": means[present], "std": stds[present],
+            "skewness": skewness[present], "kurtosis": kurtosis[present],
+        }
+        out.update(hist_stats)
+        if compute_minmax:
+            out["min"] = vmin
+            out["max"] = vmax
+        return out
+
+    # --- group by label (sorted) for robust stats + optional min/max ---
+    if engine == "segment":
+        # values are also sorted inside each label segment
+        order = _label_value_order(groups, values)
+    else:
+        order = np.argsort(groups, kind="mergesort")
+    lab_s = groups[order]
+    val_s = values[order]
+
+    # boundaries per label
+    starts = np.r_[0, np.where(np.diff(lab_s) != 0)[0] + 1]
+    lab_unique = lab_s[starts]
+    ends = np.r_[starts[1:], lab_s.size]
+
+    seg_means = means[lab_unique]
+    seg_stds = stds[lab_unique]
+
+    if engine == "segment":
+        robust = _robust_stats_segments(val_s, starts, ends, seg_means, seg_stds)
+    else:
+        robust = _robust_stats_loop(val_s, starts, ends, seg_means, seg_stds)
+
+    out: Dict[str, np.ndarray] = {
+        "group": lab_unique,
+        "n_voxels": counts[lab_unique],
+        "mean": seg_means,
+        "std": seg_stds,
+        "skewness": skewness[lab_unique],
+        "kurtosis": kurtosis[lab_unique],
+    }
+    out.update(robust)
+
+    # Optional min/max (segment ends when values are sorted, reduceat otherwise)
+    if compute_minmax:
+        if engine == "segment":
+            out["min"] = val_s[starts]
+            out["max"] = val_s[ends - 1]
+        else:
+            out["min"] = np.minimum.reduceat(val_s, starts)
+            out["max"] = np.maximum.reduceat(val_s, starts)
+
+    return out
+
+
+ROI_TABLE_METRICS = (
+    "mean", "std", "min", "max", "p05", "q1", "median", "q3", "p95", "iqr",
+    "pct_within_1sd", "pct_within_whiskers",
+    "trimmed_mean", "winsorized_std", "mad", "mode", "skewness", "kurtosis",
+)
+
+
+class RoiStats(NamedTuple):
+    """
+    Struct-of-arrays ROI statistics aligned on roi_ids: entry i describes ROI roi_ids[i].
+    ROIs without valid voxels have n_voxels 0 and NaN metrics. metrics maps each metric
+    name (mean, std, p05, ..., min/max when computed) to a float64 array.
+    """
+    roi_ids: np.ndarray
+    n_voxels: np.ndarray
+    metrics: Dict[str, np.ndarray]
+
+    @classmethod
+    def from_groups(cls, arrays: Dict[str, np.ndarray], roi_ids: np.ndarray, positions: np.ndarray) -> "RoiStats":
+        """
+        From _grouped_stats-like arrays over the present ROIs, found at positions of roi_ids.
+        """
+        n = int(roi_ids.size)
+        n_voxels = np.zeros(n, dtype=np.int64)
+        n_voxels[positions] = arrays["n_voxels"]
+        metrics: Dict[str, np.ndarray] = {}
+        for key, arr in arrays.items():
+            if key in ("group", "n_voxels"):
+                continue
+            col = np.full(n, np.nan)
+            col[positions] = arr
+            metrics[key] = col
+        return cls(roi_ids=np.asarray(roi_ids), n_voxels=n_voxels, metrics=metrics)
+
+    def row(self, pos: int) -> Dict[str, float]:
+        """
+        Metrics of the ROI at position pos as floats (empty dict if it has no voxel).
+        """
+        if self.n_voxels[pos] == 0:
+            return {}
+        row: Dict[str, float] = {key: float(arr[pos]) for key, arr in self.metrics.items()}
+        row["n_voxels"] = int(self.n_voxels[pos])
+        return row
+
+    def to_dict(self) -> Dict[int, Dict[str, float]]:
+        """
+        {roi_id: {metric: value}} of the ROIs with voxels (layout of compute_stats_fast).
+        """
+        return {int(self.roi_ids[pos]): self.row(pos) for pos in np.flatnonzero(self.n_voxels > 0)}
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame({"roi_id": self.roi_ids, "n_voxels": self.n_voxels})
+        for key, arr in self.metrics.items():
+            df[key] = arr
+        return df
+
+
+def compute_stats_arrays(
     label_data: np.ndarray,
     value_data: np.ndarray,
     include_negative: bool,
     compute_minmax: bool,
-) -> Dict[int, Dict[str, float]]:
+    engine: str = "segment",
+    approx_bins: int = 0,
+    threads: int = 1,
+) -> RoiStats:
+    """
+    Per-label statistics of value_data over label_data, as a RoiStats over the labels
+    having at least one valid voxel (see compute_stats_fast for engine, approx_bins and threads).
+    """
+    if engine not in STATS_ENGINES:
+        raise ValueError(f"Unknown stats engine '{engine}'. Expected one of: {STATS_ENGINES}")
+
     labels = label_data.astype(np.int32).ravel()
     values = value_data.astype(np.float32).ravel()
 
@@ -126,117 +830,1159 @@ def compute_stats_fast(
     values = values[mask]
 
     if labels.size == 0:
-        return {}
+        return RoiStats(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), {})
+
+    arrays = _grouped_stats(
+        labels, values, int(labels.max()) + 1, compute_minmax, engine, approx_bins, threads=threads,
+    )
+    roi_ids = arrays["group"].astype(np.int64)
+    return RoiStats.from_groups(arrays, roi_ids, np.arange(roi_ids.size))
+
+
+def compute_stats_fast(
+    label_data: np.ndarray,
+    value_data: np.ndarray,
+    include_negative: bool,
+    compute_minmax: bool,
+    engine: str = "segment",
+    approx_bins: int = 0,
+    threads: int = 1,
+) -> Dict[int, Dict[str, float]]:
+    """
+    Per-label statistics of value_data over label_data.
+
+    engine:
+      - "segment": sort once by (label, value); quantiles by index arithmetic on the
+        segment boundaries and "percent within" metrics by per-segment searchsorted.
+      - "loop": original per-ROI Python loop (kept as a reference).
+    approx_bins > 0: no sort at all, quantiles, "percent within" and robust metrics are
+    interpolated from per-label histograms of approx_bins bins over the value range
+    (quantile error <= (max - min) / approx_bins). Counts, moments, min, max stay exact.
+    threads: counts and central moments are reduced by chunks on this many threads.
+    """
+    return compute_stats_arrays(
+        label_data, value_data, include_negative, compute_minmax, engine, approx_bins, threads,
+    ).to_dict()
+
+
+def compute_stats_indexed(
+    bundle: "AtlasBundle",
+    value_data: np.ndarray,
+    include_negative: bool,
+    compute_minmax: bool,
+    engine: str = "segment",
+    approx_bins: int = 0,
+    threads: int = 1,
+    kernel: str = "numpy",
+) -> RoiStats:
+    """
+    Same statistics as compute_stats_fast, as a RoiStats aligned on bundle.roi_ids. Reuses
+    the precomputed label index of an atlas bundle: only labelled voxels are gathered
+    (already grouped by label), background is never touched.
+    """
+    return compute_stats_batch(
+        bundle, [value_data], include_negative, compute_minmax, engine, approx_bins, threads, kernel,
+    )[0]
+
+
+def compute_stats_batch(
+    bundle: "AtlasBundle",
+    value_stack: Sequence[np.ndarray],
+    include_negative: bool,
+    compute_minmax: bool,
+    engine: str = "segment",
+    approx_bins: int = 0,
+    threads: int = 1,
+    kernel: str = "numpy",
+) -> List[RoiStats]:
+    """
+    ROI statistics of several co-registered volumes (e.g. all modalities of a group,
+    or all subjects of a modality) in a single grouped pass.
+    Every volume is gathered through the same label index; volume k uses group ids
+    k * n_rois + segment, so one moments/sort/quantile pass covers the whole stack (group ids
+    come out sorted, which the chunked moments reduction uses).
+    With approx_bins > 0 each volume gets its own histogram range (its min/max); with
+    kernel "numba" each volume is then a single compiled pass (accumulate_volume) instead.
+    Returns one RoiStats (aligned on bundle.roi_ids) per volume, in input order.
+    """
+    if engine not in STATS_ENGINES:
+        raise ValueError(f"Unknown stats engine '{engine}'. Expected one of: {STATS_ENGINES}")
+    if kernel not in STATS_KERNELS:
+        raise ValueError(f"Unknown stats kernel '{kernel}'. Expected one of: {STATS_KERNELS}")
+
+    if kernel == "numba" and approx_bins > 0:
+        stats: List[RoiStats] = []
+        for data in value_stack:
+            arrays = accumulate_volume(bundle, data, include_negative, approx_bins, kernel).finalize(compute_minmax)
+            stats.append(RoiStats.from_groups(arrays, bundle.roi_ids, arrays["group"]))
+        return stats
+
+    n_rois = int(bundle.roi_ids.size)
+    voxel_order = np.asarray(bundle.voxel_order)
+    voxel_segment = np.asarray(bundle.voxel_segment, dtype=np.int64)
+
+    values = np.stack([np.asarray(v, dtype=np.float32).ravel()[voxel_order] for v in value_stack])
+    n_volumes = values.shape[0]
+
+    mask = np.isfinite(values)
+    if not include_negative:
+        mask &= (values >= 0)
+
+    group_lo = group_hi = None
+    if approx_bins > 0:
+        with np.errstate(invalid="ignore"):
+            vol_lo = np.where(mask, values, np.inf).min(axis=1)
+            vol_hi = np.where(mask, values, -np.inf).max(axis=1)
+        group_lo = np.repeat(vol_lo, n_rois)
+        group_hi = np.repeat(vol_hi, n_rois)
+
+    groups = (voxel_segment[None, :] + n_rois * np.arange(n_volumes, dtype=np.int64)[:, None])[mask]
+    values = values[mask]
+
+    if values.size == 0:
+        empty = RoiStats.from_groups({"n_voxels": np.zeros(0, dtype=np.int64)}, bundle.roi_ids, np.zeros(0, dtype=np.int64))
+        return [empty for _ in range(n_volumes)]
+
+    arrays = _grouped_stats(
+        groups, values, n_volumes * n_rois, compute_minmax, engine, approx_bins, group_lo, group_hi,
+        sorted_groups=True, threads=threads,
+    )
+    volume = arrays["group"] // n_rois
+    segment = arrays["group"] % n_rois
+
+    # groups are sorted, so each volume is a contiguous slice
+    bounds = np.searchsorted(volume, np.arange(n_volumes + 1))
+    out: List[RoiStats] = []
+    for k in range(n_volumes):
+        sl = slice(bounds[k], bounds[k + 1])
+        out.append(RoiStats.from_groups({key: arr[sl] for key, arr in arrays.items()}, bundle.roi_ids, segment[sl]))
+    return out
 
-    max_label = int(labels.max())
 
-    counts = np.bincount(labels, minlength=max_label + 1).astype(np.int64)
-    sums = np.bincount(labels, weights=values, minlength=max_label + 1).astype(np.float64)
-    sums2 = np.bincount(labels, weights=(values * values), minlength=max_label + 1).astype(np.float64)
+# ---------------------------------------------------------------------------
+# Histogram sketches (approximate quantiles, streaming accumulators)
+# ---------------------------------------------------------------------------
 
+class _RowSearch(NamedTuple):
+    flat: np.ndarray     # row-offset cumulative histogram, globally sorted
+    off: np.ndarray      # offset added to each row
+    n_bins: int
+
+
+def _hist_row_search(cum: np.ndarray) -> _RowSearch:
+    n_rows, n_bins = cum.shape
+    off = np.arange(n_rows, dtype=np.float64) * (float(cum[:, -1].max()) + 1.0) if n_rows else np.zeros(0)
+    return _RowSearch((cum + off[:, None]).ravel(), off, n_bins)
+
+
+def _hist_row_bins(rs: _RowSearch, k: np.ndarray) -> np.ndarray:
+    """
+    Per row r, number of bins whose cumulative count is <= k[r] (i.e. (cum <= k[:, None]).sum(1))
+    with one searchsorted over the row-offset flattened cumulative histogram.
+    """
+    return np.searchsorted(rs.flat, k + rs.off, side="right") - np.arange(rs.off.size) * rs.n_bins
+
+
+def _hist_order_statistic(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    rs: _RowSearch,
+    lo: np.ndarray,
+    width: np.ndarray,
+    k: np.ndarray,
+) -> np.ndarray:
+    """
+    Estimate of the k-th smallest value (0-based) of each histogram row, assuming the
+    values of a bin are evenly spread inside it. Always lies in the bin of the true value.
+    Row r has evenly spaced bins starting at lo[r], of width width[r].
+    """
+    n_rows, n_bins = hist.shape
+    rows = np.arange(n_rows)
+    b = np.minimum(_hist_row_bins(rs, k), n_bins - 1)
+    prev = np.where(b > 0, cum[rows, np.maximum(b - 1, 0)], 0)
+    in_bin = np.maximum(hist[rows, b], 1)
+    frac = np.clip((k - prev + 0.5) / in_bin, 0.0, 1.0)
+    return lo + (b + frac) * width
+
+
+def _hist_quantiles(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    qs: List[float],
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+) -> np.ndarray:
+    """
+    Quantiles of every row of a (n_rows, n_bins) histogram (cum = its row-wise cumsum) with the
+    np.quantile(method="linear") convention: the two neighbouring order statistics are estimated
+    from the histogram (clamped to the exact per-row [vmin, vmax]) and linearly interpolated.
+    As each estimate lies in the bin of the true order statistic, the error is at most one bin width.
+    Returns (len(qs), n_rows); NaN for empty rows.
+    """
+    n = cum[:, -1]
+    rs = _hist_row_search(cum)
+
+    out = np.full((len(qs), hist.shape[0]), np.nan, dtype=np.float64)
+    nonempty = n > 0
+    for i, q in enumerate(qs):
+        rank = q * np.maximum(n - 1, 0).astype(np.float64)
+        k_lo = np.floor(rank)
+        k_hi = np.minimum(k_lo + 1, np.maximum(n - 1, 0))
+        v_lo = np.clip(_hist_order_statistic(hist, cum, rs, lo, width, k_lo), vmin, vmax)
+        v_hi = np.clip(_hist_order_statistic(hist, cum, rs, lo, width, k_hi), vmin, vmax)
+        out[i] = np.where(nonempty, v_lo + (v_hi - v_lo) * (rank - k_lo), np.nan)
+    return out
+
+
+def _hist_cdf(hist: np.ndarray, cum: np.ndarray, lo: np.ndarray, width: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    Interpolated number of values <= x[r] in each histogram row r.
+    """
+    n_rows, n_bins = hist.shape
+    rows = np.arange(n_rows)
+    pos = np.where(np.isfinite(x), (x - lo) / width, 0.0)
+    b = np.clip(np.floor(pos), 0, n_bins - 1).astype(np.int64)
+    prev = np.where(b > 0, cum[rows, np.maximum(b - 1, 0)], 0)
+    frac = np.clip(pos - b, 0.0, 1.0)
+    return prev + frac * hist[rows, b]
+
+
+def _hist_pct_within(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+) -> np.ndarray:
+    """
+    Percentage of each histogram row in [low, high]. Intervals covering the exact
+    [vmin, vmax] of a row count 100%, disjoint ones 0%; partial overlaps are interpolated
+    (error bounded by the counts of the two bins holding low and high).
+    """
+    n = cum[:, -1].astype(np.float64)
+    ok = np.isfinite(low) & np.isfinite(high) & (n > 0)
+    inside = np.maximum(_hist_cdf(hist, cum, lo, width, high) - _hist_cdf(hist, cum, lo, width, low), 0.0)
+    inside = np.where((low <= vmin) & (high >= vmax), n, inside)
+    inside = np.where((high < vmin) | (low > vmax), 0.0, inside)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.minimum(100.0 * inside / n, 100.0)
+    return np.where(ok, pct, np.nan)
+
+
+def _hist_trimmed_stats(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+    center: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Histogram counterpart of _segment_trimmed_stats: each bin contributes the part of its
+    counts whose ranks lie in [k, n - k) at its centre (clipped to [vmin, vmax]); the clamped
+    values of the winsorized std are the estimated order statistics k and n - 1 - k.
+    """
+    n = cum[:, -1].astype(np.float64)
+    k = np.floor(TRIM_FRACTION * n)
+    kept = np.clip(cum, k[:, None], (n - k)[:, None]) - np.clip(cum - hist, k[:, None], (n - k)[:, None])
+    # lo / width: per row, or scalars (shared grid of an accumulator)
+    grid = np.expand_dims(lo, -1) + (np.arange(hist.shape[1]) + 0.5) * np.expand_dims(width, -1)
+    centers = np.clip(grid, vmin[:, None], vmax[:, None])
+    d = centers - center[:, None]
+    s1 = (kept * d).sum(axis=1)
+    s2 = (kept * d * d).sum(axis=1)
+
+    rs = _hist_row_search(cum)
+    low = np.clip(_hist_order_statistic(hist, cum, rs, lo, width, k), vmin, vmax) - center
+    high = np.clip(_hist_order_statistic(hist, cum, rs, lo, width, np.maximum(n - 1 - k, 0)), vmin, vmax) - center
     with np.errstate(divide="ignore", invalid="ignore"):
-        means = sums / counts
-        vars_ = (sums2 / counts) - (means * means)
-        vars_ = np.maximum(vars_, 0.0)
-        stds = np.sqrt(vars_)
+        trimmed = center + s1 / (n - 2 * k)
+        w1 = (s1 + k * (low + high)) / n
+        w2 = (s2 + k * (low * low + high * high)) / n
+    return trimmed, np.sqrt(np.maximum(w2 - w1 * w1, 0.0))
+
+
+def _hist_mad(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    medians: np.ndarray,
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+    steps: int = 40,
+) -> np.ndarray:
+    """
+    Median absolute deviation of each histogram row, with the np.quantile(method="linear")
+    convention of _hist_quantiles: the two neighbouring order statistics k of |x - median|
+    are found by bisection on t until the interpolated counts in [median - t, median + t]
+    reach k + 1/2 (the rank of a value evenly spread in its bin), then interpolated.
+    """
+    n = cum[:, -1].astype(np.float64)
+    rank = 0.5 * np.maximum(n - 1, 0)
+    k_lo = np.floor(rank)
+    k_hi = np.minimum(k_lo + 1, np.maximum(n - 1, 0))
+    span = np.maximum(np.maximum(vmax - medians, medians - vmin), 0.0)
+
+    def order_statistic(k: np.ndarray) -> np.ndarray:
+        t_lo = np.zeros(n.size)
+        t_hi = span.copy()
+        for _ in range(steps):
+            t = 0.5 * (t_lo + t_hi)
+            inside = _hist_cdf(hist, cum, lo, width, medians + t) - _hist_cdf(hist, cum, lo, width, medians - t)
+            below = inside < k + 0.5
+            t_lo = np.where(below, t, t_lo)
+            t_hi = np.where(below, t_hi, t)
+        return t_hi
+
+    d_lo = order_statistic(k_lo)
+    d_hi = order_statistic(k_hi)
+    return np.where(n > 0, d_lo + (d_hi - d_lo) * (rank - k_lo), np.nan)
+
+
+def _hist_whisker_mode(
+    hist: np.ndarray,
+    cum: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+) -> np.ndarray:
+    """
+    Histogram counterpart of _segment_mode: the sketch counts are re-binned (interpolated
+    CDF) into MODE_BINS bins over [low, high] before taking the fullest one, so that both
+    engines estimate the same quantity.
+    """
+    mode_width = (high - low) / MODE_BINS
+    cdf = np.stack(
+        [_hist_cdf(hist, cum, lo, width, low + j * mode_width) for j in range(MODE_BINS + 1)], axis=1,
+    )
+    return np.where(mode_width > 0, _hist_mode(np.diff(cdf, axis=1), low, mode_width), low)
+
+
+def _hist_robust_stats(
+    hist: np.ndarray,
+    lo: np.ndarray,
+    width: np.ndarray,
+    means: np.ndarray,
+    stds: np.ndarray,
+    vmin: np.ndarray,
+    vmax: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """
+    Histogram counterpart of _robust_stats_segments (same keys).
+    """
+    cum = np.cumsum(hist, axis=1)
+    q05, q25, q50, q75, q95 = _hist_quantiles(hist, cum, lo, width, ROBUST_QS, vmin, vmax)
+    iqr = q75 - q25
+    trimmed, wstd = _hist_trimmed_stats(hist, cum, lo, width, vmin, vmax, q50)
+    low, high = _whisker_range(q25, q75, vmin, vmax)
+    return {
+        "p05": q05, "q1": q25, "median": q50, "q3": q75, "p95": q95, "iqr": iqr,
+        "pct_within_1sd": _hist_pct_within(hist, cum, lo, width, means - stds, means + stds, vmin, vmax),
+        "pct_within_whiskers": _hist_pct_within(hist, cum, lo, width, q25 - 1.5 * iqr, q75 + 1.5 * iqr, vmin, vmax),
+        "trimmed_mean": trimmed, "winsorized_std": wstd,
+        "mad": _hist_mad(hist, cum, lo, width, q50, vmin, vmax),
+        "mode": np.clip(_hist_whisker_mode(hist, cum, lo, width, low, high), vmin, vmax),
+    }
+
+
+def _histogram_stats(
+    groups: np.ndarray,
+    values: np.ndarray,
+    n_groups: int,
+    counts: np.ndarray,
+    means: np.ndarray,
+    stds: np.ndarray,
+    n_bins: int,
+    group_lo: np.ndarray,
+    group_hi: np.ndarray,
+    group_min: Optional[np.ndarray] = None,
+    group_max: Optional[np.ndarray] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    O(N) robust stats: one 2-D bincount over (group, value bin), then quantiles and
+    "percent within" metrics from the cumulative histograms. Bins of group g evenly
+    split [group_lo[g], group_hi[g]] (typically the value range of its volume), so the
+    quantile error is at most (group_hi - group_lo) / n_bins.
+    Exact min/max are group_min/group_max when given (fused moments pass), otherwise
+    only the voxels of each group's first/last non-empty bin are revisited.
+    Returns arrays over the non-empty groups (robust keys + "min"/"max").
+    """
+    present = np.flatnonzero(counts > 0)
+    compact = np.full(n_groups, -1, dtype=np.int64)
+    compact[present] = np.arange(present.size)
 
-    # --- group by label (sorted) for robust stats + optional min/max ---
-    order = np.argsort(labels, kind="mergesort")
-    lab_s = labels[order]
-    val_s = values[order]
+    lo = np.asarray(group_lo, dtype=np.float64)[present]
+    width = (np.asarray(group_hi, dtype=np.float64)[present] - lo) / n_bins
+    width = np.where(width > 0, width, 1.0)
 
-    # boundaries per label
-    starts = np.r_[0, np.where(np.diff(lab_s) != 0)[0] + 1]
-    lab_unique = lab_s[starts]
-    ends = np.r_[starts[1:], lab_s.size]
+    row = compact[groups]
+    bins = np.clip(np.floor((values - lo[row]) / width[row]), 0, n_bins - 1).astype(np.int64)
+    hist = np.bincount(row * n_bins + bins, minlength=present.size * n_bins).reshape(present.size, n_bins)
 
-    # Optional min/max via reduceat (fast)
-    min_map: Dict[int, float] = {}
-    max_map: Dict[int, float] = {}
-    if compute_minmax and lab_s.size > 0:
-        mins = np.minimum.reduceat(val_s, starts)
-        maxs = np.maximum.reduceat(val_s, starts)
-        min_map = {int(l): float(v) for l, v in zip(lab_unique, mins)}
-        max_map = {int(l): float(v) for l, v in zip(lab_unique, maxs)}
-
-    # Robust stats maps
-    q1_map: Dict[int, float] = {}
-    med_map: Dict[int, float] = {}
-    q3_map: Dict[int, float] = {}
-    iqr_map: Dict[int, float] = {}
-    p05_map: Dict[int, float] = {}
-    p95_map: Dict[int, float] = {}
-    pct1sd_map: Dict[int, float] = {}
-    pctwhisk_map: Dict[int, float] = {}
-
-    qs = [0.05, 0.25, 0.50, 0.75, 0.95]
-
-    for rid, st, en in zip(lab_unique, starts, ends):
-        rid = int(rid)
-        vals_roi = val_s[st:en]
-        n = vals_roi.size
-        if n <= 0:
-            continue
+    if group_min is not None and group_max is not None:
+        vmin = np.asarray(group_min, dtype=np.float64)[present]
+        vmax = np.asarray(group_max, dtype=np.float64)[present]
+    else:
+        nonzero = hist > 0
+        first = nonzero.argmax(axis=1)
+        last = n_bins - 1 - nonzero[:, ::-1].argmax(axis=1)
+        vmin = np.full(present.size, np.inf)
+        vmax = np.full(present.size, -np.inf)
+        sel = bins == first[row]
+        np.minimum.at(vmin, row[sel], values[sel])
+        sel = bins == last[row]
+        np.maximum.at(vmax, row[sel], values[sel])
+
+    out = _hist_robust_stats(hist, lo, width, means[present], stds[present], vmin, vmax)
+    out["min"] = vmin
+    out["max"] = vmax
+    return out
 
-        q05, q25, q50, q75, q95 = _quantiles(vals_roi, qs)
-        iqr = float(q75 - q25)
 
-        p05_map[rid] = float(q05)
-        q1_map[rid] = float(q25)
-        med_map[rid] = float(q50)
-        q3_map[rid] = float(q75)
-        p95_map[rid] = float(q95)
-        iqr_map[rid] = iqr
+# ---------------------------------------------------------------------------
+# Optional JIT kernels (numba)
+# ---------------------------------------------------------------------------
+STATS_KERNELS = ("numpy", "numba")
+_NO_INDEX = np.empty(0, dtype=np.int64)
+_JIT_KERNELS: Dict[str, object] = {}
 
-        # % within mean ± 1 std
-        m = float(means[rid]) if rid < means.size else np.nan
-        s = float(stds[rid]) if rid < stds.size else np.nan
-        if np.isfinite(m) and np.isfinite(s):
-            low1 = m - s
-            high1 = m + s
-            pct1 = 100.0 * float(np.mean((vals_roi >= low1) & (vals_roi <= high1)))
-        else:
-            pct1 = np.nan
-        pct1sd_map[rid] = pct1
 
-        # % within Tukey boxplot whiskers: [q1 - 1.5*IQR, q3 + 1.5*IQR]
-        if np.isfinite(iqr):
-            loww = float(q25 - 1.5 * iqr)
-            highw = float(q75 + 1.5 * iqr)
-            pctw = 100.0 * float(np.mean((vals_roi >= loww) & (vals_roi <= highw)))
-        else:
-            pctw = np.nan
-        pctwhisk_map[rid] = pctw
-
-    # Build per-label dict
-    stats: Dict[int, Dict[str, float]] = {}
-    for roi_id in np.unique(labels):
-        rid = int(roi_id)
-        n = int(counts[rid]) if rid < counts.size else 0
-        if n <= 0:
+def _import_numba():
+    try:
+        import numba
+    except ImportError as e:
+        raise ImportError("--stats-kernel numba needs numba (pip install numba).") from e
+    return numba
+
+
+def _jit_kernel(fn):
+    """
+    numba-compiled version of a module-level kernel (once per process, cached on disk).
+    """
+    if fn.__name__ not in _JIT_KERNELS:
+        _JIT_KERNELS[fn.__name__] = _import_numba().njit(cache=True, nogil=True)(fn)
+    return _JIT_KERNELS[fn.__name__]
+
+
+def _kernel_value_range(values, index, include_negative):
+    """
+    Min/max of the valid values[index[j]]; (inf, -inf) if there is none.
+    """
+    lo = np.inf
+    hi = -np.inf
+    for j in range(index.size):
+        v = values[index[j]]
+        if not np.isfinite(v) or (v < 0 and not include_negative):
             continue
+        lo = min(lo, v)
+        hi = max(hi, v)
+    return lo, hi
 
-        row: Dict[str, float] = {
-            "n_voxels": n,
-            "mean": float(means[rid]),
-            "std": float(stds[rid]),
-            "p05": float(p05_map.get(rid, np.nan)),
-            "q1": float(q1_map.get(rid, np.nan)),
-            "median": float(med_map.get(rid, np.nan)),
-            "q3": float(q3_map.get(rid, np.nan)),
-            "p95": float(p95_map.get(rid, np.nan)),
-            "iqr": float(iqr_map.get(rid, np.nan)),
-            "pct_within_1sd": float(pct1sd_map.get(rid, np.nan)),
-            "pct_within_whiskers": float(pctwhisk_map.get(rid, np.nan)),
-        }
 
+def _kernel_accumulate(
+    values, segments, index, include_negative, lo, width, count, mean, m2, m3, m4, vmin, vmax, hist,
+):
+    """
+    One pass of per-ROI count, online mean and central moments M2..M4 (Welford / Terriberry),
+    min, max and histogram (even bins of width starting at lo, edge bins catch the rest),
+    updated in place. Voxel j belongs to ROI position segments[j] and has value
+    values[index[j]] (values[j] when index is empty); NaN and, unless include_negative,
+    negative values are skipped. No temporary arrays.
+    """
+    n_bins = hist.shape[1]
+    indirect = index.size > 0
+    for j in range(segments.size):
+        v = values[index[j]] if indirect else values[j]
+        if not np.isfinite(v) or (v < 0 and not include_negative):
+            continue
+        s = segments[j]
+        x = np.float64(v)
+        n1 = np.float64(count[s])
+        n = n1 + 1.0
+        count[s] += 1
+        delta = x - mean[s]
+        delta_n = delta / n
+        delta_n2 = delta_n * delta_n
+        term = delta * delta_n * n1
+        mean[s] += delta_n
+        m4[s] += term * delta_n2 * (n * n - 3.0 * n + 3.0) + 6.0 * delta_n2 * m2[s] - 4.0 * delta_n * m3[s]
+        m3[s] += term * delta_n * (n - 2.0) - 3.0 * delta_n * m2[s]
+        m2[s] += term
+        if x < vmin[s]:
+            vmin[s] = x
+        if x > vmax[s]:
+            vmax[s] = x
+        b = min(max(np.floor((x - lo) / width), 0.0), n_bins - 1.0)
+        hist[s, int(b)] += 1
+
+
+class RoiAccumulator:
+    """
+    Mergeable per-ROI sufficient statistics: count, mean, central moments M2..M4 (pairwise
+    merges, see _merge_moments), min, max and a histogram with n_bins even bins over
+    [lo, hi] (quantile sketch; values outside go to the edge bins). Two accumulators can be merged when they share the same number
+    of ROIs and histogram grid (slabs, files or workers).
+    """
+
+    def __init__(self, n_rois: int, lo: float, hi: float, n_bins: int):
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.n_bins = int(n_bins)
+        self.count = np.zeros(n_rois, dtype=np.int64)
+        self.mean = np.zeros(n_rois, dtype=np.float64)
+        self.m2 = np.zeros(n_rois, dtype=np.float64)
+        self.m3 = np.zeros(n_rois, dtype=np.float64)
+        self.m4 = np.zeros(n_rois, dtype=np.float64)
+        self.vmin = np.full(n_rois, np.inf, dtype=np.float64)
+        self.vmax = np.full(n_rois, -np.inf, dtype=np.float64)
+        self.hist = np.zeros((n_rois, self.n_bins), dtype=np.int64)
+
+    @property
+    def n_rois(self) -> int:
+        return self.count.size
+
+    @property
+    def width(self) -> float:
+        return (self.hi - self.lo) / self.n_bins
+
+    def moments(self) -> GroupMoments:
+        return GroupMoments(self.count, self.mean, self.m2, self.m3, self.m4, None, None)
+
+    def _absorb(self, other: GroupMoments) -> None:
+        # pairwise update, exact for any split of the data
+        merged = _merge_moments(self.moments(), other)
+        self.count, self.mean, self.m2, self.m3, self.m4 = merged.count, merged.mean, merged.m2, merged.m3, merged.m4
+
+    def update(self, segments: np.ndarray, values: np.ndarray, kernel: str = "numpy") -> None:
+        """
+        Add voxels (segment position in [0, n_rois), float value). Values must be finite.
+        kernel "numba": single compiled pass (online moments) instead of the NumPy reductions.
+        """
+        if values.size == 0:
+            return
+        if kernel == "numba":
+            _jit_kernel(_kernel_accumulate)(
+                values, segments, _NO_INDEX, True, self.lo, self.width,
+                self.count, self.mean, self.m2, self.m3, self.m4, self.vmin, self.vmax, self.hist,
+            )
+            return
+        self._absorb(_grouped_moments(segments, values, self.n_rois))
+        values = values.astype(np.float64)
+
+        order = np.argsort(segments, kind="stable")
+        seg_s = segments[order]
+        val_s = values[order]
+        starts = np.r_[0, np.where(np.diff(seg_s) != 0)[0] + 1]
+        present = seg_s[starts]
+        self.vmin[present] = np.minimum(self.vmin[present], np.minimum.reduceat(val_s, starts))
+        self.vmax[present] = np.maximum(self.vmax[present], np.maximum.reduceat(val_s, starts))
+
+        bins = np.clip(np.floor((values - self.lo) / self.width), 0, self.n_bins - 1).astype(np.int64)
+        self.hist += np.bincount(
+            segments.astype(np.int64) * self.n_bins + bins, minlength=self.n_rois * self.n_bins
+        ).reshape(self.n_rois, self.n_bins)
+
+    def merge(self, other: "RoiAccumulator") -> "RoiAccumulator":
+        if other.n_rois != self.n_rois or (other.lo, other.hi, other.n_bins) != (self.lo, self.hi, self.n_bins):
+            raise ValueError("Cannot merge accumulators with different ROIs or histogram grids.")
+        self._absorb(other.moments())
+        self.vmin = np.minimum(self.vmin, other.vmin)
+        self.vmax = np.maximum(self.vmax, other.vmax)
+        self.hist += other.hist
+        return self
+
+    def finalize(self, compute_minmax: bool) -> Dict[str, np.ndarray]:
+        """
+        Same layout as _grouped_stats: arrays over non-empty ROIs, "group" = ROI positions.
+        """
+        present = np.flatnonzero(self.count > 0)
+        count = self.count[present]
+        means = self.mean[present]
+        stds, skewness, kurtosis = _moment_shape(
+            count, means, self.m2[present], self.m3[present], self.m4[present],
+        )
+        vmin = self.vmin[present]
+        vmax = self.vmax[present]
+
+        out: Dict[str, np.ndarray] = {
+            "group": present, "n_voxels": count, "mean": means, "std": stds,
+            "skewness": skewness, "kurtosis": kurtosis,
+        }
+        out.update(_hist_robust_stats(self.hist[present], self.lo, self.width, means, stds, vmin, vmax))
         if compute_minmax:
-            row["min"] = float(min_map.get(rid, np.nan))
-            row["max"] = float(max_map.get(rid, np.nan))
+            out["min"] = vmin
+            out["max"] = vmax
+        return out
+
+
+# ---------------------------------------------------------------------------
+# Compiled atlas bundle
+# ---------------------------------------------------------------------------
+
+ATLAS_BUNDLE_VERSION = 1
+ATLAS_BUNDLE_ARRAYS = (
+    "labels", "voxel_order", "voxel_segment", "roi_ids", "starts", "ends", "base_ids", "hemis", "names",
+)
+
+
+class AtlasBundle(NamedTuple):
+    """
+    Label volume + precomputed label index. Arrays are memory-mapped when loaded from disk.
+    Segment i (ROI roi_ids[i]) is voxel_order[starts[i]:ends[i]] (flat C-order voxel indices).
+    """
+    key: str
+    shape: Tuple[int, ...]
+    labels: np.ndarray          # compact dtype label volume
+    voxel_order: np.ndarray     # flat indices of labelled voxels, grouped by ascending label
+    voxel_segment: np.ndarray   # segment position of each entry of voxel_order
+    roi_ids: np.ndarray         # label id per segment (background excluded)
+    starts: np.ndarray
+    ends: np.ndarray
+    base_ids: np.ndarray        # label id without the L/R offset
+    hemis: np.ndarray           # "L" / "R"
+    names: np.ndarray           # ROI name with hemisphere suffix
+
+
+def _compact_label_dtype(min_label: int, max_label: int) -> np.dtype:
+    if min_label >= 0:
+        for dt in (np.uint8, np.uint16, np.uint32):
+            if max_label <= np.iinfo(dt).max:
+                return np.dtype(dt)
+    return np.dtype(np.int32)
+
+
+def load_label_volume(labels_path: Path) -> np.ndarray:
+    """
+    Read an integer label NIfTI without going through float64 get_fdata().
+    """
+    return _as_label_array(np.asanyarray(nib.load(str(labels_path)).dataobj))
+
+
+def _as_label_array(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data)
+    if data.dtype.kind == "f":
+        data = data.astype(np.int32)
+    if data.size == 0:
+        return data
+    return data.astype(_compact_label_dtype(int(data.min()), int(data.max())), copy=False)
+
+
+def _hash_file(h: "hashlib._Hash", path: Path) -> None:
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+
+def atlas_bundle_key(
+    labels_path: Path,
+    table_path: Optional[Path],
+    lr_offset: int,
+    right_suffix: str,
+    left_suffix: str,
+) -> str:
+    h = hashlib.sha256()
+    h.update(f"v{ATLAS_BUNDLE_VERSION}|{lr_offset}|{right_suffix}|{left_suffix}|".encode())
+    _hash_file(h, labels_path)
+    if table_path is not None and table_path.exists():
+        h.update(b"|table|")
+        _hash_file(h, table_path)
+    return h.hexdigest()
+
+
+def build_atlas_bundle(
+    labels_path: Path,
+    table_path: Optional[Path],
+    lr_offset: int,
+    right_suffix: str,
+    left_suffix: str,
+    key: str = "",
+) -> AtlasBundle:
+    id_to_name: Dict[int, str] = {}
+    if table_path is not None and table_path.exists():
+        id_to_name = load_label_table(table_path)
+    return index_label_volume(load_label_volume(labels_path), id_to_name, lr_offset, right_suffix, left_suffix, key)
+
+
+def index_label_volume(
+    labels: np.ndarray,
+    id_to_name: Dict[int, str],
+    lr_offset: int,
+    right_suffix: str,
+    left_suffix: str,
+    key: str = "",
+) -> AtlasBundle:
+    """
+    In-memory AtlasBundle of an integer label volume (label index, ROI names and hemispheres).
+    """
+    labels = _as_label_array(labels)
+    flat = labels.ravel()
+    brain = np.flatnonzero(flat)
+    order = np.argsort(flat[brain], kind="stable")
+    voxel_order = brain[order]
+    lab_s = flat[voxel_order]
+
+    if lab_s.size:
+        starts = np.r_[0, np.where(np.diff(lab_s) != 0)[0] + 1]
+    else:
+        starts = np.zeros(0, dtype=np.int64)
+    ends = np.r_[starts[1:], lab_s.size].astype(np.int64)
+    roi_ids = lab_s[starts].astype(np.int64)
+    voxel_segment = np.repeat(np.arange(roi_ids.size, dtype=np.int32), ends - starts)
+
+    named = [label_name_from_id(int(r), id_to_name, lr_offset, right_suffix, left_suffix) for r in roi_ids]
+
+    return AtlasBundle(
+        key=key,
+        shape=tuple(int(d) for d in labels.shape),
+        labels=labels,
+        voxel_order=voxel_order.astype(np.int64 if flat.size > np.iinfo(np.int32).max else np.int32),
+        voxel_segment=voxel_segment,
+        roi_ids=roi_ids,
+        starts=starts.astype(np.int64),
+        ends=ends,
+        base_ids=np.array([b for b, _, _ in named], dtype=np.int64),
+        hemis=np.array([h for _, h, _ in named], dtype="<U1"),
+        names=np.array([n for _, _, n in named], dtype=str),
+    )
+
+
+def save_atlas_bundle(bundle: AtlasBundle, bundle_dir: Path) -> Path:
+    """
+    Write one .npy per array + meta.json. Written to a temporary directory then renamed,
+    so concurrent runs never see a partial bundle.
+    """
+    bundle_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = bundle_dir.parent / f".{bundle_dir.name}.tmp{os.getpid()}"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    for name in ATLAS_BUNDLE_ARRAYS:
+        np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(getattr(bundle, name)))
+    meta = {"version": ATLAS_BUNDLE_VERSION, "key": bundle.key, "shape": list(bundle.shape)}
+    (tmp_dir / "meta.json").write_text(json.dumps(meta, indent=2))
+
+    try:
+        tmp_dir.rename(bundle_dir)
+    except OSError:
+        # another process compiled the same bundle first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return bundle_dir
+
+
+def load_atlas_bundle(bundle_dir: Path) -> AtlasBundle:
+    meta = json.loads((bundle_dir / "meta.json").read_text())
+    if meta.get("version") != ATLAS_BUNDLE_VERSION:
+        raise ValueError(f"Atlas bundle version mismatch in {bundle_dir}: {meta.get('version')}")
+    arrays = {name: np.load(bundle_dir / f"{name}.npy", mmap_mode="r") for name in ATLAS_BUNDLE_ARRAYS}
+    return AtlasBundle(key=meta["key"], shape=tuple(meta["shape"]), **arrays)
+
+
+def get_atlas_bundle(
+    labels_path: Path,
+    table_path: Optional[Path],
+    cache_dir: Optional[Path],
+    lr_offset: int,
+    right_suffix: str,
+    left_suffix: str,
+) -> AtlasBundle:
+    """
+    Load the compiled bundle for this atlas/table/options from cache_dir, compiling it on first use.
+    cache_dir=None builds the index in memory only.
+    """
+    key = atlas_bundle_key(labels_path, table_path, lr_offset, right_suffix, left_suffix)
+    if cache_dir is None:
+        return build_atlas_bundle(labels_path, table_path, lr_offset, right_suffix, left_suffix, key=key)
+
+    bundle_dir = cache_dir / f"atlas_{key[:16]}"
+    if not (bundle_dir / "meta.json").exists():
+        print(f"[INFO] Compiling atlas bundle: {labels_path.name} -> {bundle_dir}")
+        bundle = build_atlas_bundle(labels_path, table_path, lr_offset, right_suffix, left_suffix, key=key)
+        save_atlas_bundle(bundle, bundle_dir)
+    return load_atlas_bundle(bundle_dir)
+
+
+class NativeAtlases:
+    """
+    Atlas bundles of --input-type native: one per subject and modality, from the labels warped
+    to the native grid of that map (native_labels_path). They are compiled to the atlas cache
+    like the template atlas; the bundle (and hierarchy plan) of the last map is kept in
+    memory. Picklable: process-pool workers get a copy.
+    """
+
+    def __init__(
+        self,
+        out_root: Path,
+        labels_path: Path,
+        table_path: Optional[Path],
+        cache_dir: Optional[Path],
+        lr_offset: int,
+        right_suffix: str,
+        left_suffix: str,
+        hierarchy: Optional[pd.DataFrame] = None,
+        hierarchy_match: str = "acronym",
+    ):
+        self.out_root = out_root
+        self.labels_path = labels_path
+        self.table_path = table_path
+        self.cache_dir = cache_dir
+        self.options = (lr_offset, right_suffix, left_suffix)
+        self.hierarchy = hierarchy
+        self.hierarchy_match = hierarchy_match
+        self.keys: Dict[str, str] = {}
+        self._current: Optional[Tuple[Tuple[str, str], AtlasBundle, Optional["HierarchyPlan"]]] = None
+
+    def __getstate__(self) -> Dict[str, object]:
+        state = self.__dict__.copy()
+        state["_current"] = None
+        return state
+
+    def subject_labels(self, subject: str, modality: str) -> Path:
+        return native_labels_path(self.out_root, subject, modality, self.labels_path)
+
+    def key(self, subject: str, modality: str) -> str:
+        labels = self.subject_labels(subject, modality)
+        if labels.name not in self.keys:
+            self.keys[labels.name] = atlas_bundle_key(labels, self.table_path, *self.options)
+        return self.keys[labels.name]
+
+    def get(self, subject: str, modality: str) -> Tuple[AtlasBundle, Optional["HierarchyPlan"]]:
+        if self._current is None or self._current[0] != (subject, modality):
+            labels = self.subject_labels(subject, modality)
+            bundle = get_atlas_bundle(labels, self.table_path, self.cache_dir, *self.options)
+            plan = None
+            if self.hierarchy is not None:
+                id_to_name = load_label_table(self.table_path) if self.table_path and self.table_path.exists() else {}
+                plan = build_hierarchy_plan(bundle, self.hierarchy, id_to_name, self.hierarchy_match)
+            self._current = ((subject, modality), bundle, plan)
+        return self._current[1], self._current[2]
+
+
+# ---------------------------------------------------------------------------
+# Streaming statistics (mergeable per-ROI sketches)
+# ---------------------------------------------------------------------------
+
+def iter_image_slabs(
+    bundle: AtlasBundle,
+    image_path: Path,
+    slab: int,
+    include_negative: bool,
+):
+    """
+    Yields (segment positions, float32 values) of labelled, valid voxels, z-slab by z-slab.
+    The image is read through its nibabel array proxy and the labels through the
+    (memory-mapped) bundle, so only one slab of each is in memory at a time.
+    """
+    img = nib.load(str(image_path))
+    if tuple(img.shape) != bundle.shape:
+        raise ValueError(f"Shape mismatch labels {bundle.shape} vs template {img.shape}: {image_path}")
+
+    roi_ids = np.asarray(bundle.roi_ids)
+    nz = bundle.shape[-1]
+    for z0 in range(0, nz, max(slab, 1)):
+        z1 = min(z0 + max(slab, 1), nz)
+        labels = np.asarray(bundle.labels[..., z0:z1]).ravel()
+        values = np.asarray(img.dataobj[..., z0:z1], dtype=np.float32).ravel()
+
+        keep = labels != 0
+        keep &= np.isfinite(values)
+        if not include_negative:
+            keep &= (values >= 0)
+        labels = labels[keep]
+        values = values[keep]
+        if values.size == 0:
+            continue
+        yield np.searchsorted(roi_ids, labels).astype(np.int64), values
+
+
+def image_value_range(bundle: AtlasBundle, image_path: Path, slab: int, include_negative: bool) -> Tuple[float, float]:
+    """
+    Min/max of the labelled valid voxels (first streaming pass when no --stream-range is given).
+    """
+    lo, hi = np.inf, -np.inf
+    for _, values in iter_image_slabs(bundle, image_path, slab, include_negative):
+        lo = min(lo, float(values.min()))
+        hi = max(hi, float(values.max()))
+    if not np.isfinite(lo):
+        return 0.0, 1.0
+    if hi <= lo:
+        hi = lo + 1.0
+    return lo, hi
+
+
+def accumulate_image(
+    bundle: AtlasBundle,
+    image_path: Path,
+    slab: int,
+    n_bins: int,
+    include_negative: bool,
+    value_range: Optional[Tuple[float, float]] = None,
+    kernel: str = "numpy",
+) -> RoiAccumulator:
+    """
+    Streams one image in z-slabs into a RoiAccumulator (peak memory ~ one slab + n_rois * n_bins).
+    value_range fixes the histogram edges (needed to merge accumulators of different images);
+    otherwise it is taken from a first min/max pass over the image.
+    """
+    if value_range is None:
+        value_range = image_value_range(bundle, image_path, slab, include_negative)
+    acc = RoiAccumulator(int(bundle.roi_ids.size), value_range[0], value_range[1], n_bins)
+    for segments, values in iter_image_slabs(bundle, image_path, slab, include_negative):
+        acc.update(segments, values, kernel)
+    return acc
+
+
+def compute_stats_streaming(
+    bundle: AtlasBundle,
+    image_path: Path,
+    include_negative: bool,
+    compute_minmax: bool,
+    slab: int = 8,
+    n_bins: int = 2048,
+    value_range: Optional[Tuple[float, float]] = None,
+    kernel: str = "numpy",
+) -> RoiStats:
+    """
+    Out-of-core counterpart of compute_stats_indexed. Counts, mean, std, min and max are exact;
+    quantiles and "percent within" metrics come from the histogram sketch (error <= one bin width).
+    """
+    acc = accumulate_image(bundle, image_path, slab, n_bins, include_negative, value_range, kernel)
+    arrays = acc.finalize(compute_minmax)
+    return RoiStats.from_groups(arrays, bundle.roi_ids, arrays["group"])
+
+
+# ---------------------------------------------------------------------------
+# Ontology roll-up (parent structures from merged leaf sufficient statistics)
+# ---------------------------------------------------------------------------
+HIERARCHY_MATCH = ("acronym", "id")
+HIERARCHY_HEMIS = ("L", "R", "B")  # B = both hemispheres
+
+
+def load_structure_hierarchy(path: Path) -> pd.DataFrame:
+    """
+    Allen structure hierarchy as a table (id, parent_id, acronym, name; parent_id = -1 for roots), from
+    - an Allen structure graph JSON (nested 'children', optionally wrapped in {'msg': [...]}), or
+    - a CSV/TSV with columns id and parent_structure_id (or parent_id, or structure_id_path
+      like '/997/8/567/'), optionally acronym and name.
+    Rows keep the file order (Allen graph order), which is also the order of the output tables.
+    """
+    if path.suffix.lower() == ".json":
+        with path.open() as f:
+            doc = json.load(f)
+        if isinstance(doc, dict):
+            doc = doc.get("msg", [doc])
+        rows: List[Tuple[int, int, str, str]] = []
+        stack = [(node, -1) for node in reversed(doc)]
+        while stack:
+            node, parent_id = stack.pop()
+            node_id = int(node["id"])
+            rows.append((node_id, parent_id, str(node.get("acronym", "")), str(node.get("name", ""))))
+            stack.extend((child, node_id) for child in reversed(node.get("children") or []))
+        return pd.DataFrame(rows, columns=["id", "parent_id", "acronym", "name"])
+
+    df = pd.read_csv(path, sep="\t" if path.suffix.lower() == ".tsv" else ",")
+    if "id" not in df.columns:
+        raise ValueError(f"Hierarchy table must contain column: id. Found: {list(df.columns)}")
+    if "parent_structure_id" in df.columns:
+        parents = pd.to_numeric(df["parent_structure_id"], errors="coerce")
+    elif "parent_id" in df.columns:
+        parents = pd.to_numeric(df["parent_id"], errors="coerce")
+    elif "structure_id_path" in df.columns:
+        # '/997/8/567/' -> 8 is the parent of 567
+        parents = pd.to_numeric(
+            df["structure_id_path"].astype(str).str.strip("/").str.split("/").str[-2], errors="coerce",
+        )
+    else:
+        raise ValueError(
+            "Hierarchy table needs one of the columns parent_structure_id, parent_id, structure_id_path. "
+            f"Found: {list(df.columns)}"
+        )
+    ids = pd.to_numeric(df["id"], errors="coerce")
+    keep = ids.notna()
+    return pd.DataFrame({
+        "id": ids[keep].astype(np.int64).to_numpy(),
+        "parent_id": parents[keep].fillna(-1).astype(np.int64).to_numpy(),
+        "acronym": df["acronym"][keep].astype(str).str.strip().to_numpy() if "acronym" in df.columns else "",
+        "name": df["name"][keep].astype(str).str.strip().to_numpy() if "name" in df.columns else "",
+    })
+
+
+class HierarchyPlan(NamedTuple):
+    """
+    Output rows of the roll-up, one per (structure, hemisphere) containing at least one
+    atlas ROI, and a sparse 0/1 membership matrix (n_rows, n_rois) of the atlas ROIs
+    (bundle segments) under each row. Built once per run; rolling up an image is then a
+    few sparse products over per-ROI statistics, independent of the number of voxels.
+    """
+    node_ids: np.ndarray
+    acronyms: np.ndarray
+    names: np.ndarray
+    depths: np.ndarray
+    hemis: np.ndarray
+    membership: object  # scipy.sparse.csr_matrix
+
+
+def build_hierarchy_plan(
+    bundle: AtlasBundle,
+    hierarchy: pd.DataFrame,
+    id_to_name: Dict[int, str],
+    match: str = "acronym",
+) -> HierarchyPlan:
+    """
+    Atlas ROIs are attached to hierarchy nodes by their label-table name (match='acronym',
+    for atlases with their own label ids such as 100_AMBA_LR) or by base id (match='id',
+    for atlases labelled with Allen structure ids). Every ROI then counts for its node and
+    all ancestors, in its own hemisphere and in 'B' (both hemispheres).
+    """
+    from scipy import sparse
+
+    if match not in HIERARCHY_MATCH:
+        raise ValueError(f"Unknown hierarchy match '{match}'. Expected one of: {HIERARCHY_MATCH}")
+
+    node_ids = hierarchy["id"].tolist()
+    parent = {n: p for n, p in zip(node_ids, hierarchy["parent_id"].tolist()) if p >= 0}
+    rank = {n: i for i, n in enumerate(node_ids)}
+    if match == "acronym":
+        node_of = dict(zip(hierarchy["acronym"].tolist(), node_ids))
+        keys = [id_to_name.get(b) for b in bundle.base_ids.tolist()]
+    else:
+        node_of = {n: n for n in node_ids}
+        keys = bundle.base_ids.tolist()
+
+    members: Dict[Tuple[int, str], List[int]] = {}
+    depth: Dict[int, int] = {}
+    unmatched = 0
+    for pos, (key, hemi) in enumerate(zip(keys, bundle.hemis.tolist())):
+        node = node_of.get(key)
+        if node is None:
+            unmatched += 1
+            continue
+        chain: List[int] = []
+        while node is not None and node not in chain:  # guard against cycles
+            chain.append(node)
+            node = parent.get(node)
+        for k, node in enumerate(chain):
+            depth[node] = len(chain) - 1 - k
+            members.setdefault((node, hemi), []).append(pos)
+            members.setdefault((node, "B"), []).append(pos)
+    if unmatched:
+        print(f"[WARN] {unmatched}/{bundle.roi_ids.size} atlas ROIs not found in the hierarchy (match={match}).")
+
+    row_keys = sorted(members, key=lambda nh: (rank[nh[0]], HIERARCHY_HEMIS.index(nh[1])))
+    cols = [members[k] for k in row_keys]
+    lengths = np.array([len(c) for c in cols], dtype=np.int64)
+    membership = sparse.csr_matrix(
+        (
+            np.ones(int(lengths.sum()), dtype=np.int64),
+            np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64),
+            np.r_[0, np.cumsum(lengths)],
+        ),
+        shape=(len(row_keys), int(bundle.roi_ids.size)),
+    )
+
+    info = hierarchy.set_index("id")
+    row_nodes = [n for n, _ in row_keys]
+    return HierarchyPlan(
+        node_ids=np.array(row_nodes, dtype=np.int64),
+        acronyms=info.loc[row_nodes, "acronym"].to_numpy(dtype=str),
+        names=info.loc[row_nodes, "name"].to_numpy(dtype=str),
+        depths=np.array([depth[n] for n in row_nodes], dtype=np.int64),
+        hemis=np.array([h for _, h in row_keys], dtype="<U1"),
+        membership=membership,
+    )
+
+
+def rollup_accumulator(acc: RoiAccumulator, plan: HierarchyPlan) -> RoiAccumulator:
+    """
+    Accumulator of the plan rows, merging the leaf (atlas ROI) accumulator bottom-up:
+    counts and histograms add up, min/max reduce, and the central moments follow the
+    multi-way merge around the row mean (d_i = mean_i - mean):
+      M2 = sum(M2_i + n_i d_i^2), M3 = sum(M3_i + 3 d_i M2_i + n_i d_i^3),
+      M4 = sum(M4_i + 4 d_i M3_i + 6 d_i^2 M2_i + n_i d_i^4),
+    exact in one step for any number of children.
+    """
+    m = plan.membership
+    out = RoiAccumulator(m.shape[0], acc.lo, acc.hi, acc.n_bins)
+    if m.nnz == 0:
+        return out
+
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    leaves = m.indices
+    out.count = m @ acc.count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out.mean = np.where(out.count > 0, (m @ (acc.count * acc.mean)) / np.maximum(out.count, 1), 0.0)
+    d = acc.mean[leaves] - out.mean[rows]
+    n = acc.count[leaves]
+    m2 = acc.m2[leaves]
+    m3 = acc.m3[leaves]
+    n_rows = m.shape[0]
+    out.m2 = m @ acc.m2 + np.bincount(rows, weights=n * d ** 2, minlength=n_rows)
+    out.m3 = m @ acc.m3 + np.bincount(rows, weights=3.0 * d * m2 + n * d ** 3, minlength=n_rows)
+    out.m4 = m @ acc.m4 + np.bincount(
+        rows, weights=4.0 * d * m3 + 6.0 * d ** 2 * m2 + n * d ** 4, minlength=n_rows,
+    )
+    # every row has at least one leaf, so the reduceat segments are never empty
+    out.vmin = np.minimum.reduceat(acc.vmin[leaves], m.indptr[:-1])
+    out.vmax = np.maximum.reduceat(acc.vmax[leaves], m.indptr[:-1])
+    out.hist = np.asarray(m @ acc.hist, dtype=np.int64)
+    return out
+
+
+def accumulate_volume(
+    bundle: AtlasBundle,
+    data: np.ndarray,
+    include_negative: bool,
+    n_bins: int,
+    kernel: str = "numpy",
+) -> RoiAccumulator:
+    """
+    Accumulator of an in-memory volume, histogram over its value range. The numba kernel
+    reads the volume in place through the label index (no gathered copy, mask or sort).
+    """
+    voxel_order = np.asarray(bundle.voxel_order)
+    voxel_segment = np.asarray(bundle.voxel_segment)
+    if kernel == "numba":
+        flat = np.asarray(data, dtype=np.float32).ravel()
+        lo, hi = _jit_kernel(_kernel_value_range)(flat, voxel_order, include_negative)
+        lo, hi = (float(lo), float(hi)) if np.isfinite(lo) else (0.0, 1.0)
+        acc = RoiAccumulator(int(bundle.roi_ids.size), lo, hi if hi > lo else lo + 1.0, n_bins)
+        _jit_kernel(_kernel_accumulate)(
+            flat, voxel_segment, voxel_order, include_negative, acc.lo, acc.width,
+            acc.count, acc.mean, acc.m2, acc.m3, acc.m4, acc.vmin, acc.vmax, acc.hist,
+        )
+        return acc
+
+    values = np.asarray(data, dtype=np.float32).ravel()[voxel_order]
+    mask = np.isfinite(values)
+    if not include_negative:
+        mask &= (values >= 0)
+    values = values[mask]
+    lo, hi = (float(values.min()), float(values.max())) if values.size else (0.0, 1.0)
+    acc = RoiAccumulator(int(bundle.roi_ids.size), lo, hi if hi > lo else lo + 1.0, n_bins)
+    acc.update(voxel_segment.astype(np.int64)[mask], values)
+    return acc
 
-        stats[rid] = row
 
-    return stats
+def accumulate_volumes(
+    bundle: AtlasBundle,
+    value_stack: Sequence[np.ndarray],
+    include_negative: bool,
+    n_bins: int,
+    kernel: str = "numpy",
+) -> List[RoiAccumulator]:
+    """
+    Leaf accumulators of in-memory volumes (histogram over each volume's value range),
+    for the roll-up. Streaming mode gets them for free from accumulate_image.
+    """
+    return [accumulate_volume(bundle, data, include_negative, n_bins, kernel) for data in value_stack]
 
 
 def parse_roi_ids(arg: str) -> Optional[List[int]]:
@@ -260,14 +2006,167 @@ def parse_roi_ids(arg: str) -> Optional[List[int]]:
     return out
 
 
+def parse_value_range(arg: str) -> Optional[Tuple[float, float]]:
+    """
+    --stream-range "LO,HI" => (LO, HI); "" => None (per-image min/max pass).
+    """
+    s = (arg or "").strip()
+    if not s:
+        return None
+    lo, hi = (float(tok) for tok in s.split(","))
+    if not hi > lo:
+        raise ValueError(f"Invalid value range '{arg}': expected LO,HI with HI > LO")
+    return lo, hi
+
+
+def _round_table(df: pd.DataFrame, digits: int = 2) -> pd.DataFrame:
+    """
+    Text tables are rounded to 2 decimals (columnar stores keep full precision).
+    """
+    df = df.copy()
+    num_cols = df.select_dtypes(include=[np.number]).columns
+    df[num_cols] = df[num_cols].round(digits)
+    return df
+
+
 def write_group_modality_table(df: pd.DataFrame, outdir: Path, group: str, modality: str, as_csv: bool) -> Path:
     outdir.mkdir(parents=True, exist_ok=True)
     ext = "csv" if as_csv else "tsv"
     sep = "," if as_csv else "\t"
     out_path = outdir / f"{group}_{modality}_roi_stats.{ext}"
-    df.to_csv(out_path, sep=sep, index=False)
+    _round_table(df).to_csv(out_path, sep=sep, index=False)
+    return out_path
+
+def write_long_table(
+    df: pd.DataFrame,
+    outdir: Path,
+    key: str,
+    input_type: str,
+    as_csv: bool,
+    append: bool,
+    merge: bool = False,
+) -> Path:
+    """
+    Combined long-format table of a batch: <key>_<input_type>_roi_stats_long.<ext>
+    append=True adds the rows of further batches of the same group/modality.
+    merge=True (incremental runs) keeps the rows of an existing table, except those
+    of the (Group, Modality) pairs in df, which are replaced.
+    """
+    outdir.mkdir(parents=True, exist_ok=True)
+    ext = "csv" if as_csv else "tsv"
+    sep = "," if as_csv else "\t"
+    out_path = outdir / f"{key}_{input_type}_roi_stats_long.{ext}"
+    df = _round_table(df)
+    if merge and not append and out_path.exists():
+        old = pd.read_csv(out_path, sep=sep, dtype={"Group": str, "Modality": str})
+        replaced = pd.MultiIndex.from_frame(df[["Group", "Modality"]].astype(str).drop_duplicates())
+        keep = ~pd.MultiIndex.from_frame(old[["Group", "Modality"]]).isin(replaced)
+        df = pd.concat([old[keep], df], ignore_index=True)
+    df.to_csv(out_path, sep=sep, index=False, mode="a" if append else "w", header=not append)
+    return out_path
+
+def write_hierarchy_table(df: pd.DataFrame, outdir: Path, group: str, modality: str, as_csv: bool) -> Path:
+    outdir.mkdir(parents=True, exist_ok=True)
+    ext = "csv" if as_csv else "tsv"
+    sep = "," if as_csv else "\t"
+    out_path = outdir / f"{group}_{modality}_roi_stats_hierarchy.{ext}"
+    _round_table(df).to_csv(out_path, sep=sep, index=False)
+    return out_path
+
+
+# ---------------------------------------------------------------------------
+# Columnar store (Parquet / Arrow IPC, optional pyarrow)
+# ---------------------------------------------------------------------------
+COLUMNAR_FORMATS = ("parquet", "feather")
+COLUMNAR_PARTITIONS = ("input_type", "Group", "Modality")
+COLUMNAR_ROI_COLUMN = {"roi_stats": "ROI_id", "roi_hierarchy": "structure_id"}
+_COLUMNAR_CATEGORIES = ("TemplateFile", "Hemisphere", "ROI_name", "acronym", "structure_name")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The columnar ROI stats store needs pyarrow (pip install pyarrow).") from e
+    return pyarrow
+
+
+def write_columnar_table(
+    df: pd.DataFrame,
+    root: Path,
+    dataset: str,
+    input_type: str,
+    group: str,
+    modality: str,
+    fmt: str,
+) -> Path:
+    """
+    One image's rows (full precision) as the partition
+    <root>/<dataset>/input_type=<t>/Group=<g>/Modality=<m>/part-0.<parquet|feather>.
+    Partition columns are stored in the path only (hive layout); repeated strings are dictionary-encoded.
+    """
+    pa = _import_pyarrow()
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown columnar format '{fmt}'. Expected one of: {COLUMNAR_FORMATS}")
+
+    part_dir = root / dataset / f"input_type={input_type}" / f"Group={group}" / f"Modality={modality}"
+    part_dir.mkdir(parents=True, exist_ok=True)
+    df = df.drop(columns=[c for c in COLUMNAR_PARTITIONS if c in df.columns])
+    for col in _COLUMNAR_CATEGORIES:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    out_path = part_dir / f"part-0.{fmt}"
+    tmp = part_dir / f".part-0.{fmt}.tmp{os.getpid()}"
+    if fmt == "parquet":
+        pa.parquet.write_table(table, tmp, compression="zstd")
+    else:
+        pa.feather.write_feather(table, tmp, compression="zstd")
+    os.replace(tmp, out_path)
     return out_path
 
+
+def load_roi_stats(
+    root: Path,
+    columns: Optional[Sequence[str]] = None,
+    roi_ids: Optional[Sequence[int]] = None,
+    groups: Optional[Sequence[str]] = None,
+    modalities: Optional[Sequence[str]] = None,
+    input_type: Optional[str] = None,
+    dataset: str = "roi_stats",
+) -> pd.DataFrame:
+    """
+    Read a columnar ROI stats store written with --columnar (dataset 'roi_stats', or
+    'roi_hierarchy' with roi_ids matched against structure_id). Only the requested columns
+    are read; group/modality/input type filters skip whole partitions and roi_ids is pushed
+    down to the files (Parquet row-group statistics).
+    """
+    pa = _import_pyarrow()
+    ds = pa.dataset
+
+    base = Path(root) / dataset
+    first = next(base.rglob("part-0.*"), None)
+    if first is None:
+        raise FileNotFoundError(f"No columnar ROI stats found under: {base}")
+    partitioning = ds.partitioning(
+        pa.schema([(name, pa.string()) for name in COLUMNAR_PARTITIONS]), flavor="hive",
+    )
+    data = ds.dataset(base, format="parquet" if first.suffix == ".parquet" else "feather", partitioning=partitioning)
+
+    expr = None
+    for name, wanted in (("Group", groups), ("Modality", modalities),
+                         ("input_type", [input_type] if input_type else None),
+                         (COLUMNAR_ROI_COLUMN.get(dataset, "ROI_id"), roi_ids)):
+        if wanted is not None:
+            cond = ds.field(name).isin(list(wanted))
+            expr = cond if expr is None else expr & cond
+    return data.to_table(columns=list(columns) if columns else None, filter=expr).to_pandas()
+
+
 def plot_single_roi_distribution(
     values: np.ndarray,
     roi_id: int,
@@ -277,10 +2176,17 @@ def plot_single_roi_distribution(
     out_png: Path,
     modality_label: str,
     max_points: int,
+    reuse_figure: bool = True,
 ) -> None:
     """
     One PNG per ROI: boxplot + jittered sampled voxels + mean + ±1 SD + stats box + legend.
+    By default the figure of this process' RoiFigureRenderer is reused; reuse_figure=False
+    builds (and closes) a fresh matplotlib figure for this ROI.
     """
+    if reuse_figure:
+        roi_figure_renderer().render(values, roi_id, roi_name, hemi, stats, out_png, modality_label, max_points)
+        return
+
     import matplotlib
     matplotlib.use("Agg")
     import matplotlib.pyplot as plt
@@ -386,18 +2292,1002 @@ def plot_single_roi_distribution(
     plt.close(fig)
 
 
+class RoiAxes:
+    """
+    Artists of one ROI distribution plot (boxplot, jittered sampled voxels, mean and ±1 SD
+    lines, stats box) created once in an axes; update() only changes their data. Used by
+    RoiFigureRenderer (one large axes) and RoiSheetRenderer (one cell per ROI).
+    """
+
+    X0 = 1.0
+
+    def __init__(self, ax, compact: bool = False):
+        self.ax = ax
+        self.compact = compact
+        lw = 1.0 if compact else 1.6
+
+        # template boxplot (q1=1, q3=3): box vertices on q3 are the "top" ones
+        bp = ax.boxplot(
+            [np.arange(5.0)],
+            positions=[self.X0],
+            widths=0.35,
+            patch_artist=True,
+            showfliers=False,
+            medianprops=dict(linewidth=1.0 if compact else 1.2, color="black"),
+            boxprops=dict(facecolor='lightcoral', color='black', alpha=0.6),
+        )
+        self.box = bp["boxes"][0]
+        self.box.set_alpha(0.35)
+        self.box_top = self.box.get_path().vertices[:, 1] == 3.0
+        self.whiskers = bp["whiskers"]
+        self.caps = bp["caps"]
+        self.median = bp["medians"][0]
+
+        if compact:
+            self.points = ax.scatter([], [], s=3, alpha=0.25, color="black", linewidths=0)
+        else:
+            self.points = ax.scatter([], [], s=10, alpha=0.25, color="black")
+        self.mean_line = ax.axhline(0.0, linestyle="--", linewidth=lw, color="black")
+        self.sd_lines = [ax.axhline(0.0, linestyle=":", linewidth=lw, color="black") for _ in range(2)]
+
+        if compact:
+            ax.set_xticks([])
+            ax.tick_params(axis="y", labelsize=7)
+        else:
+            ax.set_xticks([self.X0])
+        ax.grid(True, linestyle="--", alpha=0.35)
+        self.text = ax.text(
+            0.98, 0.98, "",
+            transform=ax.transAxes,
+            ha="right", va="top",
+            fontsize=6 if compact else 10,
+            bbox=dict(boxstyle="round", alpha=0.25),
+        )
+
+    def update(
+        self,
+        values: np.ndarray,
+        roi_id: int,
+        roi_name: str,
+        hemi: str,
+        stats: Dict[str, float],
+        max_points: int,
+    ) -> Optional[Tuple[float, float]]:
+        """
+        Shows one ROI; returns the y limits, or None (nothing drawn) if it has no finite value.
+        """
+        from matplotlib.cbook import boxplot_stats
+
+        vals = values.astype(np.float32)
+        vals = vals[np.isfinite(vals)]
+        if vals.size == 0:
+            return None
+
+        # downsample points for display (but stats stay from full ROI)
+        sampled = vals
+        if max_points > 0 and vals.size > max_points:
+            rng = np.random.default_rng(0)
+            sampled = rng.choice(vals, size=max_points, replace=False)
+
+        mean = float(stats.get("mean", np.nan))
+        std = float(stats.get("std", np.nan))
+        vmin = float(stats.get("min", np.nan))
+        vmax = float(stats.get("max", np.nan))
+        nvox = int(stats.get("n_voxels", vals.size))
+
+        bs = boxplot_stats(vals, whis=1.5)[0]
+        path = self.box.get_path()
+        path.vertices[:, 1] = np.where(self.box_top, bs["q3"], bs["q1"])
+        self.box.set_path(path)
+        self.whiskers[0].set_ydata([bs["q1"], bs["whislo"]])
+        self.whiskers[1].set_ydata([bs["q3"], bs["whishi"]])
+        self.caps[0].set_ydata([bs["whislo"], bs["whislo"]])
+        self.caps[1].set_ydata([bs["whishi"], bs["whishi"]])
+        self.median.set_ydata([bs["med"], bs["med"]])
+
+        rng = np.random.default_rng(1)
+        jitter = (rng.random(sampled.size) - 0.5) * 0.10  # +/- 0.05
+        self.points.set_offsets(np.column_stack([np.full(sampled.size, self.X0) + jitter, sampled]))
+
+        has_mean = np.isfinite(mean)
+        has_sd = has_mean and np.isfinite(std)
+        self.mean_line.set_visible(has_mean)
+        if has_mean:
+            self.mean_line.set_ydata([mean, mean])
+        for line, y in zip(self.sd_lines, (mean + std, mean - std)):
+            line.set_visible(has_sd)
+            if has_sd:
+                line.set_ydata([y, y])
+
+        # y limits as autoscaling would set them (5% margins around all artists)
+        ys = [float(sampled.min()), float(sampled.max()), bs["whislo"], bs["whishi"]]
+        if has_mean:
+            ys.append(mean)
+        if has_sd:
+            ys += [mean - std, mean + std]
+        lo, hi = min(ys), max(ys)
+        pad = 0.05 * (hi - lo) if hi > lo else max(abs(lo) * 0.05, 0.5)
+        self.ax.set_ylim(lo - pad, hi + pad)
+
+        if self.compact:
+            self.ax.set_title(f"{roi_name} ({hemi}) (ID={roi_id})", fontsize=8)
+            self.text.set_text(f"n={nvox}\nmean={mean:.5g}\nstd={std:.5g}")
+        else:
+            self.ax.set_title(f"{roi_name} ({hemi}) (ID={roi_id})")
+            self.ax.set_xticklabels([str(roi_id)], rotation=25)
+            self.text.set_text(
+                f"n_voxels: {nvox}\n"
+                f"mean: {mean:.6g}\n"
+                f"std:  {std:.6g}\n"
+                f"min:  {vmin:.6g}\n"
+                f"max:  {vmax:.6g}\n"
+            )
+        return lo, hi
+
+
+def _roi_legend_handles(compact: bool) -> list:
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+
+    lw = 1.0 if compact else 1.6
+    return [
+        Patch(alpha=0.35, label="Boxplot", facecolor="lightcoral", edgecolor="black"),
+        Line2D([0], [0], linestyle="--", linewidth=lw, label="Mean", color="black"),
+        Line2D([0], [0], linestyle=":", linewidth=lw, label="±1 SD", color="black"),
+        Line2D([0], [0], marker="o", linestyle="none", markersize=4 if compact else 7, alpha=0.25,
+               label="Sampled voxels", color="black"),
+        Line2D([0], [0], marker="_", linewidth=lw,  label="Median", color="black"),
+    ]
+
+
+class RoiFigureRenderer:
+    """
+    Per-ROI figure built once (axes, RoiAxes artists, legend); render() only updates the
+    artists' data for each ROI and saves. Same drawing as the per-figure path of
+    plot_single_roi_distribution. The layout is recomputed only when the y label or the
+    magnitude of the y axis changes (tick label widths).
+    """
+
+    DPI = 160
+
+    def __init__(self):
+        import matplotlib
+        matplotlib.use("Agg")
+        from matplotlib.figure import Figure
+
+        self.fig = Figure(figsize=(5.5, 7.5))
+        self.roi_axes = RoiAxes(self.fig.add_subplot())
+        self.roi_axes.ax.legend(
+            handles=_roi_legend_handles(compact=False), loc="lower center", bbox_to_anchor=(0.5, -0.12), ncol=2,
+        )
+        self._layout_key: Optional[Tuple[str, int]] = None
+
+    def render(
+        self,
+        values: np.ndarray,
+        roi_id: int,
+        roi_name: str,
+        hemi: str,
+        stats: Dict[str, float],
+        out_png: Path,
+        modality_label: str,
+        max_points: int,
+    ) -> None:
+        from matplotlib.layout_engine import TightLayoutEngine
+
+        ylim = self.roi_axes.update(values, roi_id, roi_name, hemi, stats, max_points)
+        if ylim is None:
+            return
+        self.roi_axes.ax.set_ylabel(f"{modality_label} value")
+
+        layout_key = (modality_label, int(np.floor(np.log10(max(abs(ylim[0]), abs(ylim[1]), 1e-12)))))
+        if layout_key != self._layout_key:
+            # same subplot adjustment as fig.tight_layout(), without attaching a layout
+            # engine to the figure (which would cost an extra draw in every savefig)
+            TightLayoutEngine().execute(self.fig)
+            self._layout_key = layout_key
+
+        out_png.parent.mkdir(parents=True, exist_ok=True)
+        self.fig.savefig(out_png, dpi=self.DPI)
+
+
+_ROI_RENDERER: Optional[RoiFigureRenderer] = None
+
+
+def roi_figure_renderer() -> RoiFigureRenderer:
+    """
+    RoiFigureRenderer of this process (built on first use, so once per PNG worker).
+    """
+    global _ROI_RENDERER
+    if _ROI_RENDERER is None:
+        _ROI_RENDERER = RoiFigureRenderer()
+    return _ROI_RENDERER
+
+
+# ---------------------------------------------------------------------------
+# ROI distribution sheets (many ROIs per figure: multi-page PDF or tiled PNGs)
+# ---------------------------------------------------------------------------
+ROI_PLOT_FORMATS = ("png", "pdf", "sheet")
+
+
+def parse_sheet_grid(arg: str) -> Tuple[int, int]:
+    """
+    'ROWSxCOLS' (e.g. '4x5') -> (rows, cols).
+    """
+    try:
+        rows, cols = (int(x) for x in arg.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Sheet grid must be 'ROWSxCOLS' (e.g. 4x5), got: {arg!r}")
+    if rows < 1 or cols < 1:
+        raise ValueError(f"Sheet grid must have at least one row and one column, got: {arg!r}")
+    return rows, cols
+
+
+class RoiSheetRenderer:
+    """
+    Page of rows x cols ROI distributions: the figure, one RoiAxes per cell and the shared
+    legend are built once; render_page() only updates the cells' data (unused cells are hidden).
+    """
+
+    DPI = 100
+
+    def __init__(self, rows: int, cols: int):
+        import matplotlib
+        matplotlib.use("Agg")
+        from matplotlib.figure import Figure
+
+        self.fig = Figure(figsize=(cols * 2.6, rows * 3.2 + 0.8))
+        self.cells = [RoiAxes(ax, compact=True) for ax in self.fig.subplots(rows, cols, squeeze=False).ravel()]
+        self.fig.legend(handles=_roi_legend_handles(compact=True), loc="lower center", ncol=5, fontsize=8)
+        height = self.fig.get_figheight()
+        self.fig.subplots_adjust(left=0.06, right=0.98, top=1.0 - 0.6 / height, bottom=0.5 / height,
+                                 wspace=0.35, hspace=0.35)
+
+    @property
+    def per_page(self) -> int:
+        return len(self.cells)
+
+    def render_page(self, page_jobs: Sequence[Dict[str, object]], title: str) -> None:
+        for k, cell in enumerate(self.cells):
+            shown = False
+            if k < len(page_jobs):
+                job = page_jobs[k]
+                shown = cell.update(
+                    job["values"], job["roi_id"], job["roi_name"], job["hemi"], job["stats"], job["max_points"],
+                ) is not None
+            cell.ax.set_visible(shown)
+        self.fig.suptitle(title, fontsize=10)
+
+
+_SHEET_RENDERERS: Dict[Tuple[int, int], RoiSheetRenderer] = {}
+
+
+def roi_sheet_renderer(rows: int, cols: int) -> RoiSheetRenderer:
+    """
+    RoiSheetRenderer of this process for a grid (built on first use).
+    """
+    if (rows, cols) not in _SHEET_RENDERERS:
+        _SHEET_RENDERERS[(rows, cols)] = RoiSheetRenderer(rows, cols)
+    return _SHEET_RENDERERS[(rows, cols)]
+
+
+def _render_sheet_page(task: Tuple[List[Dict[str, object]], Path, int, int, str]) -> None:
+    page_jobs, out_png, rows, cols, title = task
+    renderer = roi_sheet_renderer(rows, cols)
+    renderer.render_page(page_jobs, title)
+    out_png.parent.mkdir(parents=True, exist_ok=True)
+    renderer.fig.savefig(out_png, dpi=renderer.DPI)
+
+
+def plot_roi_sheets(
+    jobs: Sequence[Dict[str, object]],
+    out_stem: Path,
+    fmt: str,
+    grid: Tuple[int, int],
+    title: str,
+    png_pool: Optional[ProcessPoolExecutor] = None,
+) -> List[Path]:
+    """
+    ROI distributions (plot_rois jobs) as pages of rows x cols cells: one multi-page
+    <out_stem>.pdf (fmt='pdf') or tiled PNG sheets <out_stem>_sheetNNN.png
+    (fmt='sheet', pages rendered in png_pool if given).
+    """
+    rows, cols = grid
+    per_page = rows * cols
+    pages = [list(jobs[i:i + per_page]) for i in range(0, len(jobs), per_page)]
+    if not pages:
+        return []
+    out_stem.parent.mkdir(parents=True, exist_ok=True)
+
+    if fmt == "pdf":
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        out_pdf = out_stem.with_name(out_stem.name + ".pdf")
+        renderer = roi_sheet_renderer(rows, cols)
+        with PdfPages(out_pdf) as pdf:
+            for k, page_jobs in enumerate(pages):
+                renderer.render_page(page_jobs, f"{title} ({k + 1}/{len(pages)})")
+                pdf.savefig(renderer.fig)
+        return [out_pdf]
+
+    tasks = [
+        (page_jobs, out_stem.with_name(f"{out_stem.name}_sheet{k + 1:03d}.png"), rows, cols,
+         f"{title} ({k + 1}/{len(pages)})")
+        for k, page_jobs in enumerate(pages)
+    ]
+    if png_pool is not None:
+        list(png_pool.map(_render_sheet_page, tasks))
+    else:
+        for task in tasks:
+            _render_sheet_page(task)
+    return [task[1] for task in tasks]
+
+
+def load_value_image(tpl_path: Path, bundle: AtlasBundle) -> Tuple[np.ndarray, float]:
+    """
+    Returns (float32 data, voxel volume in mm3) of an image defined on the atlas grid.
+    """
+    tpl_img = nib.load(str(tpl_path))
+    if tuple(tpl_img.shape) != bundle.shape:
+        raise ValueError(f"Shape mismatch labels {bundle.shape} vs template {tpl_img.shape}: {tpl_path}")
+
+    tpl_data = np.asanyarray(tpl_img.get_fdata(dtype=np.float32))
+
+    zooms = tpl_img.header.get_zooms()
+    return tpl_data, float(np.prod(zooms[:3]))
+
+
+def build_roi_table(
+    bundle: AtlasBundle,
+    stats: RoiStats,
+    group: str,
+    modality: str,
+    image_name: str,
+    voxel_vol_mm3: float,
+    compute_minmax: bool,
+) -> pd.DataFrame:
+    """
+    One row per atlas ROI (full precision; text tables are rounded when written),
+    assembled column-wise from the RoiStats arrays.
+    """
+    n_voxels = stats.n_voxels
+    total_brain_voxels = int(n_voxels[bundle.roi_ids != 0].sum())
+    if total_brain_voxels > 0:
+        vol_pct = n_voxels / total_brain_voxels * 100.0
+    else:
+        vol_pct = np.zeros(n_voxels.size)
+
+    df = pd.DataFrame({
+        "Group": group,
+        "Modality": modality,
+        "TemplateFile": image_name,
+        "ROI_id": np.asarray(bundle.roi_ids, dtype=np.int64),
+        "ROI_base_id": np.asarray(bundle.base_ids, dtype=np.int64),
+        "Hemisphere": np.asarray(bundle.hemis, dtype=object),
+        "ROI_name": np.asarray(bundle.names, dtype=object),
+        "n_voxels": n_voxels,
+        "volume_mm3": n_voxels * voxel_vol_mm3,
+        "volume_global_pct": vol_pct,
+    })
+    missing = np.full(n_voxels.size, np.nan)
+    for key in ROI_TABLE_METRICS:
+        if key in ("min", "max") and not compute_minmax:
+            df[key] = missing
+        else:
+            df[key] = stats.metrics.get(key, missing)
+    return df
+
+
+def build_hierarchy_table(
+    plan: HierarchyPlan,
+    acc: RoiAccumulator,
+    group: str,
+    modality: str,
+    image_name: str,
+    voxel_vol_mm3: float,
+    compute_minmax: bool,
+) -> pd.DataFrame:
+    """
+    One row per (structure, hemisphere) of the roll-up plan (full precision).
+    Counts, mean, std, skewness, kurtosis, min and max are exact; quantiles and the robust
+    metrics come from the merged histograms.
+    """
+    arrays = rollup_accumulator(acc, plan).finalize(compute_minmax)
+    stats = RoiStats.from_groups(arrays, plan.node_ids, arrays["group"])
+    n_voxels = stats.n_voxels
+    df = pd.DataFrame({
+        "Group": group,
+        "Modality": modality,
+        "TemplateFile": image_name,
+        "structure_id": plan.node_ids,
+        "acronym": plan.acronyms,
+        "structure_name": plan.names,
+        "depth": plan.depths,
+        "Hemisphere": plan.hemis,
+        "n_rois": np.diff(plan.membership.indptr),
+        "n_voxels": n_voxels,
+        "volume_mm3": n_voxels * voxel_vol_mm3,
+    })
+    missing = np.full(n_voxels.size, np.nan)
+    for key in ROI_TABLE_METRICS:
+        df[key] = stats.metrics.get(key, missing)
+    return df
+
+
+def _render_roi_png(job: Dict[str, object]) -> None:
+    plot_single_roi_distribution(**job)
+
+
+def plot_rois(
+    bundle: AtlasBundle,
+    tpl_data: np.ndarray,
+    stats: RoiStats,
+    group: str,
+    modality: str,
+    args: argparse.Namespace,
+    per_roi_png_dir: Path,
+    png_pool: Optional[ProcessPoolExecutor] = None,
+) -> None:
+    """
+    Per-ROI PNGs (voxel scatter) for the ROIs selected by --roi-ids / --roi-png-max.
+    Voxels are gathered once through the label index and sliced per ROI segment
+    (same voxel order as a boolean mask); figures are rendered in png_pool if given.
+    """
+    roi_ids_req = parse_roi_ids(args.roi_ids)  # None, [] (=all), or explicit list
+    if roi_ids_req is None:
+        return
+
+    if roi_ids_req == []:
+        roi_ids_to_plot = bundle.roi_ids.tolist()  # all
+    else:
+        roi_ids_to_plot = roi_ids_req
+
+    if args.roi_png_max > 0:
+        roi_ids_to_plot = roi_ids_to_plot[: args.roi_png_max]
+
+    gathered = np.asarray(tpl_data).reshape(-1)[np.asarray(bundle.voxel_order)]
+
+    jobs: List[Dict[str, object]] = []
+    for roi_id in roi_ids_to_plot:
+        if roi_id == 0:
+            continue
+
+        pos = int(np.searchsorted(bundle.roi_ids, int(roi_id)))
+        if pos >= bundle.roi_ids.size or int(bundle.roi_ids[pos]) != int(roi_id):
+            continue
+
+        vals = gathered[int(bundle.starts[pos]):int(bundle.ends[pos])]
+
+        if not args.include_negative:
+            vals = vals[np.isfinite(vals) & (vals >= 0)]
+        else:
+            vals = vals[np.isfinite(vals)]
+
+        if vals.size == 0:
+            continue
+
+        hemi = str(bundle.hemis[pos])
+        roi_name = str(bundle.names[pos])
+
+        s = stats.row(pos) or {"n_voxels": int(vals.size), "mean": float(np.mean(vals)), "std": float(np.std(vals))}
+
+        out_png = per_roi_png_dir / group / modality / f"{group}_{modality}_{int(roi_id)}.png"
+        jobs.append(dict(
+            values=vals,
+            roi_id=int(roi_id),
+            roi_name=roi_name,
+            hemi=hemi,
+            stats=s,
+            out_png=out_png,
+            modality_label=modality,
+            max_points=args.roi_max_points,
+        ))
+
+    if args.roi_plot_format != "png":
+        outputs = plot_roi_sheets(
+            jobs,
+            out_stem=per_roi_png_dir / group / modality / f"{group}_{modality}_rois",
+            fmt=args.roi_plot_format,
+            grid=parse_sheet_grid(args.roi_sheet_grid),
+            title=f"{group} {modality}",
+            png_pool=png_pool,
+        )
+        print(f"[OK] ROI sheets ({len(outputs)} file(s)) in: {per_roi_png_dir / group / modality}")
+        return
+
+    if png_pool is not None:
+        # consume the results so that rendering errors are raised here
+        list(png_pool.map(_render_roi_png, jobs, chunksize=8))
+    else:
+        for job in jobs:
+            _render_roi_png(job)
+
+    print(f"[OK] Per-ROI PNGs in: {per_roi_png_dir / group / modality}")
+
+
+class ImageResult(NamedTuple):
+    table: pd.DataFrame
+    hierarchy: Optional[pd.DataFrame] = None
+
+
+def process_batch(
+    bundle: AtlasBundle,
+    items: Sequence[Tuple[str, str, Path]],
+    args: argparse.Namespace,
+    per_roi_png_dir: Path,
+    plan: Optional[HierarchyPlan] = None,
+    png_pool: Optional[ProcessPoolExecutor] = None,
+) -> List[ImageResult]:
+    """
+    ROI tables of a batch of (group, modality, image) sharing the atlas grid, computed
+    in one grouped pass (compute_stats_batch). Per-ROI PNGs are written on the way.
+    With --stream-slabs each image is instead streamed in z-slabs (bounded memory).
+    With a hierarchy plan, each image also gets its parent-structure table.
+    """
+    if args.stream_slabs > 0:
+        return [_process_streaming(bundle, item, args, per_roi_png_dir, plan, png_pool) for item in items]
+
+    loaded = [load_value_image(path, bundle) for _, _, path in items]
+    stats_list = compute_stats_batch(
+        bundle=bundle,
+        value_stack=[data for data, _ in loaded],
+        include_negative=args.include_negative,
+        compute_minmax=not args.no_minmax,
+        engine=args.stats_engine,
+        approx_bins=args.approx_quantiles,
+        threads=args.threads,
+        kernel=args.stats_kernel,
+    )
+
+    accs: List[Optional[RoiAccumulator]] = [None] * len(items)
+    if plan is not None:
+        accs = accumulate_volumes(
+            bundle, [data for data, _ in loaded], args.include_negative, args.hierarchy_bins, args.stats_kernel,
+        )
+
+    results: List[ImageResult] = []
+    for (group, modality, path), (data, voxel_vol_mm3), stats, acc in zip(items, loaded, stats_list, accs):
+        table = build_roi_table(
+            bundle, stats, group, modality, path.name, voxel_vol_mm3, compute_minmax=not args.no_minmax,
+        )
+        hierarchy = None
+        if plan is not None:
+            hierarchy = build_hierarchy_table(
+                plan, acc, group, modality, path.name, voxel_vol_mm3, compute_minmax=not args.no_minmax,
+            )
+        results.append(ImageResult(table, hierarchy))
+        if args.per_roi_png:
+            plot_rois(bundle, data, stats, group, modality, args, per_roi_png_dir, png_pool)
+    return results
+
+
+def _process_streaming(
+    bundle: AtlasBundle,
+    item: Tuple[str, str, Path],
+    args: argparse.Namespace,
+    per_roi_png_dir: Path,
+    plan: Optional[HierarchyPlan] = None,
+    png_pool: Optional[ProcessPoolExecutor] = None,
+) -> ImageResult:
+    group, modality, path = item
+    acc = accumulate_image(
+        bundle=bundle,
+        image_path=path,
+        slab=args.stream_slabs,
+        n_bins=args.stream_bins,
+        include_negative=args.include_negative,
+        value_range=parse_value_range(args.stream_range),
+        kernel=args.stats_kernel,
+    )
+    arrays = acc.finalize(not args.no_minmax)
+    stats = RoiStats.from_groups(arrays, bundle.roi_ids, arrays["group"])
+    voxel_vol_mm3 = float(np.prod(nib.load(str(path)).header.get_zooms()[:3]))
+    df = build_roi_table(bundle, stats, group, modality, path.name, voxel_vol_mm3, compute_minmax=not args.no_minmax)
+    hierarchy = None
+    if plan is not None:
+        # the leaf accumulator of the stream is merged as is: no further pass over the voxels
+        hierarchy = build_hierarchy_table(
+            plan, acc, group, modality, path.name, voxel_vol_mm3, compute_minmax=not args.no_minmax,
+        )
+    if args.per_roi_png:
+        # plotting needs the voxels: the full image is loaded only in this case
+        data, _ = load_value_image(path, bundle)
+        plot_rois(bundle, data, stats, group, modality, args, per_roi_png_dir, png_pool)
+    return ImageResult(df, hierarchy)
+
+
+def make_batches(
+    template_list: List[Tuple[str, str, Path]],
+    input_type: str,
+    batch: bool,
+    batch_size: int,
+) -> List[List[Tuple[str, str, Path]]]:
+    """
+    Without --batch every image is its own batch. With --batch, templates are batched
+    per group (all modalities), native maps per subject and modality (each map grid has
+    its own native atlas) and aligned images per modality (all subjects), in chunks of at
+    most batch_size (0 = unlimited). Input order is preserved.
+    """
+    if not batch:
+        return [[item] for item in template_list]
+
+    by_key: Dict[Tuple[str, ...], List[Tuple[str, str, Path]]] = {}
+    key_slice = {"aligned": slice(1, 2), "native": slice(0, 2)}.get(input_type, slice(0, 1))
+    for item in template_list:
+        by_key.setdefault(tuple(item[key_slice]), []).append(item)
+
+    batches: List[List[Tuple[str, str, Path]]] = []
+    for items in by_key.values():
+        step = batch_size if batch_size > 0 else len(items)
+        batches.extend(items[i:i + step] for i in range(0, len(items), step))
+    return batches
+
+
+def write_batch_tables(
+    items: Sequence[Tuple[str, str, Path]],
+    results: Sequence[ImageResult],
+    outdir: Path,
+    input_type: str,
+    as_csv: bool,
+    long_written: Optional[set],
+    manifest: Optional["StatsManifest"] = None,
+    columnar_fmt: str = "",
+    columnar_root: Optional[Path] = None,
+    atlas_key: Optional[str] = None,
+) -> None:
+    """
+    Per group*modality tables (and hierarchy tables); with --batch (long_written is the
+    set of long tables already started in this run) also the combined long-format table.
+    With columnar_fmt, each image is also written to the columnar store (full precision).
+    The written images are recorded in the manifest (saved after every batch), with
+    atlas_key when the batch used another atlas than the manifest's (native subjects).
+    """
+    for item, res in zip(items, results):
+        group, modality, _ = item
+        out_table = write_group_modality_table(res.table, outdir / group, group, modality, as_csv=as_csv)
+        print(f"[OK] ROI table: {out_table}")
+        outputs = [out_table]
+        if res.hierarchy is not None:
+            out_hier = write_hierarchy_table(res.hierarchy, outdir / group, group, modality, as_csv=as_csv)
+            print(f"[OK] Hierarchy table: {out_hier}")
+            outputs.append(out_hier)
+        if columnar_fmt:
+            outputs.append(write_columnar_table(
+                res.table, columnar_root, "roi_stats", input_type, group, modality, columnar_fmt,
+            ))
+            if res.hierarchy is not None:
+                outputs.append(write_columnar_table(
+                    res.hierarchy, columnar_root, "roi_hierarchy", input_type, group, modality, columnar_fmt,
+                ))
+        if manifest is not None:
+            manifest.record(input_type, item, outputs, atlas_key)
+
+    if long_written is not None:
+        # combined long-format table of the batch (group- or modality-wide)
+        key = items[0][1] if input_type == "aligned" else items[0][0]
+        df_long = pd.concat([res.table for res in results], ignore_index=True)
+        out_long = write_long_table(
+            df_long, outdir, key, input_type, as_csv=as_csv, append=key in long_written,
+            merge=manifest is not None and manifest.incremental,
+        )
+        long_written.add(key)
+        print(f"[OK] Long ROI table: {out_long}")
+
+    if manifest is not None:
+        manifest.save()
+
+
+# ---------------------------------------------------------------------------
+# Incremental runs (manifest of input fingerprints)
+# ---------------------------------------------------------------------------
+MANIFEST_VERSION = 2  # 2: robust/shape metric columns
+MANIFEST_NAME = "roi_stats_manifest.json"
+
+
+def image_fingerprint(path: Path) -> Dict[str, object]:
+    """
+    size, mtime and sha256 of the stored file (NIfTI header + data).
+    """
+    st = path.stat()
+    h = hashlib.sha256()
+    _hash_file(h, path)
+    return {"size": int(st.st_size), "mtime_ns": int(st.st_mtime_ns), "sha256": h.hexdigest()}
+
+
+def stats_options_key(args: argparse.Namespace) -> str:
+    """
+    Hash of the options that change the content of the written rows (and plots).
+    Parallelism and batching options are left out: they do not change the results.
+    """
+    opts: Dict[str, object] = {
+        "input_type": args.input_type,
+        "include_negative": args.include_negative,
+        "no_minmax": args.no_minmax,
+        "csv": args.csv,
+        "columnar": args.columnar,
+        "stats_engine": args.stats_engine,
+        "approx_quantiles": args.approx_quantiles,
+        "stream": [args.stream_bins, args.stream_range] if args.stream_slabs > 0 else None,
+        "per_roi_png": [args.roi_ids, args.roi_png_max, args.roi_max_points, args.roi_plot_format,
+                        args.roi_sheet_grid] if args.per_roi_png else None,
+    }
+    if args.stats_kernel != "numpy":
+        opts["stats_kernel"] = args.stats_kernel
+    if args.hierarchy:
+        h = hashlib.sha256()
+        _hash_file(h, Path(args.hierarchy).resolve())
+        opts["hierarchy"] = [h.hexdigest(), args.hierarchy_match, args.hierarchy_bins]
+    return hashlib.sha256(json.dumps(opts, sort_keys=True).encode()).hexdigest()
+
+
+class StatsManifest:
+    """
+    OUTDIR/roi_stats_manifest.json: for every (input type, group, modality) written, the
+    fingerprint of its input image, the atlas bundle key, the stats options key and the
+    output files. An image is up to date when all of them still match; size and mtime are
+    checked first, the content hash only when they changed (e.g. a file copied or touched).
+    """
+
+    def __init__(self, path: Path, atlas_key: str, options_key: str, incremental: bool):
+        self.path = path
+        self.atlas_key = atlas_key
+        self.options_key = options_key
+        self.incremental = incremental
+        self.entries: Dict[str, Dict[str, object]] = {}
+        if path.exists():
+            try:
+                doc = json.loads(path.read_text())
+            except (OSError, ValueError):
+                doc = {}
+            if doc.get("version") == MANIFEST_VERSION:
+                self.entries = doc.get("entries", {})
+
+    @staticmethod
+    def entry_key(input_type: str, group: str, modality: str) -> str:
+        return f"{input_type}/{group}/{modality}"
+
+    def is_current(self, input_type: str, item: Tuple[str, str, Path], atlas_key: Optional[str] = None) -> bool:
+        group, modality, path = item
+        entry = self.entries.get(self.entry_key(input_type, group, modality))
+        atlas_key = self.atlas_key if atlas_key is None else atlas_key
+        if entry is None or entry.get("atlas") != atlas_key or entry.get("options") != self.options_key:
+            return False
+        if entry.get("image") != str(path) or not path.exists():
+            return False
+        if not all((self.path.parent / out).exists() for out in entry.get("outputs", [])):
+            return False
+
+        fp = entry.get("fingerprint", {})
+        st = path.stat()
+        if fp.get("size") == st.st_size and fp.get("mtime_ns") == st.st_mtime_ns:
+            return True
+        current = image_fingerprint(path)
+        if current["sha256"] != fp.get("sha256"):
+            return False
+        entry["fingerprint"] = current  # same content, new mtime: no need to hash it again
+        return True
+
+    def record(
+        self,
+        input_type: str,
+        item: Tuple[str, str, Path],
+        outputs: Sequence[Path],
+        atlas_key: Optional[str] = None,
+    ) -> None:
+        group, modality, path = item
+        self.entries[self.entry_key(input_type, group, modality)] = {
+            "image": str(path),
+            "fingerprint": image_fingerprint(path),
+            "atlas": self.atlas_key if atlas_key is None else atlas_key,
+            "options": self.options_key,
+            "outputs": [os.path.relpath(out, self.path.parent) for out in outputs],
+        }
+
+    def save(self) -> None:
+        # written to a temporary file then renamed: an interrupted run keeps a valid manifest
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.tmp{os.getpid()}")
+        tmp.write_text(json.dumps({"version": MANIFEST_VERSION, "entries": self.entries}, indent=2, sort_keys=True))
+        os.replace(tmp, self.path)
+
+
+# ---------------------------------------------------------------------------
+# Library API (in-memory arrays or nibabel images, no file discovery)
+# ---------------------------------------------------------------------------
+def as_atlas_bundle(
+    labels,
+    label_names=None,
+    lr_offset: int = 2000,
+    right_suffix: str = "_R",
+    left_suffix: str = "_L",
+) -> AtlasBundle:
+    """
+    labels as an AtlasBundle: returned as is if it already is one (index it once, then reuse it
+    for many images), otherwise an integer array or nibabel label image is indexed in memory.
+    label_names: {base id: name} or the path of a label table CSV (id, name).
+    """
+    if isinstance(labels, AtlasBundle):
+        return labels
+    if isinstance(label_names, (str, Path)):
+        label_names = load_label_table(Path(label_names))
+    if isinstance(labels, nib.spatialimages.SpatialImage):
+        labels = np.asanyarray(labels.dataobj)
+    return index_label_volume(labels, dict(label_names or {}), lr_offset, right_suffix, left_suffix)
+
+
+def _value_array(values, voxel_size) -> Tuple[np.ndarray, float, str]:
+    """
+    (float32 data, voxel volume in mm3, file name or "") of an array or nibabel image.
+    voxel_size: voxel spacing in mm (one value if isotropic, or per axis); default: the
+    image header for nibabel images, 1 otherwise (volume_mm3 = n_voxels).
+    """
+    name = ""
+    if isinstance(values, nib.spatialimages.SpatialImage):
+        if voxel_size is None:
+            voxel_size = values.header.get_zooms()[:3]
+        name = Path(values.get_filename()).name if values.get_filename() else ""
+        values = values.get_fdata(dtype=np.float32)
+    data = np.asarray(values, dtype=np.float32)
+
+    if voxel_size is None:
+        voxel_vol_mm3 = 1.0
+    elif np.ndim(voxel_size) == 0:
+        voxel_vol_mm3 = float(voxel_size) ** 3
+    else:
+        voxel_vol_mm3 = float(np.prod(np.asarray(voxel_size, dtype=np.float64)[:3]))
+    return data, voxel_vol_mm3, name
+
+
+def roi_stats_table(
+    values,
+    labels,
+    mask=None,
+    voxel_size=None,
+    label_names=None,
+    include_negative: bool = False,
+    compute_minmax: bool = True,
+    engine: str = "segment",
+    approx_bins: int = 0,
+    lr_offset: int = 2000,
+    right_suffix: str = "_R",
+    left_suffix: str = "_L",
+    group: str = "",
+    modality: str = "",
+    image_names: Optional[Sequence[str]] = None,
+    batch_size: int = 32,
+    threads: int = 1,
+    kernel: str = "numpy",
+) -> pd.DataFrame:
+    """
+    ROI statistics table (same columns as the *_roi_stats tables, full precision) of
+    in-memory data, without file discovery or writing.
+
+    values: array or nibabel image on the label grid, or a list of them (one long table;
+      images are computed by chunks of batch_size in one grouped pass each).
+    labels: label array / nibabel image, or an AtlasBundle (see as_atlas_bundle) to reuse
+      the label index across calls.
+    mask: optional boolean array / image (shared, or one per image); voxels outside are ignored.
+    image_names: TemplateFile of each image (default: file name of nibabel images, else its index).
+    """
+    bundle = as_atlas_bundle(labels, label_names, lr_offset, right_suffix, left_suffix)
+    single = not isinstance(values, (list, tuple))
+    value_list = [values] if single else list(values)
+    if isinstance(mask, (list, tuple)):
+        if len(mask) != len(value_list):
+            raise ValueError(f"Got {len(mask)} masks for {len(value_list)} images.")
+        masks = list(mask)
+    else:
+        masks = [mask] * len(value_list)
+
+    tables: List[pd.DataFrame] = []
+    step = batch_size if batch_size > 0 else max(len(value_list), 1)
+    for start in range(0, len(value_list), step):
+        chunk = []
+        for i in range(start, min(start + step, len(value_list))):
+            data, voxel_vol_mm3, name = _value_array(value_list[i], voxel_size)
+            if data.shape != bundle.shape:
+                raise ValueError(f"Shape mismatch labels {bundle.shape} vs values {data.shape} (image {i})")
+            if masks[i] is not None:
+                m = masks[i]
+                m = np.asanyarray(m.dataobj) if isinstance(m, nib.spatialimages.SpatialImage) else np.asarray(m)
+                data = np.where(m.astype(bool), data, np.float32(np.nan))
+            if image_names is not None:
+                name = str(image_names[i])
+            chunk.append((data, voxel_vol_mm3, name or str(i)))
+
+        stats_list = compute_stats_batch(
+            bundle, [data for data, _, _ in chunk], include_negative, compute_minmax, engine, approx_bins, threads,
+            kernel,
+        )
+        for (_, voxel_vol_mm3, name), stats in zip(chunk, stats_list):
+            tables.append(build_roi_table(bundle, stats, group, modality, name, voxel_vol_mm3, compute_minmax))
+
+    if not tables:
+        return pd.DataFrame()
+    return tables[0] if single else pd.concat(tables, ignore_index=True)
+
+
+# ---------------------------------------------------------------------------
+# Process pool
+# ---------------------------------------------------------------------------
+
+def share_atlas_bundle(bundle: AtlasBundle) -> Tuple[Dict[str, object], List[shared_memory.SharedMemory]]:
+    """
+    Copy the bundle arrays into shared memory blocks.
+    Returns a small picklable spec (block names, shapes, dtypes) + the blocks to close/unlink.
+    """
+    handles: List[shared_memory.SharedMemory] = []
+    arrays: Dict[str, Tuple[str, Tuple[int, ...], str]] = {}
+    for name in ATLAS_BUNDLE_ARRAYS:
+        arr = np.ascontiguousarray(getattr(bundle, name))
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        handles.append(shm)
+        arrays[name] = (shm.name, arr.shape, arr.dtype.str)
+    spec: Dict[str, object] = {"key": bundle.key, "shape": bundle.shape, "arrays": arrays}
+    return spec, handles
+
+
+def attach_atlas_bundle(spec: Dict[str, object]) -> Tuple[AtlasBundle, List[shared_memory.SharedMemory]]:
+    handles: List[shared_memory.SharedMemory] = []
+    arrays: Dict[str, np.ndarray] = {}
+    for name, (shm_name, shape, dtype) in spec["arrays"].items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return AtlasBundle(key=spec["key"], shape=tuple(spec["shape"]), **arrays), handles
+
+
+_WORKER: Dict[str, object] = {}
+
+
+def _init_worker(
+    spec: Optional[Dict[str, object]],
+    args: argparse.Namespace,
+    per_roi_png_dir: Path,
+    plan: Optional[HierarchyPlan] = None,
+    native: Optional[NativeAtlases] = None,
+) -> None:
+    """
+    spec: shared atlas bundle; None with native atlases (each worker maps the compiled
+    per-map bundles from the atlas cache).
+    """
+    bundle, handles = attach_atlas_bundle(spec) if spec is not None else (None, [])
+    _WORKER.update(bundle=bundle, handles=handles, args=args, per_roi_png_dir=per_roi_png_dir, plan=plan,
+                   native=native)
+
+
+def _process_batch_task(items: List[Tuple[str, str, Path]]) -> List[ImageResult]:
+    bundle, plan = _WORKER["bundle"], _WORKER["plan"]
+    if _WORKER["native"] is not None:
+        bundle, plan = _WORKER["native"].get(*items[0][:2])
+    return process_batch(bundle, items, _WORKER["args"], _WORKER["per_roi_png_dir"], plan)
+
+
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(
         description="Extract Allen ROI stats from FC3R templates. TSV per Group*Modality + PNG per ROI."
     )
     p.add_argument("--out-root", type=str, required=True, help="OUT_ROOT produced by your driver.")
-    p.add_argument("--input-type", choices=["template", "aligned"], default="template",
-                   help="Look for group templates ('template') or individual aligned images ('aligned').")
+    p.add_argument("--input-type", choices=["template", "aligned", "native"], default="template",
+                   help="Look for group templates ('template'), individual aligned images ('aligned') or "
+                        "individual native maps ('native', with the labels warped onto each map grid by "
+                        "warp_labels_to_native.sh).")
     p.add_argument("--labels", type=str, default="", help="Default: ./resources/100_AMBA_LR.nii.gz next to this script.")
     p.add_argument("--labels-table", type=str, default="", help="Default: ./resources/allen_labels_table.csv next to this script.")
     p.add_argument("--modalities", type=str, default="T1map,UNIT1", help="Comma-separated modalities.")
     p.add_argument("--outdir", type=str, default="", help="Default: OUT_ROOT/derivatives/ROI_stats")
     p.add_argument("--csv", action="store_true", help="Write CSV instead of TSV.")
+    p.add_argument("--columnar", choices=[""] + list(COLUMNAR_FORMATS), default="",
+                   help="Also write a columnar store (full precision, partitioned by input type/group/modality; "
+                        "needs pyarrow). Read it with load_roi_stats().")
+    p.add_argument("--columnar-dir", type=str, default="", help="Default: OUTDIR/columnar")
+    p.add_argument("--atlas-cache", type=str, default="",
+                   help="Directory of compiled atlas bundles (label index, names). Default: OUTDIR/atlas_cache")
+    p.add_argument("--no-atlas-cache", action="store_true",
+                   help="Build the atlas index in memory at every run instead of using a compiled bundle.")
+    p.add_argument("--compile-atlas", action="store_true",
+                   help="Only compile the atlas bundle for --labels/--labels-table/--lr-offset and exit.")
 
     p.add_argument("--lr-offset", type=int, default=2000)
     p.add_argument("--right-suffix", type=str, default="_R")
@@ -405,6 +3295,44 @@ def parse_args() -> argparse.Namespace:
 
     p.add_argument("--include-negative", action="store_true")
     p.add_argument("--no-minmax", action="store_true")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Images processed in parallel (process pool). 0 = all CPUs.")
+    p.add_argument("--threads", type=int, default=0,
+                   help="Threads of the chunked count/sum/sum-of-squares reduction of each worker. "
+                        "0 = CPUs / workers.")
+    p.add_argument("--batch", action="store_true",
+                   help="Compute stats of all modalities of a group (template) or all subjects of a modality (aligned) "
+                        "in one pass, and also write a combined long-format table per batch.")
+    p.add_argument("--batch-size", type=int, default=32,
+                   help="Max images per --batch pass (bounds memory). 0 = no limit.")
+    p.add_argument("--stream-slabs", type=int, default=0,
+                   help="Out-of-core mode: stream each image in slabs of N z-slices with mergeable per-ROI "
+                        "accumulators (quantiles from a histogram sketch). 0 = off (in-memory).")
+    p.add_argument("--stream-bins", type=int, default=2048,
+                   help="Histogram bins of the streaming quantile sketch (quantile error <= one bin width).")
+    p.add_argument("--stream-range", type=str, default="",
+                   help="Fixed 'LO,HI' histogram range for streaming (skips the min/max pass, "
+                        "makes sketches mergeable across images). Default: per-image min/max.")
+    p.add_argument("--approx-quantiles", type=int, default=0, metavar="BINS",
+                   help="O(N) mode: quantiles and pct_within_* interpolated from per-ROI histograms of BINS bins "
+                        "over each image's value range (quantile error <= range / BINS). 0 = exact.")
+    p.add_argument("--hierarchy", type=str, default="",
+                   help="Allen structure hierarchy (structure graph JSON, or CSV with id + parent_structure_id): "
+                        "also write per-structure tables rolled up from the ROI statistics.")
+    p.add_argument("--hierarchy-match", choices=list(HIERARCHY_MATCH), default="acronym",
+                   help="Attach atlas ROIs to hierarchy nodes by label-table name ('acronym') or by base id ('id').")
+    p.add_argument("--hierarchy-bins", type=int, default=2048,
+                   help="Histogram bins of the merged quantile sketch of parent structures (in-memory mode; "
+                        "streaming uses --stream-bins).")
+    p.add_argument("--incremental", action="store_true",
+                   help="Only recompute images whose input, atlas or stats options changed since the last run "
+                        "(OUTDIR/roi_stats_manifest.json); long tables keep the rows of unchanged images.")
+    p.add_argument("--stats-engine", choices=list(STATS_ENGINES), default="segment",
+                   help="'segment' (vectorized, sort once by label+value) or 'loop' (per-ROI reference).")
+    p.add_argument("--stats-kernel", choices=list(STATS_KERNELS), default="numpy",
+                   help="'numba': compiled single pass (counts, Welford moments, min/max, histograms) for the "
+                        "sort-free passes: --approx-quantiles, --stream-slabs and --hierarchy leaves (needs numba). "
+                        "Exact quantiles keep the NumPy sort.")
 
     # Per-ROI plots
     p.add_argument("--per-roi-png", action="store_true",
@@ -415,12 +3343,23 @@ def parse_args() -> argparse.Namespace:
                    help="Limit number of ROI PNGs per Group*Modality (0 = no limit).")
     p.add_argument("--roi-max-points", type=int, default=5000,
                    help="Max voxels to plot per ROI (random subsample). 0 = no subsample.")
+    p.add_argument("--roi-plot-format", choices=list(ROI_PLOT_FORMATS), default="png",
+                   help="'png': one PNG per ROI; 'pdf': one multi-page PDF per Group*Modality; "
+                        "'sheet': tiled PNG sheets per Group*Modality (--roi-sheet-grid ROIs per page).")
+    p.add_argument("--roi-sheet-grid", type=str, default="4x5",
+                   help="ROWSxCOLS ROIs per page of --roi-plot-format pdf/sheet.")
+    p.add_argument("--roi-png-workers", type=int, default=0,
+                   help="Processes rendering per-ROI PNGs (0 = all CPUs, 1 = in-process). "
+                        "With --workers > 1, each image worker renders its own PNGs.")
 
     return p.parse_args()
 
 
 def main() -> None:
     args = parse_args()
+    if args.threads <= 0:
+        n_cpus = os.cpu_count() or 1
+        args.threads = max(1, n_cpus // (args.workers if args.workers > 0 else n_cpus))
 
     out_root = Path(args.out_root).resolve()
     script_dir = Path(__file__).resolve().parent
@@ -432,14 +3371,44 @@ def main() -> None:
     if not labels_path.exists():
         raise FileNotFoundError(f"Labels NIfTI not found: {labels_path}")
 
-    id_to_name: Dict[int, str] = {}
-    if table_path.exists():
-        id_to_name = load_label_table(table_path)
+    outdir = Path(args.outdir).resolve() if args.outdir else (out_root / "derivatives" / "ROI_stats")
+    per_roi_png_dir = outdir / "plots_by_roi"  # plots_by_roi/<GROUP>/<MODALITY>/S01_T1map_214.png
+
+    # Compiled atlas (label index + names), reused across runs
+    atlas_cache: Optional[Path] = None
+    if not args.no_atlas_cache:
+        atlas_cache = Path(args.atlas_cache).resolve() if args.atlas_cache else (outdir / "atlas_cache")
+    bundle = get_atlas_bundle(
+        labels_path=labels_path,
+        table_path=table_path,
+        cache_dir=atlas_cache,
+        lr_offset=args.lr_offset,
+        right_suffix=args.right_suffix,
+        left_suffix=args.left_suffix,
+    )
+    if args.compile_atlas:
+        print(f"[OK] Atlas bundle ready: {bundle.key[:16]} ({bundle.roi_ids.size} ROIs)")
+        return
+
+    hierarchy = load_structure_hierarchy(Path(args.hierarchy).resolve()) if args.hierarchy else None
+    plan: Optional[HierarchyPlan] = None
+    if hierarchy is not None:
+        id_to_name = load_label_table(table_path) if table_path.exists() else {}
+        plan = build_hierarchy_plan(bundle, hierarchy, id_to_name, args.hierarchy_match)
+        print(f"[INFO] Hierarchy roll-up: {plan.node_ids.size} structure rows.")
 
     modalities = [m.strip() for m in args.modalities.split(",") if m.strip()]
 
+    # Native space: each subject map has its own atlas bundle (labels warped onto its grid)
+    native: Optional[NativeAtlases] = None
     if args.input_type == "template":
         template_list = discover_templates(out_root, modalities)
+    elif args.input_type == "native":
+        template_list = discover_native(out_root, modalities, labels_path)
+        native = NativeAtlases(
+            out_root, labels_path, table_path, atlas_cache, args.lr_offset, args.right_suffix, args.left_suffix,
+            hierarchy, args.hierarchy_match,
+        )
     else:
         template_list = discover_aligned(out_root, modalities)
 
@@ -447,139 +3416,74 @@ def main() -> None:
         print(f"[INFO] No '{args.input_type}' images found for modalities: {modalities}. (Skipping stats).")
         return
 
-    outdir = Path(args.outdir).resolve() if args.outdir else (out_root / "derivatives" / "ROI_stats")
-    per_roi_png_dir = outdir / "plots_by_roi"  # plots_by_roi/<GROUP>/<MODALITY>/S01_T1map_214.png
-
-    # Load labels
-    lab_img = nib.load(str(labels_path))
-    lab_data = np.asanyarray(lab_img.get_fdata()).astype(np.int32)
-    roi_ids_present = np.unique(lab_data)
-    roi_ids_present = roi_ids_present[roi_ids_present != 0].astype(int).tolist()
-
-    roi_ids_req = parse_roi_ids(args.roi_ids)  # None, [] (=all), or explicit list
-
-    for group, modality, tpl_path in template_list:
-        tpl_img = nib.load(str(tpl_path))
-        if tpl_img.shape != lab_img.shape:
-            raise ValueError(f"Shape mismatch labels {lab_img.shape} vs template {tpl_img.shape}: {tpl_path}")
-
-        tpl_data = np.asanyarray(tpl_img.get_fdata(dtype=np.float32))
-        
-        zooms = tpl_img.header.get_zooms()
-        voxel_vol_mm3 = float(np.prod(zooms[:3]))
-
-        stats_map = compute_stats_fast(
-            label_data=lab_data,
-            value_data=tpl_data,
-            include_negative=args.include_negative,
-            compute_minmax=not args.no_minmax,
-        )
-
-        total_brain_voxels = sum(
-            s.get("n_voxels", 0) for rid, s in stats_map.items() if rid != 0
-        )
-
-        rows: List[Dict[str, object]] = []
-        for roi_id in roi_ids_present:
-            base_id, hemi, roi_name = label_name_from_id(
-                roi_id=roi_id,
-                id_to_name=id_to_name,
-                lr_offset=args.lr_offset,
-                right_suffix=args.right_suffix,
-                left_suffix=args.left_suffix,
-            )
-            s = stats_map.get(roi_id, {})
-            
-            n_voxels = int(s.get("n_voxels", 0))
-            vol_mm3 = n_voxels * voxel_vol_mm3
-            vol_pct = (n_voxels / total_brain_voxels * 100.0) if total_brain_voxels > 0 else 0.0
-
-            rows.append({
-                "Group": group,
-                "Modality": modality,
-                "TemplateFile": tpl_path.name,
-                "ROI_id": int(roi_id),
-                "ROI_base_id": int(base_id),
-                "Hemisphere": hemi,
-                "ROI_name": roi_name,
-                "n_voxels": n_voxels,
-                "volume_mm3": vol_mm3,          
-                "volume_global_pct": vol_pct,   
-                "mean": float(s.get("mean", np.nan)) if s else np.nan,
-                "std": float(s.get("std", np.nan)) if s else np.nan,
-                "min": float(s.get("min", np.nan)) if (s and not args.no_minmax) else np.nan,
-                "max": float(s.get("max", np.nan)) if (s and not args.no_minmax) else np.nan,
-                "p05": float(s.get("p05", np.nan)) if s else np.nan,
-                "q1": float(s.get("q1", np.nan)) if s else np.nan,
-                "median": float(s.get("median", np.nan)) if s else np.nan,
-                "q3": float(s.get("q3", np.nan)) if s else np.nan,
-                "p95": float(s.get("p95", np.nan)) if s else np.nan,
-                "iqr": float(s.get("iqr", np.nan)) if s else np.nan,
-                "pct_within_1sd": float(s.get("pct_within_1sd", np.nan)) if s else np.nan,
-                "pct_within_whiskers": float(s.get("pct_within_whiskers", np.nan)) if s else np.nan,
-            })
-
-        df = pd.DataFrame(rows)
-
-        num_cols = df.select_dtypes(include=[np.number]).columns
-        df[num_cols] = df[num_cols].round(2)
-        
-        # 1) TSV per group*modality
-        group_dir = outdir / group
-        out_table = write_group_modality_table(df, group_dir, group, modality, as_csv=args.csv)
-        print(f"[OK] ROI table: {out_table}")
-
-        # 2) Per-ROI PNGs (voxel scatter)
-        if args.per_roi_png:
-            if roi_ids_req is None:
-                continue
-
-            if roi_ids_req == []:
-                roi_ids_to_plot = roi_ids_present[:]  # all
-            else:
-                roi_ids_to_plot = roi_ids_req
-
-            if args.roi_png_max > 0:
-                roi_ids_to_plot = roi_ids_to_plot[: args.roi_png_max]
-
-            for roi_id in roi_ids_to_plot:
-                if roi_id == 0:
-                    continue
-
-                mask = (lab_data == int(roi_id))
-                vals = tpl_data[mask]
-
-                if not args.include_negative:
-                    vals = vals[np.isfinite(vals) & (vals >= 0)]
-                else:
-                    vals = vals[np.isfinite(vals)]
-
-                if vals.size == 0:
-                    continue
-
-                base_id, hemi, roi_name = label_name_from_id(
-                    roi_id=int(roi_id),
-                    id_to_name=id_to_name,
-                    lr_offset=args.lr_offset,
-                    right_suffix=args.right_suffix,
-                    left_suffix=args.left_suffix,
+    if args.stats_kernel == "numba":
+        _import_numba()  # fail before computing anything
+        if not (args.approx_quantiles or args.stream_slabs or args.hierarchy):
+            print("[INFO] --stats-kernel numba only applies to --approx-quantiles, --stream-slabs and --hierarchy.")
+
+    columnar_root: Optional[Path] = None
+    if args.columnar:
+        _import_pyarrow()  # fail before computing anything
+        columnar_root = Path(args.columnar_dir).resolve() if args.columnar_dir else (outdir / "columnar")
+
+    manifest = StatsManifest(outdir / MANIFEST_NAME, bundle.key, stats_options_key(args), args.incremental)
+    if args.incremental:
+        n_found = len(template_list)
+        template_list = [
+            item for item in template_list
+            if not manifest.is_current(args.input_type, item, native.key(*item[:2]) if native else None)
+        ]
+        print(f"[INFO] Incremental: {n_found - len(template_list)} image(s) up to date, {len(template_list)} to compute.")
+        if not template_list:
+            manifest.save()
+            return
+
+    batches = make_batches(template_list, args.input_type, args.batch, args.batch_size)
+    long_written: Optional[set] = set() if args.batch else None
+
+    if args.workers == 1 or len(batches) == 1:
+        png_pool: Optional[ProcessPoolExecutor] = None
+        if args.per_roi_png and args.roi_png_workers != 1:
+            png_pool = ProcessPoolExecutor(max_workers=args.roi_png_workers if args.roi_png_workers > 0 else None)
+        try:
+            for items in batches:
+                batch_bundle, batch_plan = native.get(*items[0][:2]) if native else (bundle, plan)
+                results = process_batch(batch_bundle, items, args, per_roi_png_dir, batch_plan, png_pool)
+                write_batch_tables(
+                    items, results, outdir, args.input_type, args.csv, long_written, manifest,
+                    args.columnar, columnar_root, native.key(*items[0][:2]) if native else None,
                 )
+        finally:
+            if png_pool is not None:
+                png_pool.shutdown()
+        return
 
-                s = stats_map.get(int(roi_id), {"n_voxels": int(vals.size), "mean": float(np.mean(vals)), "std": float(np.std(vals))})
-
-                out_png = per_roi_png_dir / group / modality / f"{group}_{modality}_{int(roi_id)}.png"
-                plot_single_roi_distribution(
-                    values=vals,
-                    roi_id=int(roi_id),
-                    roi_name=roi_name,
-                    hemi=hemi,
-                    stats=s,
-                    out_png=out_png,
-                    modality_label=modality,
-                    max_points=args.roi_max_points,
+    # Process pool: the label index lives in shared memory, workers only receive (group, modality, path)
+    n_workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    n_workers = min(n_workers, len(batches))
+    if native:
+        # compile the per-map bundles once, before the workers map them
+        for subject, modality in dict.fromkeys(item[:2] for item in template_list):
+            native.get(subject, modality)
+        spec, handles = None, []
+    else:
+        spec, handles = share_atlas_bundle(bundle)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(spec, args, per_roi_png_dir, plan, native),
+        ) as pool:
+            # map() yields in submission order: tables are written deterministically
+            for items, results in zip(batches, pool.map(_process_batch_task, batches)):
+                write_batch_tables(
+                    items, results, outdir, args.input_type, args.csv, long_written, manifest,
+                    args.columnar, columnar_root, native.key(*items[0][:2]) if native else None,
                 )
-
-            print(f"[OK] Per-ROI PNGs in: {per_roi_png_dir / group / modality}")
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
 
 
 if __name__ == "__main__":
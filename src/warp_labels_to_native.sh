@@ -0,0 +1,126 @@
+#!/usr/bin/env bash
+set -euo pipefail
+shopt -s nullglob
+
+# ============================================================
+# warp_labels_to_native.sh
+# Purpose: Allen labels -> native space of every brain-extracted map, with the inverse of
+#          the RARE -> Allen transforms (label-aware interpolation), so that ROI stats
+#          can be taken on the native maps (extract_roi_stats.py --input-type native).
+#          Each map has its own acquisition grid: the labels are warped onto each of them
+#          (-r = the map). T2starmap/QSM are aligned with the RARE header
+#          (CopyImageHeaderInformation, as in apply_transforms_to_maps.sh): the labels are
+#          warped onto that grid, then given the header of the map.
+# Outputs:
+#   - RARE/native_labels/<sub>_<ses>_<MOD>_<LABELS_ID>_native.nii.gz
+# ============================================================
+
+log_info() { echo "[INFO] $*"; }
+log_warn() { echo "[WARN] $*"; }
+log_ok()   { echo "[OK]   $*"; }
+log_skip() { echo "[SKIP] $*"; }
+log_err()  { echo "[ERROR] $*" >&2; }
+
+basename_nii() {
+  local f="$(basename "$1")"
+  if [[ "$f" == *.nii.gz ]]; then echo "${f%.nii.gz}"; elif [[ "$f" == *.nii ]]; then echo "${f%.nii}"; else echo "$f"; fi
+}
+
+parse_sub_ses_suffix() {
+  local base="$1"
+  if [[ "$base" =~ ^(sub-[0-9]+)_ses-([0-9]+)_(.+)$ ]]; then
+    SUB="${BASH_REMATCH[1]}"; SES="ses-${BASH_REMATCH[2]}"; SUFFIX="${BASH_REMATCH[3]}"; CANON_BASE="$base";
+  elif [[ "$base" =~ ^(sub-[0-9]+)_(.+)$ ]]; then
+    SUB="${BASH_REMATCH[1]}"; SES="ses-1"; SUFFIX="${BASH_REMATCH[2]}"; CANON_BASE="${SUB}_${SES}_${SUFFIX}";
+  else return 1; fi
+  SUBSES="${SUB}_${SES}"; return 0
+}
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+BRAIN_DIR="${BRAIN_DIR:-$PWD}"
+RARE_DIR="${RARE_DIR:-$BRAIN_DIR/RARE}"
+TRANSFORM_DIR="${TRANSFORM_DIR:-$RARE_DIR/transforms}"
+# Only its name is used: it identifies the RARE -> Allen transforms
+ALLEN_TEMPLATE="${ALLEN_TEMPLATE:-$SCRIPT_DIR/resources/100_AMBA_ref.nii.gz}"
+ALLEN_LABELS="${ALLEN_LABELS:-$SCRIPT_DIR/resources/100_AMBA_LR.nii.gz}"
+FORCE_RERUN="${FORCE_RERUN:-0}"
+INTERP="${INTERP:-GenericLabel}"
+
+# Comma-separated modality folders of BRAIN_DIR to process (default: all, RARE included)
+MODALITIES="${MODALITIES:-}"
+
+[[ -d "$RARE_DIR" ]] || { log_err "RARE_DIR not found: $RARE_DIR"; exit 1; }
+[[ -f "$ALLEN_LABELS" ]] || { log_err "ALLEN_LABELS not found: $ALLEN_LABELS"; exit 1; }
+
+ALLEN_ID="$(basename_nii "$ALLEN_TEMPLATE")"
+LABELS_ID="$(basename_nii "$ALLEN_LABELS")"
+OUT_DIR="${RARE_DIR}/native_labels"
+mkdir -p "$OUT_DIR"
+
+log_info "Warp labels -> native space"
+log_info "Labels           : $ALLEN_LABELS"
+log_info "Transforms source: $TRANSFORM_DIR"
+
+if [[ -n "$MODALITIES" ]]; then
+  IFS=',' read -r -a mod_names <<< "$MODALITIES"
+else
+  mod_names=()
+  for d in "$BRAIN_DIR"/*/; do mod_names+=( "$(basename "$d")" ); done
+fi
+
+n_inputs=0
+for MOD in "${mod_names[@]}"; do
+  for IMG in "$BRAIN_DIR/$MOD"/*_brain_extracted.nii.gz "$BRAIN_DIR/$MOD"/*_brain_extracted.nii; do
+    [[ -f "$IMG" ]] || continue
+    n_inputs=$((n_inputs + 1))
+    IMG_BASE="$(basename_nii "$IMG")"
+    if ! parse_sub_ses_suffix "$IMG_BASE"; then continue; fi
+
+    OUT_FILE="${OUT_DIR}/${SUBSES}_${MOD}_${LABELS_ID}_native.nii.gz"
+    if [[ -f "$OUT_FILE" && "$FORCE_RERUN" != "1" ]]; then
+      log_skip "Exists: $OUT_FILE"
+      continue
+    fi
+
+    RARE_FILE=""
+    for cand in "$RARE_DIR/${SUBSES}_RARE_brain_extracted"* "$RARE_DIR/${SUB}_RARE_brain_extracted"*; do
+      [[ -f "$cand" ]] && RARE_FILE="$cand" && break
+    done
+    if [[ -z "$RARE_FILE" ]]; then
+      log_warn "No RARE for $IMG_BASE: skipping"
+      continue
+    fi
+    RARE_BASE="$(basename_nii "$RARE_FILE")"
+
+    AFFINE_MAT="${TRANSFORM_DIR}/${RARE_BASE}_aligned_to_${ALLEN_ID}_0GenericAffine.mat"
+    INV_WARP="${TRANSFORM_DIR}/${RARE_BASE}_aligned_to_${ALLEN_ID}_1InverseWarp.nii.gz"
+    if [[ ! -f "$AFFINE_MAT" ]]; then
+      log_warn "No RARE -> Allen transform for $RARE_BASE: skipping $IMG_BASE"
+      continue
+    fi
+
+    # Inverse of (warp o affine): inverted affine, then inverse warp (ANTs applies the last -t first)
+    TRANSFORMS=(-t "[${AFFINE_MAT},1]")
+    [[ -f "$INV_WARP" ]] && TRANSFORMS+=(-t "$INV_WARP")
+
+    if [[ "$MOD" == "T2starmap" || "$MOD" == "QSM" ]]; then
+      REF_IMG="${OUT_DIR}/${SUBSES}_${MOD}_tmp_hdr.nii.gz"
+      CopyImageHeaderInformation "$RARE_FILE" "$IMG" "$REF_IMG" 1 1 1
+    else
+      REF_IMG="$IMG"
+    fi
+
+    antsApplyTransforms -d 3 -i "$ALLEN_LABELS" -r "$REF_IMG" -o "$OUT_FILE" -n "$INTERP" "${TRANSFORMS[@]}"
+
+    if [[ "$REF_IMG" != "$IMG" ]]; then
+      # back to the header of the map: labels and map then share its grid voxel by voxel
+      CopyImageHeaderInformation "$IMG" "$OUT_FILE" "$OUT_FILE" 1 1 1
+      rm -f "$REF_IMG"
+    fi
+    log_ok "Wrote: $OUT_FILE"
+  done
+done
+
+if [[ $n_inputs -eq 0 ]]; then
+  log_warn "No brain-extracted maps found in: $BRAIN_DIR"
+fi